@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Compare the parallel tree copy of copyfiles against cp -a and rsync -a.
+
+Creates a tree of small files (150k by default) shaped like a rootfs and
+copies it with every tool, then repeats the copy into the existing
+destination to show the incremental mode.
+
+    python3 benchmarks/copytree.py [-n FILES] [-j JOBS] [-d DIR]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from imageforge.copytree import copy_tree  # noqa: E402
+
+
+def make_tree(root: str, files: int) -> None:
+    """Create files of 0-16KiB spread over directories of 50 files."""
+    for i in range(files):
+        directory = os.path.join(root, "d" + str(i // 2500), "s" + str(i // 50))
+        if i % 50 == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, "f" + str(i)), "wb") as f:
+            f.write(os.urandom(i % 16 * 1024))
+
+
+def bench(name: str, func) -> None:
+    start = time.monotonic()
+    func()
+    print("%-28s %10.2fs" % (name, time.monotonic() - start))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--files", type=int, default=150000, help="Files")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="Copy threads")
+    parser.add_argument("-d", "--dir", default=None, help="Scratch directory")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(dir=args.dir)
+    try:
+        src = os.path.join(scratch, "src")
+        make_tree(src, args.files)
+        subprocess.run(["sync"])
+        bench(
+            "cp -a",
+            lambda: subprocess.run(["cp", "-a", src, scratch + "/cp"], check=True),
+        )
+        if shutil.which("rsync"):
+            bench(
+                "rsync -a",
+                lambda: subprocess.run(
+                    ["rsync", "-a", src + "/", scratch + "/rsync/"], check=True
+                ),
+            )
+            bench(
+                "rsync -a (up to date)",
+                lambda: subprocess.run(
+                    ["rsync", "-a", src + "/", scratch + "/rsync/"], check=True
+                ),
+            )
+        bench("copy_tree", lambda: copy_tree(src, scratch + "/py", jobs=args.jobs))
+        bench(
+            "copy_tree (up to date)",
+            lambda: copy_tree(src, scratch + "/py", jobs=args.jobs, incremental=True),
+        )
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+    main()
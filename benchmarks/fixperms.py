@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Compare the in-process permission fixing against one chown/chmod per entry.
+
+Creates a tree of small files (200k by default) spread over a few hundred
+directories and applies a perms map with an entry for every directory and
+a recursive entry for every top level directory. Needs to run as root.
+
+    python3 benchmarks/fixperms.py [-n FILES] [-e ENTRIES] [-d DIR]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from imageforge.perms import apply_perms  # noqa: E402
+
+
+def fix_subprocess(root: str, perms: dict) -> None:
+    """The previous path: chown and chmod once per entry."""
+    for key, (user, group, mode) in perms.items():
+        flags = "-Rh" if key.endswith("/") else "-h"
+        subprocess.run(["chown", flags, "--", user + ":" + group, root + key])
+        subprocess.run(["chmod", "--", mode, root + key])
+
+
+def make_tree(root: str, files: int, entries: int) -> dict:
+    """Create the tree and a perms map with about the given number of entries."""
+    tops = max(1, entries // 20)
+    dirs = ["/top" + str(i) + "/dir" + str(j) for i in range(tops) for j in range(19)]
+    for d in dirs:
+        os.makedirs(root + d)
+    for i in range(files):
+        with open(root + dirs[i % len(dirs)] + "/file" + str(i), "w"):
+            pass
+    perms = {}
+    for i in range(tops):
+        perms["/top" + str(i) + "/"] = ("0", "0", "755")
+    for i, d in enumerate(dirs):
+        perms[d + "/"] = (str(1000 + i % 7), str(1000 + i % 5), "750")
+    return perms
+
+
+def bench(name: str, func) -> None:
+    start = time.monotonic()
+    func()
+    print("%-24s %10.2fs" % (name, time.monotonic() - start))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--files", type=int, default=200000, help="Files")
+    parser.add_argument("-e", "--entries", type=int, default=400, help="Entries")
+    parser.add_argument("-d", "--dir", default=None, help="Scratch directory")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(dir=args.dir)
+    try:
+        perms = make_tree(scratch, args.files, args.entries)
+        print(str(len(perms)) + " entries, " + str(args.files) + " files")
+        bench("chown/chmod per entry", lambda: fix_subprocess(scratch, perms))
+        bench("apply_perms", lambda: apply_perms(scratch, perms))
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+    main()
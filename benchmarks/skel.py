@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compare the in-process skel provisioning against mkdir, cp and chown per user.
+
+Creates a rootfs with a passwd file of regular users (500 by default) and a
+skeleton of a few dotfiles and config directories, then fills the homes
+both ways. The previous path also needed a chown -R per home, which is
+included. Needs to run as root.
+
+    python3 benchmarks/skel.py [-u USERS] [-d DIR]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from imageforge import users  # noqa: E402
+
+
+def skel_subprocess(root: str) -> None:
+    """The previous path: mkdir and cp per user, then chown for fixperms."""
+    with open(root + "/etc/passwd") as f:
+        lines = f.readlines()
+    for line in lines:
+        parts = line.split(":")
+        if 1000 < int(parts[2]) < 2000:
+            home = root + "/home/" + parts[0]
+            subprocess.run(["mkdir", "-p", home])
+            subprocess.run(["cp", "-r", root + "/etc/skel/.", home])
+            subprocess.run(["chown", "-R", parts[2] + ":" + parts[3], home])
+
+
+def skel_inprocess(root: str) -> None:
+    regular = users.UserTable(root).regular()
+    entries = users.list_skel(root + "/etc/skel")
+    users.provision_homes(root, regular, entries)
+
+
+def make_root(root: str, count: int) -> None:
+    """Create the passwd file and the skeleton."""
+    os.makedirs(root + "/etc/skel/.config/autostart")
+    os.makedirs(root + "/etc/skel/.local/share")
+    for name in [".bashrc", ".bash_profile", ".bash_logout", ".zshrc"]:
+        with open(root + "/etc/skel/" + name, "w") as f:
+            f.write("# " + name + "\n" * 40)
+    with open(root + "/etc/skel/.config/autostart/setup.desktop", "w") as f:
+        f.write("[Desktop Entry]\n")
+    with open(root + "/etc/passwd", "w") as f:
+        f.write("root:x:0:0::/root:/bin/bash\n")
+        for uid in range(1001, 1001 + count):
+            f.write("lab%d:x:%d:%d::/home/lab%d:/bin/bash\n" % (uid, uid, uid, uid))
+
+
+def bench(name: str, func) -> None:
+    start = time.monotonic()
+    func()
+    print("%-24s %10.2fs" % (name, time.monotonic() - start))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-u", "--users", type=int, default=500, help="Users")
+    parser.add_argument("-d", "--dir", default=None, help="Scratch directory")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(dir=args.dir)
+    try:
+        make_root(scratch, min(args.users, 998))
+        print(str(min(args.users, 998)) + " users")
+        bench("mkdir/cp/chown per user", lambda: skel_subprocess(scratch))
+        shutil.rmtree(scratch + "/home")
+        bench("provision_homes", lambda: skel_inprocess(scratch))
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+    main()
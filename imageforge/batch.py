@@ -0,0 +1,170 @@
+"""Concurrent batch builds for imageforge.
+
+Runs one build script per config directory, each in its own process with
+its own work directory, while the builds share loop device allocation and
+a limited number of slots for I/O heavy stages through imageforge.locks.
+build_contexts does the same for BuildContexts within the calling process.
+
+    python3 -m imageforge.batch -s build.py -w work -o out [-j N] config_dir...
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from . import loopdev
+
+
+def _job_names(config_dirs: list) -> list:
+    """Give every config directory a unique name for its work directory."""
+    names = []
+    for config_dir in config_dirs:
+        name = os.path.basename(os.path.normpath(config_dir))
+        candidate = name
+        i = 1
+        while candidate in names:
+            i += 1
+            candidate = name + "-" + str(i)
+        names.append(candidate)
+    return names
+
+
+def build_many(
+    config_dirs: list,
+    script: str,
+    work_root: str,
+    out_dir: str,
+    jobs: int = 0,
+    io_slots: int = 2,
+    extra_args: list = None,  # type: ignore
+) -> dict:
+    """
+    Build several images concurrently.
+
+    Parameters
+    ----------
+        config_dirs (list): The config directories to build.
+        script (str): The build script, run with -w, -c and -o for every config.
+        work_root (str): Directory holding one work directory per build.
+        out_dir (str): The output directory shared by the builds.
+        jobs (int, optional): Number of concurrent builds, 0 for one per core. Defaults to 0.
+        io_slots (int, optional): Number of I/O heavy stages running at once. Defaults to 2.
+        extra_args (list, optional): Additional arguments for the build script. Defaults to None.
+
+    Returns
+    -------
+    dict: The exit code of every config directory.
+    """
+    names = _job_names(config_dirs)
+    extra_args = extra_args or []
+    jobs = jobs if jobs > 0 else os.cpu_count() or 1
+    env = dict(os.environ, IMAGEFORGE_IO_SLOTS=str(io_slots))
+    os.makedirs(work_root, exist_ok=True)
+
+    def build(config_dir: str, name: str) -> int:
+        work_dir = os.path.join(work_root, name)
+        log = os.path.join(work_root, name + ".log")
+        logging.info("Starting build of " + config_dir + ", log in " + log)
+        with open(log, "w") as f:
+            ret = subprocess.run(
+                [sys.executable, script, "-w", work_dir, "-c", config_dir]
+                + ["-o", out_dir]
+                + extra_args,
+                env=env,
+                stdout=f,
+                stderr=subprocess.STDOUT,
+            ).returncode
+        if ret != 0:
+            logging.error("Build of " + config_dir + " failed with code " + str(ret))
+        else:
+            logging.info("Build of " + config_dir + " done")
+        return ret
+
+    with ThreadPoolExecutor(max_workers=min(jobs, len(config_dirs))) as pool:
+        results = pool.map(build, config_dirs, names)
+        return dict(zip(config_dirs, results))
+
+
+def build_contexts(pipeline, contexts: list, jobs: int = 0) -> list:
+    """
+    Run a build pipeline for several build contexts in this process.
+
+    Parameters
+    ----------
+        pipeline (callable): Builds one image, called with the BuildContext.
+        contexts (list): The BuildContexts to build.
+        jobs (int, optional): Number of concurrent builds, 0 for one per core. Defaults to 0.
+
+    Returns
+    -------
+    list: The exception raised by every build, None for the successful ones.
+    """
+    jobs = jobs if jobs > 0 else os.cpu_count() or 1
+
+    def build(ctx) -> Exception:  # type: ignore
+        try:
+            pipeline(ctx)
+        except Exception as e:
+            ctx.log.exception("Build of " + ctx["img_name"] + " failed")
+            # The other builds keep running, release the devices of this one now.
+            loopdev.detach_all(owner=ctx["work_dir"])
+            return e
+        return None  # type: ignore
+
+    with ThreadPoolExecutor(max_workers=min(jobs, len(contexts))) as pool:
+        return list(pool.map(build, contexts))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build several images concurrently")
+    parser.add_argument("-s", "--script", help="Build script to run", required=True)
+    parser.add_argument(
+        "-w", "--work_root", help="Directory for the work directories", required=True
+    )
+    parser.add_argument(
+        "-o", "--out_dir", help="Folder to put output files", required=True
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="Concurrent builds, default one per core", type=int
+    )
+    parser.add_argument(
+        "--io-slots", help="Concurrent I/O heavy stages", type=int, default=2
+    )
+    parser.add_argument(
+        "-x", "--no-compress", help="Do not compress into a .xz", action="store_true"
+    )
+    parser.add_argument(
+        "-ff", "--fast-forward", help="Compress very briefly .xz", action="store_true"
+    )
+    parser.add_argument("config_dirs", nargs="+", help="Folders with config files")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S",
+        level=logging.INFO,
+    )
+    extra_args = []
+    if args.no_compress:
+        extra_args.append("-x")
+    if args.fast_forward:
+        extra_args.append("-ff")
+    results = build_many(
+        [os.path.abspath(d) for d in args.config_dirs],
+        os.path.abspath(args.script),
+        os.path.abspath(args.work_root),
+        os.path.abspath(args.out_dir),
+        jobs=args.jobs or 0,
+        io_slots=args.io_slots,
+        extra_args=extra_args,
+    )
+    failed = [d for d, ret in results.items() if ret != 0]
+    logging.info(
+        str(len(results) - len(failed)) + "/" + str(len(results)) + " builds succeeded"
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
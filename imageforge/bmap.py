@@ -0,0 +1,227 @@
+"""Block map files for imageforge images.
+
+A block map (.bmap) lists the blocks of an image holding data, with a
+checksum per range, in the version 2.0 format of bmaptool. Flashing tools
+write only those ranges and skip the rest of the image. The map is built
+from the chunks the compressors read, so it costs no extra pass over the
+image: holes reported by read_sparse are unmapped, data is mapped even if
+it is all zeros.
+"""
+
+import hashlib
+import os
+from .sparse import is_hole
+
+VERSION = "2.0"
+BLOCK_SIZE = 4096
+
+_TEMPLATE = """<?xml version="1.0" ?>
+<!-- This file contains the block map for an image file, which is basically
+     a list of useful (mapped) block numbers in the image file. In other
+     words, it lists only those blocks which contain data (boot sector,
+     partition table, file-system metadata, files, directories, extents,
+     etc). These blocks have to be copied to the target device. The other
+     blocks do not contain any useful data and do not have to be copied to
+     the target device. -->
+<bmap version="%(version)s">
+    <!-- Image size in bytes: %(human)s -->
+    <ImageSize> %(size)d </ImageSize>
+
+    <!-- Size of a block in bytes -->
+    <BlockSize> %(block_size)d </BlockSize>
+
+    <!-- Count of blocks in the image file -->
+    <BlocksCount> %(blocks)d </BlocksCount>
+
+    <!-- Count of mapped blocks: %(mapped_human)s or %(percent).1f%% -->
+    <MappedBlocksCount> %(mapped)d </MappedBlocksCount>
+
+    <!-- Type of checksum used in this file -->
+    <ChecksumType> sha256 </ChecksumType>
+
+    <!-- The checksum of this bmap file. When it is calculated, the value of
+         the checksum has be zero (all ASCII "0" symbols).  -->
+    <BmapFileChecksum> %(checksum)s </BmapFileChecksum>
+
+    <!-- The block map which consists of elements which may either be a
+         range of blocks or a single block. The 'chksum' attribute
+         (if present) is the checksum of this blocks range. -->
+    <BlockMap>
+%(ranges)s    </BlockMap>
+</bmap>
+"""
+
+
+def _human(size: int) -> str:
+    for unit in ["bytes", "KiB", "MiB", "GiB"]:
+        if size < 1024 or unit == "GiB":
+            return ("%d " if unit == "bytes" else "%.1f ") % size + unit
+        size /= 1024
+
+
+class BlockMap:
+    """
+    Builds the block map of an image from the chunks it is read in.
+
+    A block is mapped when any of its bytes is data. The checksum of a range
+    covers its blocks, the last block of the image only up to its end.
+    """
+
+    def __init__(self, block_size: int = BLOCK_SIZE):
+        """
+        Parameters
+        ----------
+            block_size (int, optional): Size of the blocks. Defaults to BLOCK_SIZE.
+        """
+        self.block_size = block_size
+        self.size = 0
+        # Finished (first, last, sha256) block ranges.
+        self.ranges = []
+        self.mapped = 0
+        # The open range: its first and last block and running hash.
+        self.first = None
+        self.last = None
+        self.hash = None
+        # Bytes of the current partial block and whether any is data.
+        self.partial = bytearray()
+        self.partial_data = False
+
+    def track(self, chunks):
+        """
+        Map chunks while passing them on.
+
+        Parameters
+        ----------
+            chunks (iterable): The image, as read by read_sparse.
+
+        Returns
+        -------
+        Generator of the same chunks.
+        """
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    def update(self, chunk) -> None:
+        """
+        Map the next chunk of the image.
+
+        Parameters
+        ----------
+            chunk (bytes-like): The chunk, a hole if is_hole says so.
+
+        Returns
+        -------
+        Nothing
+        """
+        data = not is_hole(chunk)
+        view = memoryview(chunk)
+        if self.partial:
+            n = min(len(view), self.block_size - len(self.partial))
+            self.partial += view[:n]
+            self.partial_data = self.partial_data or data
+            self.size += n
+            view = view[n:]
+            if len(self.partial) < self.block_size:
+                return
+            self._block((self.size - 1) // self.block_size)
+            self.partial = bytearray()
+            self.partial_data = False
+        whole = len(view) - len(view) % self.block_size
+        if whole:
+            if data:
+                self._blocks(view[:whole], self.size // self.block_size, whole)
+            else:
+                self._close()
+            self.size += whole
+        if whole < len(view):
+            self.partial += view[whole:]
+            self.partial_data = data
+            self.size += len(view) - whole
+
+    def _block(self, block: int) -> None:
+        """Finish the partial block, the given block of the image."""
+        if self.partial_data:
+            self._blocks(self.partial, block, len(self.partial))
+        else:
+            self._close()
+
+    def _blocks(self, view, block: int, length: int) -> None:
+        """Add mapped blocks, the data of length bytes starting at the given block."""
+        if self.last != block - 1:
+            self._close()
+            self.first = block
+            self.hash = hashlib.sha256()
+        self.hash.update(view)
+        count = -(-length // self.block_size)
+        self.last = block + count - 1
+        self.mapped += count
+
+    def _close(self) -> None:
+        """Finish the open range, if any."""
+        if self.first is not None:
+            self.ranges.append((self.first, self.last, self.hash.hexdigest()))
+        self.first = self.last = self.hash = None
+
+    def finish(self) -> None:
+        """
+        Map the last, partial block once the whole image was read.
+
+        Returns
+        -------
+        Nothing
+        """
+        if self.partial:
+            self._block((self.size - 1) // self.block_size)
+            self.partial = bytearray()
+        self._close()
+
+    def render(self) -> str:
+        """
+        Render the block map as a bmap file.
+
+        Returns
+        -------
+        str: The contents of the bmap file, with its checksum.
+        """
+        blocks = -(-self.size // self.block_size)
+        ranges = ""
+        for first, last, digest in self.ranges:
+            span = str(first) if first == last else str(first) + "-" + str(last)
+            ranges += '        <Range chksum="' + digest + '"> ' + span + " </Range>\n"
+        fields = {
+            "version": VERSION,
+            "human": _human(self.size),
+            "size": self.size,
+            "block_size": self.block_size,
+            "blocks": blocks,
+            "mapped_human": _human(self.mapped * self.block_size),
+            "percent": 100.0 * self.mapped / blocks if blocks else 0.0,
+            "mapped": self.mapped,
+            "checksum": "0" * 64,
+            "ranges": ranges,
+        }
+        fields["checksum"] = hashlib.sha256(
+            (_TEMPLATE % fields).encode("utf-8")
+        ).hexdigest()
+        return _TEMPLATE % fields
+
+    def write(self, path: str, digests=None) -> None:
+        """
+        Write the bmap file.
+
+        Parameters
+        ----------
+            path (str): The bmap file, usually the image path with .bmap instead of its compression extension.
+            digests (Digests, optional): Updated with the bytes written. Defaults to None.
+
+        Returns
+        -------
+        Nothing
+        """
+        data = self.render().encode("utf-8")
+        if digests is not None:
+            digests.update(data)
+        with open(path + ".part", "wb") as f:
+            f.write(data)
+        os.replace(path + ".part", path)
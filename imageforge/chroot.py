@@ -0,0 +1,227 @@
+"""Persistent chroot sessions for imageforge.
+
+arch-chroot mounts /proc, /sys, /dev and the rest for every command it
+runs and unmounts them again afterwards. A ChrootSession sets up the same
+mounts once for a root, every command then only costs the fork and exec of
+chroot(8). Sessions are shared by every command run in the same root and
+closed when the build is done with the tree, by unmount, copyfiles and
+cleanup, or at exit otherwise: processes left running in the root are
+killed and the mounts removed, so nothing of the host leaks into an image.
+"""
+
+import atexit
+import logging
+import os
+import signal
+import threading
+import time
+from .profiling import run
+
+_lock = threading.Lock()
+# Open sessions by root.
+_sessions = {}
+_atexit_registered = False
+
+# (source, target below the root, mount options) as arch-chroot sets them up.
+MOUNTS = [
+    ("proc", "proc", ["-t", "proc", "-o", "nosuid,noexec,nodev"]),
+    ("sys", "sys", ["-t", "sysfs", "-o", "nosuid,noexec,nodev,ro"]),
+    (
+        "efivarfs",
+        "sys/firmware/efi/efivars",
+        ["-t", "efivarfs", "-o", "nosuid,noexec,nodev"],
+    ),
+    ("udev", "dev", ["-t", "devtmpfs", "-o", "mode=0755,nosuid"]),
+    ("devpts", "dev/pts", ["-t", "devpts", "-o", "mode=0620,gid=5,nosuid,noexec"]),
+    ("shm", "dev/shm", ["-t", "tmpfs", "-o", "mode=1777,nosuid,nodev"]),
+    ("/run", "run", ["--bind", "--make-private"]),
+    ("tmp", "tmp", ["-t", "tmpfs", "-o", "mode=1777,strictatime,nodev,nosuid"]),
+]
+
+
+class ChrootSession:
+    """
+    The mounts of a chroot, set up once for all the commands run in it.
+    """
+
+    def __init__(self, root: str):
+        """
+        Parameters
+        ----------
+            root (str): The root of the chroot.
+        """
+        self.root = os.path.realpath(root)
+        # Mount points, in the order they were mounted.
+        self.mounts = []
+        # Files created to bind the resolv.conf of the host onto.
+        self.created = []
+        self.commands = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _mount(self, source: str, target: str, options: list) -> None:
+        path = os.path.join(self.root, target)
+        if not os.path.isdir(path):
+            if target == "sys/firmware/efi/efivars":
+                # Only on EFI hosts.
+                return
+            os.makedirs(path, exist_ok=True)
+        run(["mount", source, path] + options, check=True)
+        self.mounts.append(path)
+
+    def _resolv_conf(self) -> None:
+        """Bind the resolv.conf of the host, like arch-chroot, for network access."""
+        if not os.path.isfile("/etc/resolv.conf"):
+            return
+        path = os.path.join(self.root, "etc/resolv.conf")
+        if os.path.islink(path):
+            # Bind onto the target of the link within the root, e.g. systemd-resolved's.
+            target = os.readlink(path)
+            if os.path.isabs(target):
+                path = os.path.join(self.root, target.lstrip("/"))
+            else:
+                path = os.path.join(os.path.dirname(path), target)
+            path = os.path.normpath(path)
+            if not path.startswith(self.root + "/"):
+                return
+        if not os.path.lexists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+            self.created.append(path)
+        elif not os.path.isfile(path) or os.path.islink(path):
+            return
+        run(["mount", "--bind", "/etc/resolv.conf", path], check=True)
+        self.mounts.append(path)
+
+    def start(self) -> None:
+        """
+        Set up the mounts of the chroot.
+
+        Returns
+        -------
+        Nothing
+        """
+        logging.info("Setting up chroot " + self.root)
+        try:
+            for source, target, options in MOUNTS:
+                self._mount(source, target, options)
+            self._resolv_conf()
+        except BaseException:
+            self.close()
+            raise
+
+    def run(self, cmd: list, **kwargs):
+        """
+        Run a command in the chroot.
+
+        Parameters
+        ----------
+            cmd (list): The argv of the command, resolved in the chroot.
+            **kwargs: Passed on to profiling.run, e.g. check.
+
+        Returns
+        -------
+        subprocess.CompletedProcess: The result of the command.
+        """
+        self.commands += 1
+        env = dict(kwargs.pop("env", None) or os.environ, SHELL="/bin/bash")
+        return run(["chroot", self.root] + cmd, env=env, **kwargs)
+
+    def _processes(self) -> list:
+        """Processes running in the chroot, left behind by its commands."""
+        pids = []
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                if os.readlink("/proc/" + pid + "/root") == self.root:
+                    pids.append(int(pid))
+            except OSError:
+                pass
+        return pids
+
+    def close(self) -> None:
+        """
+        Kill what still runs in the chroot and remove its mounts.
+
+        Failures are logged, not raised, so teardown carries on.
+
+        Returns
+        -------
+        Nothing
+        """
+        for signum in (signal.SIGTERM, signal.SIGKILL):
+            pids = self._processes()
+            for pid in pids:
+                logging.warning("Killing process " + str(pid) + " left in the chroot")
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+            if pids and signum == signal.SIGTERM:
+                time.sleep(0.5)
+        for path in reversed(self.mounts):
+            if run(["umount", path]).returncode != 0:
+                logging.warning("Lazily unmounting busy " + path)
+                run(["umount", "-l", path])
+        self.mounts = []
+        for path in self.created:
+            os.remove(path)
+        self.created = []
+        logging.info(
+            "Closed chroot " + self.root + " after " + str(self.commands) + " commands"
+        )
+
+
+def session(root: str) -> ChrootSession:
+    """
+    Get the chroot session of a root, setting it up on first use.
+
+    Parameters
+    ----------
+        root (str): The root of the chroot.
+
+    Returns
+    -------
+    ChrootSession: The session, closed by close_sessions or at exit.
+    """
+    global _atexit_registered
+    root = os.path.realpath(root)
+    with _lock:
+        if root not in _sessions:
+            chroot = ChrootSession(root)
+            chroot.start()
+            _sessions[root] = chroot
+            if not _atexit_registered:
+                atexit.register(close_sessions)
+                _atexit_registered = True
+        return _sessions[root]
+
+
+def close_sessions(under: str = None) -> None:  # type: ignore
+    """
+    Close the chroot sessions of the roots within a directory.
+
+    Parameters
+    ----------
+        under (str, optional): The directory, None to close every session. Defaults to None.
+
+    Returns
+    -------
+    Nothing
+    """
+    under = os.path.realpath(under) if under is not None else None
+    with _lock:
+        roots = [
+            root
+            for root in _sessions
+            if under is None or root == under or root.startswith(under + "/")
+        ]
+        closing = [_sessions.pop(root) for root in roots]
+    for chroot in closing:
+        chroot.close()
@@ -1,7 +1,20 @@
-import subprocess
+import os
+from . import manifest
+from .bmap import BlockMap
+from .compression import FORMATS, compress_stream
+from .copytree import copy_tree
+from .digests import Digests, hash_file, sign, update_manifest, write_sidecar
+from .export import export_file
+from .fsimage import assemble, build_all, read_disk
+from . import chroot, loopdev, reproducible, rootfs, users
+from .locks import io_slot
+from .perms import apply_perms
+from .profiling import run, stage
+from .sizing import image_size, scan, shrink_image
+from .sparse import read_sparse
 from .config import (
-    cfg,
-    logging,
+    BuildContext,
+    resolve,
 )
 
 
@@ -18,61 +31,53 @@ def realpath(path: str) -> str:
     -------
     The real path of the file or directory.
     """
-    return subprocess.check_output(["readlink", "-f", path]).decode("utf-8").split()[0]
+    return os.path.realpath(path)
 
 
-def copy_skel_to_users() -> None:
+@stage
+def copy_skel_to_users(ctx: BuildContext = None) -> None:  # type: ignore
     """
     Copies the contents of the skeleton directory to non-root users' home directories.
 
+    passwd and group are parsed once and /etc/skel is walked once for all
+    users, the homes are then filled concurrently with everything already
+    owned by its user, see imageforge.users.
+
     Parameters
     ----------
-    None
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
-    non_root_users = []
-
-    try:
-        with open(cfg["install_dir"] + "/etc/passwd", "r") as passwd_file:
-            lines = passwd_file.readlines()
-
-        for line in lines:
-            parts = line.split(":")
-            username = parts[0]
-            uid = int(parts[2])
-
-            if (
-                uid != 0 and uid > 1000 and uid < 2000
-            ):  # Check if the user ID is not root (UID 0)
-                non_root_users.append(username)
-
-    except FileNotFoundError:
-        print("Error: No passwd file not found.")
-
-    for user in non_root_users:
-        logging.info("Copying skel to " + user)
-        subprocess.run(["mkdir", "-p", cfg["install_dir"] + "/home/" + user])
-        subprocess.run(
-            "cp -r "
-            + cfg["install_dir"]
-            + "/etc/skel/. "
-            + cfg["install_dir"]
-            + "/home/"
-            + user,
-            shell=True,
-        )
+    cfg = resolve(ctx)
+    if not os.path.isfile(cfg["install_dir"] + "/etc/passwd"):
+        cfg.log.error("No passwd file found")
+        return
+    regular = users.UserTable(cfg["install_dir"]).regular()
+    if not regular:
+        return
+    entries = users.list_skel(cfg["install_dir"] + "/etc/skel")
+    cfg.log.info("Copying skel to " + ", ".join(user[0] for user in regular))
+    copied = users.provision_homes(cfg["install_dir"], regular, entries)
+    cfg.log.info(
+        "Copied " + str(copied) + " skel entries to " + str(len(regular)) + " homes"
+    )
 
 
-def fixperms() -> None:
+@stage
+def fixperms(ctx: BuildContext = None) -> None:  # type: ignore
     """
     Fix the permissions of the specified target file or directory.
 
+    All entries of the perms config are applied in a single walk of the rootfs,
+    see imageforge.perms.apply_perms.
+
     Parameters
     ----------
         target (str): The path to the target file or directory.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Raises
     ------
@@ -83,37 +88,27 @@ def fixperms() -> None:
     Nothing
 
     """
-    realtarget = realpath(cfg["install_dir"])
-    for i in cfg["perms"].keys():
-        if realpath(realtarget + i) != realtarget + (i if not i[-1] == "/" else i[:-1]):
-            raise OSError("Out of bounds permission fix!")
-        if i[-1] == "/":
-            subprocess.run(
-                [
-                    "chown",
-                    "-Rh",
-                    "--",
-                    cfg["perms"][i][0] + ":" + cfg["perms"][i][1],
-                    realtarget + i,
-                ]
-            )
-        else:
-            subprocess.run(
-                [
-                    "chown",
-                    "-hv",
-                    "--",
-                    cfg["perms"][i][0] + ":" + cfg["perms"][i][1],
-                    realtarget + i,
-                ]
-            )
-        subprocess.run(["chmod", "--", cfg["perms"][i][2], realtarget + i])
+    cfg = resolve(ctx)
+    # No host mount of a chroot session may be chowned.
+    chroot.close_sessions(cfg["install_dir"])
+    stats = apply_perms(realpath(cfg["install_dir"]), cfg["perms"])
+    cfg.log.debug(
+        "Fixed ownership of "
+        + str(stats["entries"])
+        + " files and "
+        + str(stats["modes"])
+        + " modes"
+    )
 
 
 def run_chroot_cmd(work_dir: str, cmd: list) -> None:
     """
     Run a command inside a chroot environment.
 
+    The mounts of the chroot are set up on the first command and shared by
+    the following ones, until the build is done with the tree, see
+    imageforge.chroot.
+
     Parameters
     ----------
         work_dir (str): The path to the chroot environment.
@@ -123,145 +118,459 @@ def run_chroot_cmd(work_dir: str, cmd: list) -> None:
     -------
     Nothing
     """
-    subprocess.run(["arch-chroot", work_dir] + cmd)
+    chroot.session(work_dir).run(cmd)
 
 
-def compressimage(ff: bool = False) -> None:
+@stage
+def compressimage(ff: bool = False, ctx: BuildContext = None) -> None:  # type: ignore
     """
-    Compresses the image file using the xz compression algorithm.
+    Compresses the image file into every format listed in the compression config.
+
+    The image is read once and fed to one multithreaded compressor per format,
+    which write straight into the output directory. Streamed images are read
+    from their partition table and filesystem images, see fsimage.read_disk.
+    The block map of the image is written next to them as a bmaptool .bmap
+    file from the same read, and the outputs are seekable if the config asks.
+    With checksums, the raw image is hashed from the same read and every
+    output on its way out of its compressor, see _record_digests.
 
     Parameters
     ----------
         ff (bool, optional): Flag indicating whether to use fast compression. Defaults to False.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
-    logging.info("Compressing " + cfg["img_name"] + ".img")
-    subprocess.run(
-        [
-            "xz",
-            "-k",
-            "-5" if not ff else "-1",
-            "-T0",
-            "--verbose",
-            "-f",
-            "-M",
-            "65%",
-            cfg["work_dir"] + "/" + cfg["img_name"] + ".img",
-        ]
-    )
-    # Move the image to the correct output directory
-    subprocess.run(
-        [
-            "mv",
-            cfg["work_dir"] + "/" + cfg["img_name"] + ".img.xz",
-            cfg["out_dir"] + "/" + cfg["img_name"] + ".img.xz",
-        ]
-    )
-    subprocess.run(["chmod", "-R", "777", cfg["out_dir"]])
-    logging.info("Compressed " + cfg["img_name"] + ".img")
+    cfg = resolve(ctx)
+    cfg.log.info("Compressing " + cfg["img_name"] + ".img")
+    image = cfg["work_dir"] + "/" + cfg["img_name"] + ".img"
+    dst_base = cfg["out_dir"] + "/" + cfg["img_name"] + ".img"
+    outputs = {fmt: dst_base + FORMATS[fmt]["ext"] for fmt in cfg["compression"]}
+    artifacts = list(outputs.values())
+    with io_slot():
+        if any("image" in fs for fs in cfg.filesystems):
+            chunks = read_disk(image, cfg.filesystems)
+        else:
+            chunks = read_sparse(image)
+        block_map = BlockMap() if cfg["bmap"] else None
+        if block_map is not None:
+            chunks = block_map.track(chunks)
+        image_digests = None
+        output_digests = {}
+        if cfg["checksums"]:
+            image_digests = Digests()
+            chunks = image_digests.track(chunks)
+            output_digests = {fmt: Digests() for fmt in outputs}
+        compress_stream(
+            chunks,
+            outputs,
+            fast=ff,
+            seekable=cfg["seekable"],
+            digests=output_digests,
+        )
+    results = {
+        outputs[fmt]: digests.result() for fmt, digests in output_digests.items()
+    }
+    if block_map is not None:
+        block_map.finish()
+        bmap_digests = Digests() if cfg["checksums"] else None
+        block_map.write(dst_base + ".bmap", bmap_digests)
+        artifacts.append(dst_base + ".bmap")
+        if bmap_digests is not None:
+            results[dst_base + ".bmap"] = bmap_digests.result()
+        cfg.log.info(
+            "Mapped "
+            + str(block_map.mapped)
+            + " of "
+            + str(-(-block_map.size // block_map.block_size))
+            + " blocks"
+        )
+    if cfg["checksums"]:
+        cfg.image_digests = image_digests.result()
+        artifacts += _record_digests(cfg.image_digests, results, cfg)
+    for artifact in artifacts:
+        os.chmod(artifact, 0o777)
+    cfg.log.info("Compressed " + cfg["img_name"] + ".img")
 
 
-def copyimage() -> None:
+def _record_digests(
+    image: dict, results: dict, ctx: BuildContext = None, name: str = None  # type: ignore
+) -> list:
+    """
+    Write the .sha256 sidecars of the artifacts and record them in the manifest.
+
+    The manifest, out_dir/<name>.manifest.json, is signed if a signing_key
+    is configured.
+
+    Parameters
+    ----------
+        image (dict): Digests of the raw image, see Digests.result, or None.
+        results (dict): Digests of every artifact by path.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+        name (str, optional): The base name of the artifacts. Defaults to <img_name>.img.
+
+    Returns
+    -------
+    list: The files written.
+    """
+    cfg = resolve(ctx)
+    if name is None:
+        name = cfg["img_name"] + ".img"
+    written = [write_sidecar(path, result) for path, result in results.items()]
+    manifest = cfg["out_dir"] + "/" + name + ".manifest.json"
+    update_manifest(manifest, image, results)
+    written.append(manifest)
+    if image is not None:
+        cfg.log.info("Image sha256 " + image["sha256"])
+    if cfg["signing_key"] is not None:
+        written.append(sign(manifest, cfg["signing_key"]))
+        cfg.log.info("Signed " + os.path.basename(manifest))
+    return written
+
+
+@stage
+def copyimage(move: bool = False, ctx: BuildContext = None) -> None:  # type: ignore
     """
     Copies the image file to the output directory.
 
-    This function moves the image file from the working directory to the output directory.
-    It also sets the appropriate permissions for the output directory.
+    This function exports the image file from the working directory to the output directory
+    with the cheapest strategy available (reflink, sparse in-kernel copy or rename).
+    Streamed images are assembled from their filesystem images first.
+    Only the exported image gets its permissions set. With checksums, the
+    digests compressimage took of the image are reused. Without them the
+    image is hashed while it is copied, which rules out the in-kernel copies,
+    and read once more after a reflink or rename, see export_file.
 
     Parameters
     ----------
-    None
+        move (bool, optional): Whether the work image may be moved instead of copied. Defaults to False.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
-    logging.info("Copying " + cfg["img_name"] + ".img")
-    # Move the image to the correct output directory
-    subprocess.run(
-        [
-            "cp",
+    cfg = resolve(ctx)
+    cfg.log.info("Copying " + cfg["img_name"] + ".img")
+    if any("image" in fs for fs in cfg.filesystems):
+        cfg.log.info("Assembling the streamed image")
+        with io_slot():
+            assemble(cfg.filesystems)
+    dst = cfg["out_dir"] + "/" + cfg["img_name"] + ".img"
+    digests = None
+    if cfg["checksums"] and cfg.image_digests is None:
+        digests = Digests()
+    # Export the image to the correct output directory
+    with io_slot():
+        strategy = export_file(
             cfg["work_dir"] + "/" + cfg["img_name"] + ".img",
-            cfg["out_dir"] + "/" + cfg["img_name"] + ".img",
-        ]
-    )
-    subprocess.run(["chmod", "-R", "777", cfg["out_dir"]])
-    logging.info("Copied " + cfg["img_name"] + ".img")
+            dst,
+            move=move,
+            digests=digests,
+        )
+    cfg.log.info("Copied " + cfg["img_name"] + ".img using " + strategy)
+    if cfg["checksums"]:
+        result = cfg.image_digests if digests is None else digests.result()
+        for path in _record_digests(result, {dst: result}, cfg):
+            os.chmod(path, 0o777)
 
 
-def copyfiles(ot: str, to: str, retainperms=False) -> None:
+@stage
+def export_rootfs(ff: bool = False, ctx: BuildContext = None) -> None:  # type: ignore
+    """
+    Exports the install directory as a rootfs, without building a disk image.
+
+    Every format of the rootfs_formats config is written to the output
+    directory. The tar is streamed from tar straight into one multithreaded
+    compressor per compression format, as <img_name>.rootfs.tar.<ext>, and
+    squashfs and erofs images are written by their tools using every core.
+    The outputs are deterministic, see imageforge.rootfs, and reproducible
+    with SOURCE_DATE_EPOCH set or the reproducible config. With checksums,
+    the tar outputs are hashed on their way out of their compressors and the
+    images are read once.
+
+    Parameters
+    ----------
+        ff (bool, optional): Flag indicating whether to use fast compression. Defaults to False.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
+    # Nothing of the host may be mounted in the exported tree.
+    chroot.close_sessions(cfg["install_dir"])
+    epoch = cfg["source_date_epoch"]
+    name = cfg["img_name"] + ".rootfs"
+    dst_base = cfg["out_dir"] + "/" + name
+    artifacts = []
+    results = {}
+    tar_digests = None
+    for fmt in cfg["rootfs_formats"]:
+        cfg.log.info("Exporting the rootfs as " + fmt)
+        if fmt == "tar":
+            outputs = {
+                compression: dst_base
+                + rootfs.FORMATS[fmt]
+                + FORMATS[compression]["ext"]
+                for compression in cfg["compression"]
+            }
+            output_digests = {}
+            if cfg["checksums"]:
+                tar_digests = Digests()
+                output_digests = {compression: Digests() for compression in outputs}
+            with io_slot():
+                rootfs.write_tar(
+                    cfg["install_dir"],
+                    outputs,
+                    epoch=epoch,
+                    fast=ff,
+                    seekable=cfg["seekable"],
+                    digests=output_digests,
+                    tar_digests=tar_digests,
+                )
+            artifacts += outputs.values()
+            for compression, digests in output_digests.items():
+                results[outputs[compression]] = digests.result()
+        else:
+            dst = dst_base + rootfs.FORMATS[fmt]
+            with io_slot():
+                rootfs.write_image(fmt, cfg["install_dir"], dst, epoch=epoch, fast=ff)
+            artifacts.append(dst)
+            if cfg["checksums"]:
+                results[dst] = hash_file(dst).result()
+    if cfg["checksums"]:
+        image = tar_digests.result() if tar_digests is not None else None
+        artifacts += _record_digests(image, results, cfg, name)
+    for artifact in artifacts:
+        os.chmod(artifact, 0o777)
+    cfg.log.info("Exported the rootfs")
+
+
+@stage
+def copyfiles(
+    ot: str, to: str, retainperms=False, incremental=False, ctx: BuildContext = None
+) -> None:  # type: ignore
     """
     Copy files from one directory to another.
 
+    Files are copied in parallel keeping ownership, modes, hardlinks, xattrs,
+    device nodes and holes, see imageforge.copytree.copy_tree. When the
+    install dir is copied into a previous image reused by makeimg, only the
+    differences to the manifest of that image are applied.
+
     Parameters
     ----------
         ot (str): The source directory path.
         to (str): The destination directory path.
-        retainperms (bool, optional): Whether to retain the permissions of the copied files. Defaults to False.
+        retainperms (bool, optional): Whether to copy like rsync -a, leaving out the contents of proc and skipping files already up to date. Defaults to False.
+        incremental (bool, optional): Whether to skip files whose size, mtime, mode and owner already match. Defaults to False.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
-    logging.info("Copying files to " + to)
-    if retainperms:
-        subprocess.run(f"rsync -ah --progress --exclude=proc/* {ot}/ {to}/", shell=True)
-    else:
-        subprocess.run("cp -ar " + ot + "/* " + to, shell=True)
+    cfg = resolve(ctx)
+    # The mounts of a chroot must not be copied.
+    chroot.close_sessions(ot)
+    if os.path.realpath(ot) == os.path.realpath(to):
+        # The mkfs image backend generates the filesystems from ot directly.
+        cfg.log.info("Files already in " + to)
+        return
+    if cfg["reproducible"]:
+        reproducible.normalize(ot, cfg["source_date_epoch"])
+    if cfg.previous is not None and os.path.realpath(ot) == cfg["install_dir"]:
+        cfg.log.info("Patching changed files into " + to)
+        with io_slot():
+            # Reproducible builds clamp mtimes, so they cannot tell changes apart.
+            cfg.manifest = manifest.scan(ot, cfg.previous, rehash=cfg["reproducible"])
+            stats = manifest.apply(ot, to, cfg.previous, cfg.manifest)
+        cfg.log.info(
+            "Patched "
+            + str(stats["changed"])
+            + " changed and "
+            + str(stats["removed"])
+            + " removed paths"
+        )
+        return
+    cfg.log.info("Copying files to " + to)
+    with io_slot():
+        stats = copy_tree(
+            ot,
+            to,
+            incremental=incremental or retainperms,
+            exclude=["proc"] if retainperms else [],
+        )
+    cfg.log.info(
+        "Copied "
+        + str(stats["files"])
+        + " files ("
+        + str(stats["bytes"] // 1024**2)
+        + " MiB), skipped "
+        + str(stats["skipped"])
+    )
 
 
-def remove_machine_id() -> None:
+@stage
+def remove_machine_id(ctx: BuildContext = None) -> None:  # type: ignore
     """
     Removes the machine ID file from the installation directory.
 
+    In reproducible builds every file recording the machine or the build is
+    removed or emptied, see reproducible.clean.
+
     Parameters
     ----------
-    None
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
-    subprocess.run(
-        " ".join(
-            [
-                "rm",
-                "-rf",
-                cfg["install_dir"] + "/etc/machine-id",
-                cfg["install_dir"] + "/var/lib/dbus/machine-id",
-            ]
-        ),
-        shell=True,
+    cfg = resolve(ctx)
+    run(
+        [
+            "rm",
+            "-rf",
+            cfg["install_dir"] + "/etc/machine-id",
+            cfg["install_dir"] + "/var/lib/dbus/machine-id",
+        ]
     )
+    if cfg["reproducible"]:
+        cleaned = reproducible.clean(cfg["install_dir"])
+        cfg.log.info("Removed or emptied " + str(len(cleaned)) + " build records")
 
 
-def unmount(ldev: str, ldev_alt: str = None) -> None:  # type: ignore
+@stage
+def unmount(ldev: str, ldev_alt: str = None, ctx: BuildContext = None) -> None:  # type: ignore
     """
     Unmounts a device and releases loop devices.
 
+    With the mkfs image backend nothing is mounted, the planned filesystems
+    are generated from mnt_dir and written into their image files instead,
+    or kept apart for compressimage to stream in stream mode.
+    With an incremental_dir the manifest of mnt_dir is taken first and the
+    image is saved with it for the next build to patch.
+
     Parameters
     ----------
         ldev (str): The device to unmount.
         ldev_alt (str, optional): An alternative device to unmount. Defaults to None.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
-    logging.info("Unmounting!")
-    subprocess.run(["umount", "-R", cfg["mnt_dir"]])
-    subprocess.run(["losetup", "-d", ldev])
+    cfg = resolve(ctx)
+    chroot.close_sessions(cfg["mnt_dir"])
+    if cfg["img_backend"] == "mkfs":
+        if cfg["reproducible"]:
+            reproducible.normalize(cfg["mnt_dir"], cfg["source_date_epoch"])
+        cfg.log.info("Generating filesystems")
+        with io_slot():
+            build_all(
+                cfg.filesystems,
+                cfg["mnt_dir"],
+                cfg["work_dir"],
+                splice=not cfg["stream"],
+            )
+        if cfg["stream"]:
+            # Kept for compressimage and copyimage.
+            if cfg["shrink"]:
+                cfg.log.warning("Streamed images are not shrunk")
+            return
+        cfg.filesystems = []
+        _shrink(cfg)
+        return
+    entries = None
+    if cfg["incremental_dir"] is not None:
+        cfg.log.info("Taking the manifest of the image")
+        entries = manifest.scan(
+            cfg["mnt_dir"], cfg.manifest, rehash=cfg["reproducible"]
+        )
+    cfg.log.info("Unmounting!")
+    run(["umount", "-R", cfg["mnt_dir"]])
+    loopdev.detach(ldev, force=True)
     if ldev_alt is not None:
-        subprocess.run(["losetup", "-d", ldev_alt])
+        loopdev.detach(ldev_alt, force=True)
+    if cfg["loop_pool"]:
+        loopdev.warm(cfg["loop_pool"])
+    if entries is not None:
+        _save_incremental(entries, cfg)
+    cfg.previous = None
+    _shrink(cfg)
+
+
+def _shrink(ctx: BuildContext = None) -> None:  # type: ignore
+    """
+    Shrink the image file to its contents if the config asks to.
+
+    Parameters
+    ----------
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
+    if not cfg["shrink"]:
+        return
+    image = cfg["work_dir"] + "/" + cfg["img_name"] + ".img"
+    before = os.path.getsize(image) // 1024
+    after = shrink_image(image)
+    cfg.log.info(
+        "Shrunk the image from "
+        + str(before // 1024)
+        + "MiB to "
+        + str(after // 1024)
+        + "MiB"
+    )
+
+
+def _save_incremental(entries: dict, ctx: BuildContext = None) -> None:  # type: ignore
+    """
+    Save the image and its manifest for the next build to patch.
+
+    Parameters
+    ----------
+        entries (dict): The manifest of the image.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
+    image = cfg["work_dir"] + "/" + cfg["img_name"] + ".img"
+    base = os.path.join(cfg["incremental_dir"], cfg["img_name"])
+    os.makedirs(cfg["incremental_dir"], exist_ok=True)
+    # The manifest goes first, so it never describes another image.
+    if os.path.exists(base + ".manifest.json"):
+        os.remove(base + ".manifest.json")
+    with io_slot():
+        strategy = export_file(image, base + ".img.part", mode=0o644)
+    os.replace(base + ".img.part", base + ".img")
+    manifest.save(
+        base + ".manifest.json",
+        entries,
+        manifest.layout_key(cfg, os.path.getsize(image) // 1024),
+    )
+    cfg.log.info("Saved the image for incremental builds using " + strategy)
 
 
 def get_size(path: str) -> int:
     """
     Get the size of a file or directory.
 
+    Like du -s --exclude=proc, hardlinked files are counted once. The chroot
+    sessions within path are closed first, so no host mount is counted.
+
     Parameters
     ----------
         path (str): The path to the file or directory.
@@ -270,17 +579,41 @@ def get_size(path: str) -> int:
     -------
     int: The size of the file or directory in kilobytes.
     """
-    return int(
-        subprocess.check_output(["du", "-s", "--exclude=proc", path])
-        .split()[0]
-        .decode("utf-8")
-    )
+    chroot.close_sessions(path)
+    return scan(path, ["proc"])["allocated"] // 1024
+
+
+def get_img_size(path: str, headroom: int = 0, ctx: BuildContext = None) -> int:  # type: ignore
+    """
+    Get the size of an image holding a rootfs, to pass to makeimg.
+
+    The filesystem overhead of the configured filesystem and the partitions
+    of the partition table are accounted for, see sizing.image_size. The
+    chroot sessions within path are closed first, see get_size.
+
+    Parameters
+    ----------
+        path (str): The rootfs directory.
+        headroom (int, optional): Free space to leave in the root filesystem, in kilobytes. Defaults to 0.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    int: The image size in kilobytes.
+    """
+    cfg = resolve(ctx)
+    chroot.close_sessions(path)
+    img_size = image_size(path, cfg, headroom)
+    cfg.log.info("Image size for " + path + ": " + str(img_size // 1024) + "MiB")
+    return img_size
 
 
 def next_loop() -> str:
     """
     Returns the next available loop device.
 
+    The device is not reserved, concurrent builds should let makeimg allocate it.
+
     Parameters
     ----------
     None
@@ -290,4 +623,24 @@ def next_loop() -> str:
         str: The next available loop device.
     """
 
-    return subprocess.check_output(["losetup", "-f"]).decode("utf-8").strip("\n")
+    return loopdev.find_free()
+
+
+def attach_loop(image: str, ldev: str = None, owner: str = None) -> str:  # type: ignore
+    """
+    Attaches an image file to a loop device.
+
+    The device is allocated and configured atomically and recorded in the
+    registry of imageforge.loopdev, so it is released even if the build fails.
+
+    Parameters
+    ----------
+        image (str): The image file to attach.
+        ldev (str, optional): The loop device to use, another free one is picked if it is taken. Defaults to None.
+        owner (str, optional): The build owning the device. Defaults to None.
+
+    Returns
+    -------
+        str: The loop device the image is attached to.
+    """
+    return loopdev.attach(image, ldev, owner=owner)
@@ -0,0 +1,360 @@
+"""Compression engine for imageforge."""
+
+import logging
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .digests import tee
+from .profiling import run
+from .sparse import is_hole, read_sparse
+
+# Supported output formats, the file extension they produce and the
+# compression level used for normal and fast (-ff) builds.
+FORMATS = {
+    "xz": {"ext": ".xz", "level": 5, "fast_level": 1},
+    "zstd": {"ext": ".zst", "level": 9, "fast_level": 1},
+    "gzip": {"ext": ".gz", "level": 6, "fast_level": 1},
+}
+
+# Uncompressed size of the independent blocks (xz) or frames (zstd) of
+# seekable outputs, the unit tools can decompress in parallel or skip.
+FRAME_SIZE = 16 * 1024 * 1024
+
+# Magic numbers of the seek table skippable frame of the zstd seekable format.
+_ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+_ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+def compressor_argv(
+    fmt: str, fast: bool = False, threads: int = 0, seekable: bool = False
+) -> list:
+    """
+    Build the command line of a compressor reading stdin and writing stdout.
+
+    Parameters
+    ----------
+        fmt (str): The output format, one of FORMATS.
+        fast (bool, optional): Use the fast compression level. Defaults to False.
+        threads (int, optional): Number of threads, 0 for all cores. Defaults to 0.
+        seekable (bool, optional): Compress FRAME_SIZE blocks independently. Defaults to False.
+
+    Returns
+    -------
+    list: The compressor argv.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unsupported compression format " + fmt)
+    level = FORMATS[fmt]["fast_level" if fast else "level"]
+    if fmt == "xz":
+        # Multithreaded xz splits the stream into independent blocks, indexed
+        # at the end of the file.
+        argv = ["xz", "-c", "-" + str(level), "-T" + str(threads), "-M", "65%"]
+        if seekable:
+            argv.append("--block-size=" + str(FRAME_SIZE))
+        return argv
+    if fmt == "zstd":
+        if seekable:
+            # One process per frame, see _zstd_frames, frames do not share a window.
+            return ["zstd", "-c", "-q", "-" + str(level)]
+        # A 128MiB long-range window is still decoded by plain `zstd -d`.
+        return [
+            "zstd",
+            "-c",
+            "-q",
+            "-" + str(level),
+            "-T" + str(threads),
+            "--long=27",
+        ]
+    if shutil.which("pigz") is not None:
+        return [
+            "pigz",
+            "-c",
+            "-" + str(level),
+            "-p",
+            str(threads if threads > 0 else os.cpu_count() or 1),
+        ]
+    logging.warning("pigz not found, falling back to single threaded gzip")
+    return ["gzip", "-c", "-" + str(level)]
+
+
+def _feed(proc: subprocess.Popen, chunks: queue.Queue, errors: list) -> None:
+    """Write queued chunks to the stdin of a compressor until None is queued."""
+    failed = False
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if failed:
+            continue
+        try:
+            proc.stdin.write(chunk)
+        except BrokenPipeError as e:
+            # Keep draining so the reader never blocks on this queue.
+            errors.append(e)
+            failed = True
+    try:
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+
+
+def _tee(src, path: str, digests, errors: list) -> None:
+    """Write the output of a compressor into its file, hashing it, see digests.tee."""
+    try:
+        tee(src, path, digests)
+    except Exception as e:
+        errors.append(e)
+        # Unblock the compressor, which then fails on a broken pipe.
+        src.close()
+
+
+def _frames(chunks: queue.Queue):
+    """Regroup queued chunks into FRAME_SIZE frames, with whether each is all holes."""
+    frame = []
+    length = 0
+    holes = True
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        view = memoryview(chunk)
+        while view:
+            piece = view[: FRAME_SIZE - length]
+            view = view[len(piece) :]
+            frame.append(piece)
+            length += len(piece)
+            holes = holes and is_hole(chunk)
+            if length == FRAME_SIZE:
+                yield frame, length, holes
+                frame = []
+                length = 0
+                holes = True
+    if length:
+        yield frame, length, holes
+
+
+def _zstd_frames(
+    chunks: queue.Queue,
+    dst: str,
+    argv: list,
+    threads: int,
+    errors: list,
+    digests=None,
+) -> None:
+    """
+    Write queued chunks as a seekable zstd file until None is queued.
+
+    Every FRAME_SIZE of input is compressed into an independent frame, frames
+    are compressed in parallel and the seek table of the zstd seekable format
+    is appended, a skippable frame plain `zstd -d` ignores. Frames of holes
+    are compressed once.
+
+    Parameters
+    ----------
+        chunks (queue.Queue): The uncompressed data.
+        dst (str): The output file.
+        argv (list): The compressor command line, see compressor_argv.
+        threads (int): Frames compressed at once, 0 for all cores.
+        errors (list): Exceptions are appended to it.
+        digests (Digests, optional): Updated with the output. Defaults to None.
+
+    Returns
+    -------
+    Nothing
+    """
+
+    def compress(frame: list) -> bytes:
+        return run(
+            argv, input=b"".join(frame), stdout=subprocess.PIPE, check=True
+        ).stdout
+
+    workers = threads if threads > 0 else os.cpu_count() or 1
+    zeros = {}
+    sizes = []
+    failed = False
+    with open(dst, "wb") as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+
+        def write(frame, length: int) -> None:
+            data = frame if isinstance(frame, bytes) else frame.result()
+            if digests is not None:
+                digests.update(data)
+            out.write(data)
+            sizes.append((len(data), length))
+
+        def ready() -> bool:
+            return bool(pending) and (
+                len(pending) > 2 * workers
+                or isinstance(pending[0][0], bytes)
+                or pending[0][0].done()
+            )
+
+        for frame, length, holes in _frames(chunks):
+            if failed:
+                continue
+            try:
+                if holes:
+                    if length not in zeros:
+                        zeros[length] = compress(frame)
+                    pending.append((zeros[length], length))
+                else:
+                    pending.append((pool.submit(compress, frame), length))
+                # Write in order, keeping a bounded number of frames in flight.
+                while ready():
+                    write(*pending.pop(0))
+            except Exception as e:
+                # Keep draining so the reader never blocks on this queue.
+                errors.append(e)
+                failed = True
+        try:
+            while pending and not failed:
+                write(*pending.pop(0))
+            table = b"".join(struct.pack("<II", *size) for size in sizes)
+            table += struct.pack("<IBI", len(sizes), 0, _ZSTD_SEEKABLE_MAGIC)
+            table = struct.pack("<II", _ZSTD_SKIPPABLE_MAGIC, len(table)) + table
+            if digests is not None:
+                digests.update(table)
+            out.write(table)
+        except Exception as e:
+            errors.append(e)
+
+
+def _remove_parts(outputs: dict) -> None:
+    """Remove the partial outputs of a failed compression."""
+    for dst in outputs.values():
+        if os.path.exists(dst + ".part"):
+            os.remove(dst + ".part")
+
+
+def compress_stream(
+    chunks,
+    outputs: dict,
+    fast: bool = False,
+    threads: int = 0,
+    seekable: bool = False,
+    digests: dict = None,  # type: ignore
+):
+    """
+    Compress a stream of chunks into one or more formats at once.
+
+    Every chunk is handed to one compressor process per format, so the source
+    is only read a single time no matter how many formats are written.
+
+    Parameters
+    ----------
+        chunks (iterable): The uncompressed data.
+        outputs (dict): Mapping of format name to destination path.
+        fast (bool, optional): Use the fast compression level. Defaults to False.
+        threads (int, optional): Threads per compressor, 0 for all cores. Defaults to 0.
+        seekable (bool, optional): Write xz and zstd as independently
+            decompressible blocks of FRAME_SIZE with an index. Defaults to False.
+        digests (dict, optional): Digests of the formats whose output is
+            hashed on its way to the file, see imageforge.digests. Defaults to None.
+
+    Raises
+    ------
+        subprocess.CalledProcessError: If a compressor fails.
+
+    Returns
+    -------
+    Nothing
+    """
+    digests = digests or {}
+    procs = {}
+    feeders = {}
+    tees = []
+    errors = []
+    try:
+        for fmt, dst in outputs.items():
+            argv = compressor_argv(fmt, fast, threads, seekable)
+            logging.info("Compressing to " + dst + " with " + " ".join(argv))
+            pending = queue.Queue(maxsize=8)
+            if seekable and fmt == "zstd":
+                target = _zstd_frames
+                args = (pending, dst + ".part", argv, threads, errors, digests.get(fmt))
+            elif fmt in digests:
+                procs[fmt] = subprocess.Popen(
+                    argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+                )
+                # Hashes the output on its way to the file.
+                tees.append(
+                    threading.Thread(
+                        target=_tee,
+                        args=(procs[fmt].stdout, dst + ".part", digests[fmt], errors),
+                        daemon=True,
+                    )
+                )
+                tees[-1].start()
+                target = _feed
+                args = (procs[fmt], pending, errors)
+            else:
+                with open(dst + ".part", "wb") as out:
+                    procs[fmt] = subprocess.Popen(
+                        argv, stdin=subprocess.PIPE, stdout=out
+                    )
+                target = _feed
+                args = (procs[fmt], pending, errors)
+            thread = threading.Thread(target=target, args=args, daemon=True)
+            thread.start()
+            feeders[fmt] = (thread, pending)
+        for chunk in chunks:
+            for thread, pending in feeders.values():
+                pending.put(chunk)
+    except BaseException:
+        _remove_parts(outputs)
+        raise
+    finally:
+        for thread, pending in feeders.values():
+            pending.put(None)
+            thread.join()
+        for thread in tees:
+            thread.join()
+        for fmt, proc in procs.items():
+            proc.wait()
+    failed = [fmt for fmt, proc in procs.items() if proc.returncode != 0]
+    if failed or errors:
+        _remove_parts(outputs)
+        # A broken pipe only means a compressor died, its exit status tells why.
+        if not failed:
+            raise errors[0]
+        raise subprocess.CalledProcessError(
+            procs[failed[0]].returncode, procs[failed[0]].args
+        )
+    for dst in outputs.values():
+        os.replace(dst + ".part", dst)
+
+
+def compress_file(
+    src: str,
+    dst_base: str,
+    formats: list,
+    fast: bool = False,
+    threads: int = 0,
+    seekable: bool = False,
+) -> list:
+    """
+    Compress a file into every requested format with a single read of it.
+
+    Only the allocated extents of the file are read, holes are fed to the
+    compressors from memory.
+
+    Parameters
+    ----------
+        src (str): The file to compress.
+        dst_base (str): Output path without the compression extension.
+        formats (list): The formats to write, see FORMATS.
+        fast (bool, optional): Use the fast compression level. Defaults to False.
+        threads (int, optional): Threads per compressor, 0 for all cores. Defaults to 0.
+        seekable (bool, optional): Write seekable outputs, see compress_stream. Defaults to False.
+
+    Returns
+    -------
+    list: The paths of the written files.
+    """
+    outputs = {fmt: dst_base + FORMATS[fmt]["ext"] for fmt in formats}
+    compress_stream(read_sparse(src), outputs, fast, threads, seekable)
+    return list(outputs.values())
@@ -1,14 +1,17 @@
-"""Global configuration storage for imageforge"""
+"""Configuration storage for imageforge"""
 
 import os
 import argparse
 import sys
-import subprocess
 import pathlib
 import logging
+import itertools
+from . import pkglist
+from .reproducible import DEFAULT_EPOCH
+from .profiling import Profiler
 
 
-def parse_args():
+def parse_args(argv: list = None):  # type: ignore
     parser = argparse.ArgumentParser(description="Create Images")
     parser.add_argument("-w", "--work_dir", help="Directory to work in", required=True)
     parser.add_argument(
@@ -23,7 +26,7 @@ def parse_args():
     parser.add_argument(
         "-o", "--out_dir", help="Folder to put output files", required=True
     )
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def realpath(path: str) -> str:
@@ -39,31 +42,155 @@ def realpath(path: str) -> str:
     -------
     The real path of the file or directory.
     """
-    return subprocess.check_output(["readlink", "-f", path]).decode("utf-8").split()[0]
+    return os.path.realpath(path)
 
 
-args = parse_args()
-work_dir = realpath(args.work_dir)
-config_dir = realpath(args.config_dir)
-out_dir = realpath(args.out_dir)
 LOGGING_FORMAT: str = "%(asctime)s [%(levelname)s] %(message)s (%(funcName)s)"
 LOGGING_DATE_FORMAT: str = "%H:%M:%S"
 
-logging.basicConfig(
-    format="%(asctime)s %(levelname)s: %(message)s",
-    datefmt=LOGGING_DATE_FORMAT,
-    encoding="utf-8",
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(pathlib.Path(config_dir + "/imageforge.log"), mode="w"),
-    ],
-)
+# Command line of the running build script, parsed on first use.
+_cli = None
+# Build context used by functions called without an explicit one.
+_current = None
+# Numbers the loggers of the build contexts.
+_builds = itertools.count(1)
 
 
-class Config:
-    def __init__(self, params: dict):
+def _parse_cli() -> dict:
+    """
+    Parse the command line and set up logging, once.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    dict: The parsed "args" and the resolved "work_dir", "config_dir" and "out_dir".
+    """
+    global _cli
+    if _cli is None:
+        args = parse_args()
+        _cli = {
+            "args": args,
+            "work_dir": realpath(args.work_dir),
+            "config_dir": realpath(args.config_dir),
+            "out_dir": realpath(args.out_dir),
+        }
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)s: %(message)s",
+            datefmt=LOGGING_DATE_FORMAT,
+            encoding="utf-8",
+            level=logging.INFO,
+            handlers=[
+                logging.StreamHandler(sys.stdout),
+                logging.FileHandler(
+                    pathlib.Path(_cli["config_dir"] + "/imageforge.log"), mode="w"
+                ),
+            ],
+        )
+    return _cli
+
+
+def __getattr__(name: str):
+    # args, work_dir, config_dir and out_dir used to be parsed at import time
+    # and cfg set by Config, keep them reachable for build scripts.
+    if name in ["args", "work_dir", "config_dir", "out_dir"]:
+        return _parse_cli()[name]
+    if name == "cfg":
+        return current()
+    raise AttributeError("module " + __name__ + " has no attribute " + name)
+
+
+def current():  # type: ignore
+    """
+    Get the build context used when none is passed explicitly.
+
+    Parameters
+    ----------
+    None
+
+    Raises
+    ------
+        RuntimeError: If no Config or BuildContext was made current yet.
+
+    Returns
+    -------
+    The current BuildContext.
+    """
+    if _current is None:
+        raise RuntimeError("No build context, create a Config or pass ctx")
+    return _current
+
+
+def set_current(ctx) -> None:
+    """
+    Make a build context the one used when none is passed explicitly.
+
+    Parameters
+    ----------
+        ctx (BuildContext): The build context.
+
+    Returns
+    -------
+    Nothing
+    """
+    global _current
+    _current = ctx
+
+
+def resolve(ctx=None):  # type: ignore
+    """
+    Get the build context a function should work on.
+
+    Parameters
+    ----------
+        ctx (BuildContext, optional): The explicitly passed context. Defaults to None.
+
+    Returns
+    -------
+    ctx if given, the current BuildContext otherwise.
+    """
+    return ctx if ctx is not None else current()
+
+
+class BuildContext:
+    """
+    Configuration and state of a single image build.
+
+    Several contexts can live in one process, every function of common,
+    partitioning and packages takes the context to work on as ctx and falls
+    back to the current one, see set_current.
+    """
+
+    def __init__(
+        self,
+        params: dict,
+        work_dir: str,
+        config_dir: str,
+        out_dir: str,
+        log_file: str = None,  # type: ignore
+    ):
+        """
+        Parameters
+        ----------
+            params (dict): The build parameters.
+            work_dir (str): Directory to work in.
+            config_dir (str): Folder with config files.
+            out_dir (str): Folder to put output files.
+            log_file (str, optional): File receiving this build's log. Defaults to None.
+        """
         self.cfg = {}
+        self.log = logging.getLogger("imageforge.build" + str(next(_builds)))
+        if log_file is not None:
+            handler = logging.FileHandler(log_file, mode="w", encoding="utf-8")
+            handler.setFormatter(
+                logging.Formatter(
+                    "%(asctime)s %(levelname)s: %(message)s", LOGGING_DATE_FORMAT
+                )
+            )
+            self.log.addHandler(handler)
+            self.log.setLevel(logging.INFO)
 
         # Extract parameters from the passed dictionary
         self.cfg["arch"] = params.get("arch", None)
@@ -93,11 +220,15 @@ class Config:
         )
         self.cfg["has_uefi"] = params.get("has_uefi", False)
         self.cfg["base"] = params.get("base", "arch")
+        compression = params.get("compression", ["xz"])
+        self.cfg["compression"] = (
+            [compression] if isinstance(compression, str) else list(compression)
+        )
 
         # Create directories
-        self.cfg["work_dir"] = work_dir
-        self.cfg["config_dir"] = config_dir
-        self.cfg["out_dir"] = out_dir
+        self.cfg["work_dir"] = realpath(work_dir)
+        self.cfg["config_dir"] = realpath(config_dir)
+        self.cfg["out_dir"] = realpath(out_dir)
         self.cfg["mnt_dir"] = os.path.join(self.cfg["work_dir"], "mnt")
         self.cfg["install_dir"] = os.path.join(self.cfg["work_dir"], self.cfg["arch"])
         for directory in [
@@ -121,56 +252,172 @@ class Config:
         self.cfg["components"] = params.get("components", None)
         self.cfg["suite"] = params.get("suite", None)
         self.cfg["mirror"] = params.get("mirror", None)
+        self.cfg["pkg_cache_dir"] = params.get("pkg_cache_dir", None)
+        self.cfg["pkg_cache_size"] = params.get("pkg_cache_size", 20 * 1024 * 1024)
+        self.cfg["snapshot_dir"] = params.get("snapshot_dir", None)
+        self.cfg["snapshot_format"] = params.get("snapshot_format", "tar")
+        # Largest package delta applied to a snapshot, as a share of the packages.
+        self.cfg["snapshot_max_delta"] = params.get("snapshot_max_delta", 0.25)
+        self.cfg["profile"] = params.get("profile", False)
+        self.cfg["incremental_dir"] = params.get("incremental_dir", None)
+        self.cfg["shrink"] = params.get("shrink", False)
+        self.cfg["stream"] = params.get("stream", False)
+        self.cfg["bmap"] = params.get("bmap", True)
+        self.cfg["seekable"] = params.get("seekable", False)
+        self.cfg["format_partitions"] = params.get("format_partitions", False)
+        self.cfg["loop_pool"] = params.get("loop_pool", 0)
+        self.cfg["checksums"] = params.get("checksums", False)
+        self.cfg["signing_key"] = params.get("signing_key", None)
+        self.cfg["reproducible"] = params.get("reproducible", False)
+        epoch = params.get("source_date_epoch", os.environ.get("SOURCE_DATE_EPOCH"))
+        if epoch is None and self.cfg["reproducible"]:
+            epoch = DEFAULT_EPOCH
+        self.cfg["source_date_epoch"] = int(epoch) if epoch is not None else None
+        rootfs_formats = params.get("rootfs_formats", ["tar"])
+        self.cfg["rootfs_formats"] = (
+            [rootfs_formats]
+            if isinstance(rootfs_formats, str)
+            else list(rootfs_formats)
+        )
+        self.profiler = (
+            Profiler(os.path.join(self.cfg["out_dir"], self.cfg["img_name"]))
+            if self.cfg["profile"]
+            else None
+        )
+        # Filesystems the mkfs image backend generates when unmounting.
+        self.filesystems = []
+        # Manifest of the previous image when patching it, see incremental_dir.
+        self.previous = None
+        # blkid tags of the filesystems by partition path, looked up once or
+        # registered when imageforge creates or plans them.
+        self.blkid = {}
+        # Digests of the raw image read by compressimage, reused by copyimage.
+        self.image_digests = None
+        # Manifest of the install dir copied into the image.
+        self.manifest = None
 
         # Validation
         self._validate()
 
         # Read packages
         self._read_packages(packages_file)
-        global cfg
-        cfg = self.cfg
+
+    def __getitem__(self, key: str):
+        return self.cfg[key]
+
+    def __setitem__(self, key: str, value) -> None:
+        self.cfg[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.cfg
+
+    def get(self, key: str, default=None):
+        return self.cfg.get(key, default)
 
     def _validate(self):
         if not self.cfg["img_name"]:
-            logging.error("Image name not set")
+            self.log.error("Image name not set")
             exit(1)
         if not self.cfg["img_version"]:
-            logging.error("Image version not set")
+            self.log.error("Image version not set")
             exit(1)
         if self.cfg["fs"] not in ["ext4", "btrfs"]:
-            logging.error("Filesystem not supported use ext4 or btrfs")
+            self.log.error("Filesystem not supported use ext4 or btrfs")
             exit(1)
         if not os.path.isfile(self.cfg["packages_file"]):
-            logging.error(
+            self.log.error(
                 "Packages file doesn't exist. Create the file packages."
                 + self.cfg["arch"]
             )
             exit(1)
         if self.cfg["img_type"] not in ["image", "rootfs"]:
-            logging.error("Image type not supported. Use image or rootfs")
+            self.log.error("Image type not supported. Use image or rootfs")
             exit(1)
-        if self.cfg["img_backend"] not in ["loop"]:
-            logging.error("Image backend not supported. Use loop")
+        for fmt in self.cfg["compression"]:
+            if fmt not in ["xz", "zstd", "gzip"]:
+                self.log.error("Compression not supported. Use xz, zstd or gzip")
+                exit(1)
+        for fmt in self.cfg["rootfs_formats"]:
+            if fmt not in ["tar", "squashfs", "erofs"]:
+                self.log.error(
+                    "Rootfs format not supported. Use tar, squashfs or erofs"
+                )
+                exit(1)
+        if self.cfg["snapshot_format"] not in ["tar", "squashfs", "btrfs"]:
+            self.log.error("Snapshot format not supported. Use tar, squashfs or btrfs")
+            exit(1)
+        if not 0 <= self.cfg["snapshot_max_delta"] <= 1:
+            self.log.error("Snapshot max delta must be between 0 and 1")
+            exit(1)
+        if self.cfg["img_backend"] not in ["loop", "mkfs"]:
+            self.log.error("Image backend not supported. Use loop or mkfs")
             exit(1)
+        if self.cfg["stream"] and self.cfg["img_backend"] != "mkfs":
+            self.log.error("Streaming images needs the mkfs image backend")
+            exit(1)
+        if self.cfg["reproducible"]:
+            if self.cfg["img_backend"] != "mkfs":
+                self.log.warning(
+                    "Images are only byte for byte reproducible with the mkfs image backend"
+                )
+            if self.cfg["fs"] == "btrfs":
+                self.log.warning("btrfs images are not byte for byte reproducible")
+        if self.cfg["signing_key"] is not None:
+            if not self.cfg["checksums"]:
+                self.log.error("Signing needs checksums, the manifest is signed")
+                exit(1)
+            if not os.path.isfile(self.cfg["signing_key"]):
+                self.log.error("Signing key not found " + self.cfg["signing_key"])
+                exit(1)
         if self.cfg["base"] == "arch":
             if os.path.isfile(
-                os.path.join(config_dir, "/pacman.conf.", self.cfg["arch"])
+                os.path.join(self.cfg["config_dir"], "/pacman.conf.", self.cfg["arch"])
             ):
-                logging.error(
+                self.log.error(
                     "Pacman config file not found "
-                    + os.path.join(config_dir, "/pacman.conf.", self.cfg["arch"])
+                    + os.path.join(
+                        self.cfg["config_dir"], "/pacman.conf.", self.cfg["arch"]
+                    )
                 )
                 exit(1)
         elif self.cfg["base"] == "debian":
             # if os.path.isfile(config_dir + '/sources.list.' + self.cfg["arch"]):
-            #     logging.error("Sources list file not found")
+            #     self.log.error("Sources list file not found")
             #     exit(1)
             pass
 
     def _read_packages(self, packages_file):
-        with open(packages_file, "r") as f:
-            packages = map(lambda package: package.strip(), f.readlines())
-            packages = list(
-                filter(lambda package: not package.startswith("#"), packages)
+        cache_dir = os.path.join(
+            self.cfg["pkg_cache_dir"] or self.cfg["work_dir"], "pkglist"
+        )
+        try:
+            self.cfg["packages"] = pkglist.resolve(
+                packages_file,
+                edition=self.cfg["edition"],
+                base=self.cfg["base"],
+                pacman_conf=self.cfg["pacman_conf"],
+                suite=self.cfg["suite"],
+                components=self.cfg["components"],
+                arch=self.cfg["arch"],
+                install_dir=self.cfg["install_dir"],
+                cache_dir=cache_dir,
+                log=self.log,
             )
-            self.cfg["packages"] = packages
+        except (OSError, ValueError) as e:
+            self.log.error("Invalid package list: " + str(e))
+            exit(1)
+
+
+class Config:
+    """
+    Command line front end: parses the arguments of the build script and
+    makes a BuildContext for them the current one.
+    """
+
+    def __init__(self, params: dict):
+        cli = _parse_cli()
+        self.ctx = BuildContext(
+            params, cli["work_dir"], cli["config_dir"], cli["out_dir"]
+        )
+        self.cfg = self.ctx.cfg
+        set_current(self.ctx)
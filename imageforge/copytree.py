@@ -0,0 +1,286 @@
+"""Parallel rootfs tree copies for imageforge.
+
+The tree is walked once, directories, symlinks and device nodes are created
+by the walk while regular files are copied in batches by a thread pool, so
+the per-file latency of rootfs trees with many small files overlaps.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .export import FICLONE, UNSUPPORTED
+from .sparse import copy_sparse_fd
+
+# Files copied per task of the thread pool.
+BATCH = 64
+
+# Errors of metadata a destination filesystem or user cannot keep.
+_UNKEPT = (errno.EOPNOTSUPP, errno.EPERM, errno.EACCES)
+
+
+def _same(st: os.stat_result, dst_st: os.stat_result) -> bool:
+    """Whether a destination still matches its source, the incremental quick check."""
+    return (
+        dst_st is not None
+        and stat.S_IFMT(st.st_mode) == stat.S_IFMT(dst_st.st_mode)
+        and st.st_size == dst_st.st_size
+        and st.st_mtime_ns == dst_st.st_mtime_ns
+        and st.st_mode == dst_st.st_mode
+        and st.st_uid == dst_st.st_uid
+        and st.st_gid == dst_st.st_gid
+    )
+
+
+def _lstat(path: str):  # type: ignore
+    try:
+        return os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _remove(path: str, st: os.stat_result) -> None:
+    if stat.S_ISDIR(st.st_mode):
+        for entry in os.scandir(path):
+            _remove(entry.path, entry.stat(follow_symlinks=False))
+        os.rmdir(path)
+    else:
+        os.unlink(path)
+
+
+class _TreeCopy:
+    def __init__(self, incremental: bool, exclude: list):
+        self.incremental = incremental
+        self.exclude = set(exclude)
+        self.reflink = True
+        self.lock = threading.Lock()
+        self.stats = {"files": 0, "bytes": 0, "skipped": 0, "links": 0, "other": 0}
+        # First destination of every source inode with several links.
+        self.inodes = {}
+        self.hardlinks = []
+        self.dirs = []
+
+    def count(self, key: str, n: int = 1) -> None:
+        with self.lock:
+            self.stats[key] += n
+
+    def metadata(self, src, dst, st: os.stat_result) -> None:
+        """Copy ownership, mode, xattrs (and so ACLs) and times, by path or fd."""
+        follow = not isinstance(src, str)
+        try:
+            os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=follow)
+            if not stat.S_ISLNK(st.st_mode):
+                # After chown, which clears setuid and setgid bits.
+                os.chmod(dst, stat.S_IMODE(st.st_mode))
+        except OSError as e:
+            # Like cp -a, e.g. when copying into vfat or without root.
+            if e.errno not in _UNKEPT:
+                raise
+            logging.debug("Not keeping owner of " + str(dst) + ": " + str(e))
+        try:
+            names = os.listxattr(src, follow_symlinks=follow)
+        except OSError as e:
+            if e.errno not in _UNKEPT:
+                raise
+            names = []
+        for name in names:
+            try:
+                value = os.getxattr(src, name, follow_symlinks=follow)
+                os.setxattr(dst, name, value, follow_symlinks=follow)
+            except OSError as e:
+                if e.errno not in _UNKEPT + (errno.ENODATA,):
+                    raise
+                logging.debug("Not keeping " + name + " of " + str(dst) + ": " + str(e))
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=follow)
+
+    def copy_file(self, src: str, dst: str, st: os.stat_result, replace) -> None:
+        if replace is not None:
+            _remove(dst, replace)
+        src_fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        try:
+            dst_fd = os.open(
+                dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600
+            )
+            try:
+                if st.st_size:
+                    self.copy_data(src_fd, dst_fd, st)
+                self.metadata(src_fd, dst_fd, st)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        self.count("files")
+        self.count("bytes", st.st_size)
+
+    def copy_data(self, src_fd: int, dst_fd: int, st: os.stat_result) -> None:
+        if self.reflink:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                self.reflink = False
+        # Only files with fewer blocks than their size can have holes.
+        copy_sparse_fd(
+            src_fd, dst_fd, st.st_size, holes=st.st_blocks * 512 < st.st_size
+        )
+
+    def copy_batch(self, batch: list) -> None:
+        for item in batch:
+            self.copy_file(*item)
+
+    def walk(self, src: str, dst: str, rel: str, submit) -> None:
+        """Copy everything below src, handing regular files to submit."""
+        with os.scandir(src) as it:
+            # In name order, so directories are created and the first of
+            # hardlinked paths picked the same way every time.
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            path = os.path.join(dst, entry.name)
+            if (
+                self.copy(entry.path, path, entry.stat(follow_symlinks=False), submit)
+                and rel + entry.name not in self.exclude
+            ):
+                self.walk(entry.path, path, rel + entry.name + "/", submit)
+
+    def copy(self, src: str, dst: str, st: os.stat_result, submit) -> bool:
+        """Copy one entry, regular files through submit. True for directories."""
+        dst_st = _lstat(dst)
+        if self.incremental and _same(st, dst_st) and not stat.S_ISDIR(st.st_mode):
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                self.inodes.setdefault((st.st_dev, st.st_ino), dst)
+            self.count("skipped")
+            return False
+        if stat.S_ISDIR(st.st_mode):
+            if dst_st is not None and not stat.S_ISDIR(dst_st.st_mode):
+                _remove(dst, dst_st)
+                dst_st = None
+            if dst_st is None:
+                os.mkdir(dst, 0o700)
+            self.dirs.append((src, dst, st))
+            return True
+        if stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                first = self.inodes.setdefault((st.st_dev, st.st_ino), dst)
+                if first != dst:
+                    self.hardlinks.append((first, dst, dst_st))
+                    return False
+            submit((src, dst, st, dst_st))
+            return False
+        if dst_st is not None:
+            _remove(dst, dst_st)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+        self.metadata(src, dst, st)
+        self.count("other")
+        return False
+
+    def link(self) -> None:
+        """Recreate hardlinks once the first copy of every inode exists."""
+        for first, path, dst_st in self.hardlinks:
+            if dst_st is not None:
+                if os.path.samestat(dst_st, os.lstat(first)):
+                    continue
+                _remove(path, dst_st)
+            os.link(first, path)
+            self.count("links")
+
+    def finish_dirs(self) -> None:
+        """Set directory metadata deepest first, so no later write touches the times."""
+        for src, dst, st in reversed(self.dirs):
+            self.metadata(src, dst, st)
+
+
+def copy_tree(
+    src: str,
+    dst: str,
+    jobs: int = 0,
+    incremental: bool = False,
+    exclude: list = None,  # type: ignore
+) -> dict:
+    """
+    Copy a directory tree, like cp -a but copying files on a thread pool.
+
+    Regular files are reflinked where the filesystem allows it and copied
+    with copy_file_range otherwise, keeping holes. Hardlinks, symlinks,
+    device nodes, ownership, modes, xattrs (including ACLs and file
+    capabilities) and times are kept.
+
+    Parameters
+    ----------
+        src (str): The directory to copy.
+        dst (str): The destination directory, created if missing.
+        jobs (int, optional): Number of copy threads, 0 for cores + 4 up to 32. Defaults to 0.
+        incremental (bool, optional): Skip entries whose type, size, mtime, mode and owner already match. Defaults to False.
+        exclude (list, optional): Directories, relative to src, whose contents are not copied. Defaults to None.
+
+    Returns
+    -------
+    dict: The number of "files" and "bytes" copied, "skipped" entries,
+    hardlinks made ("links") and "other" entries created.
+    """
+    copier = _TreeCopy(incremental, [path.strip("/") for path in exclude or []])
+    os.makedirs(dst, exist_ok=True)
+    _run(copier, lambda submit: copier.walk(src, dst, "", submit), jobs)
+    copier.metadata(src, dst, os.lstat(src))
+    return copier.stats
+
+
+def copy_entries(src: str, dst: str, paths: list, jobs: int = 0) -> dict:
+    """
+    Copy the given entries of a directory tree, like copy_tree but not recursing.
+
+    Directories are created or get their metadata updated, their contents
+    are only copied when listed. Hardlinks are kept among the listed paths.
+
+    Parameters
+    ----------
+        src (str): The source tree.
+        dst (str): The destination tree.
+        paths (list): Paths relative to src, parents of missing entries included.
+        jobs (int, optional): Number of copy threads, see copy_tree. Defaults to 0.
+
+    Returns
+    -------
+    dict: The statistics of the copy, see copy_tree.
+    """
+    copier = _TreeCopy(False, [])
+
+    def walk(submit) -> None:
+        # Parents sort before their children.
+        for path in sorted(paths):
+            source = os.path.join(src, path)
+            copier.copy(source, os.path.join(dst, path), os.lstat(source), submit)
+
+    _run(copier, walk, jobs)
+    return copier.stats
+
+
+def _run(copier: _TreeCopy, walk, jobs: int) -> None:
+    """Run a walk handing regular files to a thread pool, then finish the copy."""
+    jobs = jobs if jobs > 0 else min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        batch = []
+
+        def submit(item: tuple) -> None:
+            batch.append(item)
+            if len(batch) >= BATCH:
+                futures.append(pool.submit(copier.copy_batch, list(batch)))
+                batch.clear()
+                # Surface errors early and bound the queued batches.
+                while len(futures) > 4 * jobs:
+                    futures.pop(0).result()
+
+        walk(submit)
+        futures.append(pool.submit(copier.copy_batch, list(batch)))
+        for future in futures:
+            future.result()
+    copier.link()
+    copier.finish_dirs()
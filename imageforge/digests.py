@@ -0,0 +1,221 @@
+"""Artifact checksums and signatures for imageforge.
+
+Checksums are off unless the checksums config asks for them. Digests are
+then computed from data already streaming through imageforge where there
+is any: the chunks read for the compressors give the digests of the raw
+image, which copyimage reuses, the output of every compressor is teed
+through its own digests on the way to its file and the block map is hashed
+as it is written. Only an image copied before it was compressed, and the
+squashfs and erofs rootfs images their tools write, are read to be hashed:
+a copy that hashes what it copies cannot use the in-kernel copies, and a
+reflinked or renamed image is read once. Every artifact gets a sha256sum compatible .sha256 sidecar
+and all of them are listed in the JSON manifest of the image, which can be
+signed with a local SSH key (ssh-keygen -Y sign, checked with
+ssh-keygen -Y verify).
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+from .profiling import run
+from .sparse import CHUNK_SIZE, is_hole, read_sparse
+
+ALGORITHMS = ("sha256", "blake2b")
+# Namespace of the signatures, see ssh-keygen -Y sign.
+SIGNATURE_NAMESPACE = "file"
+
+
+class Digests:
+    """The SHA-256 and BLAKE2b digests of a stream, updated as it passes."""
+
+    def __init__(self):
+        self.hashes = {name: hashlib.new(name) for name in ALGORITHMS}
+        self.size = 0
+
+    def update(self, chunk) -> None:
+        """
+        Hash the next chunk of the stream.
+
+        Parameters
+        ----------
+            chunk (bytes-like): The chunk.
+
+        Returns
+        -------
+        Nothing
+        """
+        for digest in self.hashes.values():
+            digest.update(chunk)
+        self.size += len(chunk)
+
+    def track(self, chunks):
+        """
+        Hash chunks while passing them on.
+
+        Parameters
+        ----------
+            chunks (iterable): The stream.
+
+        Returns
+        -------
+        Generator of the same chunks.
+        """
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    def result(self) -> dict:
+        """
+        The size and hex digests of everything hashed so far.
+
+        Returns
+        -------
+        dict: The "size" and the digest of every algorithm by name.
+        """
+        result = {"size": self.size}
+        for name, digest in self.hashes.items():
+            result[name] = digest.hexdigest()
+        return result
+
+
+def tee(src, path: str, digests: Digests) -> None:
+    """
+    Write what a pipe yields into a file, hashing it on the way.
+
+    Parameters
+    ----------
+        src (file): The pipe, e.g. the stdout of a compressor.
+        path (str): The file to write.
+        digests (Digests): Updated with the data.
+
+    Returns
+    -------
+    Nothing
+    """
+    with open(path, "wb") as out:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            digests.update(chunk)
+            out.write(chunk)
+
+
+def copy_hashed(src: str, dst: str, digests: Digests) -> int:
+    """
+    Copy a file keeping its holes, hashing it on the way.
+
+    Parameters
+    ----------
+        src (str): The file to copy.
+        dst (str): The destination file, replaced if it exists.
+        digests (Digests): Updated with the contents of src.
+
+    Returns
+    -------
+    int: The number of bytes read from disk.
+    """
+    stats = {}
+    with open(dst, "wb") as out:
+        for chunk in read_sparse(src, stats):
+            digests.update(chunk)
+            if is_hole(chunk):
+                out.seek(len(chunk), os.SEEK_CUR)
+            else:
+                out.write(chunk)
+        out.truncate(stats["size"])
+    return stats["read"]
+
+
+def hash_file(path: str) -> Digests:
+    """
+    Hash a file no data streamed through, e.g. a reflinked or renamed one.
+
+    Only its data extents are read, holes are hashed from memory.
+
+    Parameters
+    ----------
+        path (str): The file.
+
+    Returns
+    -------
+    Digests: The digests of the file.
+    """
+    digests = Digests()
+    for chunk in read_sparse(path):
+        digests.update(chunk)
+    return digests
+
+
+def write_sidecar(path: str, result: dict) -> str:
+    """
+    Write the sha256sum line of an artifact next to it.
+
+    Parameters
+    ----------
+        path (str): The artifact.
+        result (dict): Its digests, see Digests.result.
+
+    Returns
+    -------
+    str: The path of the .sha256 file.
+    """
+    sidecar = path + ".sha256"
+    with open(sidecar + ".part", "w") as f:
+        f.write(result["sha256"] + "  " + os.path.basename(path) + "\n")
+    os.replace(sidecar + ".part", sidecar)
+    return sidecar
+
+
+def update_manifest(path: str, image: dict = None, artifacts: dict = None) -> None:  # type: ignore
+    """
+    Record digests in the JSON manifest of an image, keeping the ones already in it.
+
+    Parameters
+    ----------
+        path (str): The manifest.
+        image (dict, optional): Digests of the raw image. Defaults to None.
+        artifacts (dict, optional): Digests of every artifact by path. Defaults to None.
+
+    Returns
+    -------
+    Nothing
+    """
+    manifest = {"image": None, "artifacts": {}}
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    if image is not None:
+        manifest["image"] = image
+    for artifact, result in (artifacts or {}).items():
+        manifest["artifacts"][os.path.basename(artifact)] = result
+    with open(path + ".part", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(path + ".part", path)
+
+
+def sign(path: str, key: str) -> str:
+    """
+    Write a detached signature of a file with a local SSH private key.
+
+    Parameters
+    ----------
+        path (str): The file to sign, usually the manifest.
+        key (str): The private key file.
+
+    Raises
+    ------
+        subprocess.CalledProcessError: If ssh-keygen fails.
+
+    Returns
+    -------
+    str: The path of the .sig file.
+    """
+    if os.path.exists(path + ".sig"):
+        # ssh-keygen refuses to overwrite signatures.
+        os.remove(path + ".sig")
+    run(
+        ["ssh-keygen", "-q", "-Y", "sign", "-f", key, "-n", SIGNATURE_NAMESPACE, path],
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return path + ".sig"
@@ -0,0 +1,99 @@
+"""Artifact export for imageforge."""
+
+import errno
+import fcntl
+import logging
+import os
+from .digests import copy_hashed
+from .sparse import copy_sparse, read_sparse
+
+# ioctl request cloning a whole file, _IOW(0x94, 9, int) from linux/fs.h.
+FICLONE = 0x40049409
+
+# Errors meaning a strategy is not usable here, so the next one is tried.
+UNSUPPORTED = (
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EBADF,
+)
+
+
+def _reflink(src: str, dst: str) -> None:
+    """Share the extents of src with dst, no data is copied."""
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _rename(src: str, dst: str) -> None:
+    """Move src to dst, only possible within one filesystem."""
+    os.rename(src, dst)
+
+
+STRATEGIES = [
+    ("reflink", _reflink),
+    ("copy_file_range", lambda src, dst: copy_sparse(src, dst, "copy_file_range")),
+    ("sendfile", lambda src, dst: copy_sparse(src, dst, "sendfile")),
+    ("rename", _rename),
+]
+
+
+def export_file(
+    src: str, dst: str, move: bool = False, mode: int = 0o777, digests=None
+) -> str:
+    """
+    Export a file to its final location with the cheapest strategy available.
+
+    Tries, in order, a reflink, a sparse copy_file_range copy and a sparse
+    sendfile copy. When the source may be consumed a same-filesystem rename
+    is tried first instead, as it moves no data at all. A sparse read/write
+    copy is the last resort.
+
+    With digests, the file is hashed as it is copied, so the in-kernel
+    copies, which never pass the data through imageforge, are skipped. After
+    a reflink or rename, which move no data, the file is read once to hash it.
+
+    Parameters
+    ----------
+        src (str): The file to export.
+        dst (str): The destination path.
+        move (bool, optional): Whether src may be renamed to dst. Defaults to False.
+        mode (int, optional): Permissions set on dst. Defaults to 0o777.
+        digests (Digests, optional): Updated with the contents of the file. Defaults to None.
+
+    Returns
+    -------
+    str: The name of the strategy that was used.
+    """
+    used = "copy"
+    strategies = [s for s in STRATEGIES if s[0] != "rename"]
+    if move:
+        strategies = [s for s in STRATEGIES if s[0] == "rename"] + strategies
+    if digests is not None:
+        strategies = [s for s in strategies if s[0] in ["rename", "reflink"]]
+    for name, strategy in strategies:
+        try:
+            strategy(src, dst)
+            used = name
+            break
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            logging.debug("Export with " + name + " not possible: " + str(e))
+            if name != "rename" and os.path.exists(dst):
+                os.remove(dst)
+    else:
+        if digests is not None:
+            copy_hashed(src, dst, digests)
+            digests = None
+        else:
+            copy_sparse(src, dst, "read")
+    if digests is not None:
+        # No data moved, so none was hashed either.
+        for chunk in read_sparse(dst):
+            digests.update(chunk)
+    os.chmod(dst, mode)
+    logging.debug("Exported " + dst + " using " + used)
+    return used
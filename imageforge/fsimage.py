@@ -0,0 +1,376 @@
+"""Filesystem image generation for the mkfs image backend of imageforge.
+
+Instead of mounting the partitions of a loop device and copying the rootfs
+into them, the mkfs backend leaves the image a plain file: partition writes
+its table, every filesystem is generated from the rootfs tree by its mkfs
+tool (mke2fs -d, mkfs.btrfs --rootdir, mkfs.vfat and mcopy) and written into
+the image at the offset of its partition when the build unmounts. Nothing
+is mounted, so the boot partition is populated from the /boot (or /boot/efi
+with UEFI) directory of the tree instead of being formatted and mounted by
+the build script.
+
+In stream mode the filesystem images are not written into the image at all:
+read_disk serialises the partition table and every filesystem image in disk
+order, so the compressors read the disk without it ever existing in full.
+"""
+
+import functools
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from .profiling import run
+from .ptable import SECTOR_SIZE, read_table
+from .reproducible import environment, pin_ext4_times, stable_uuid
+from .runner import run_graph
+from .sparse import read_sparse, splice_sparse
+
+# Subvolumes of a btrfs root and the directory of the tree each one holds,
+# the same layout partition creates on a mounted filesystem.
+BTRFS_SUBVOLUMES = {
+    "@": "",
+    "@home": "home",
+    "@log": None,
+    "@pkg": None,
+    "@.snapshots": None,
+}
+
+
+def read_partitions(image: str) -> dict:
+    """
+    Read the partition table of an image file.
+
+    Parameters
+    ----------
+        image (str): The image file.
+
+    Returns
+    -------
+    dict: The (offset, size) in bytes of every partition number.
+    """
+    table = read_table(image)
+    if table is None:
+        return {}
+    return {
+        part["number"]: (
+            part["start"] * SECTOR_SIZE,
+            (part["end"] - part["start"] + 1) * SECTOR_SIZE,
+        )
+        for part in table["partitions"]
+    }
+
+
+def new_uuid(fs: str, seed: str = None) -> str:  # type: ignore
+    """
+    Generate the UUID of a new filesystem, as blkid reports it.
+
+    Parameters
+    ----------
+        fs (str): The filesystem, "ext4", "btrfs" or "vfat".
+        seed (str, optional): Derive the UUID from this seed instead of
+            picking a random one, see reproducible.stable_uuid. Defaults to None.
+
+    Returns
+    -------
+    str: The UUID, a volume id like ABCD-1234 for vfat.
+    """
+    value = stable_uuid(seed) if seed is not None else uuid.uuid4()
+    if fs == "vfat":
+        volume_id = value.hex[:8].upper()
+        return volume_id[:4] + "-" + volume_id[4:]
+    return str(value)
+
+
+def plan(
+    disk: str,
+    number: int,
+    fs: str,
+    label: str,
+    source: str,
+    partitions: dict,
+    seed: str = None,  # type: ignore
+    epoch: int = None,  # type: ignore
+) -> dict:
+    """
+    Plan a filesystem for a partition of an image file.
+
+    Parameters
+    ----------
+        disk (str): The image file.
+        number (int): The partition number.
+        fs (str): The filesystem, "ext4", "btrfs" or "vfat".
+        label (str): The filesystem label.
+        source (str): Directory of the tree the filesystem holds, relative to it.
+        partitions (dict): The partitions of the image, see read_partitions.
+        seed (str, optional): Build seed to derive the UUID and hash seed of
+            the filesystem from, for reproducible builds. Defaults to None.
+        epoch (int, optional): Timestamp the filesystem is generated at, for
+            reproducible builds. Defaults to None.
+
+    Returns
+    -------
+    dict: The planned filesystem, built by build_all.
+    """
+    offset, size = partitions[number]
+    if seed is not None:
+        seed += "/fs" + str(number)
+    return {
+        "disk": disk,
+        "number": number,
+        "offset": offset,
+        "size": size,
+        "fs": fs,
+        "label": label,
+        "uuid": new_uuid(fs, seed),
+        "hash_seed": new_uuid("ext4", seed + "/hash_seed") if seed else None,
+        "epoch": epoch,
+        "source": source,
+    }
+
+
+@contextmanager
+def _moved(moves: list):
+    """
+    Rename directories for the duration of the block.
+
+    Parameters
+    ----------
+        moves (list): (src, dst, keep) renames done in order, keep leaves an
+            empty directory with the attributes of src behind.
+
+    Returns
+    -------
+    Nothing
+    """
+    done = []
+    try:
+        for src, dst, keep in moves:
+            os.rename(src, dst)
+            done.append((src, dst, keep))
+            if keep:
+                os.mkdir(src)
+                shutil.copystat(dst, src)
+                st = os.stat(dst)
+                os.chown(src, st.st_uid, st.st_gid)
+        yield
+    finally:
+        for src, dst, keep in reversed(done):
+            if keep:
+                os.rmdir(src)
+            os.rename(dst, src)
+
+
+def make_fs(fs: dict, tree: str, image: str) -> None:
+    """
+    Generate a filesystem image from a directory tree.
+
+    Parameters
+    ----------
+        fs (dict): The planned filesystem, see plan.
+        tree (str): The directory holding its contents.
+        image (str): The filesystem image to create.
+
+    Returns
+    -------
+    Nothing
+    """
+    with open(image, "wb") as f:
+        f.truncate(fs["size"])
+    epoch = fs.get("epoch")
+    env = environment(epoch) if epoch is not None else None
+    if fs["fs"] == "ext4":
+        cmd = ["mke2fs", "-q", "-F", "-t", "ext4", "-L", fs["label"], "-U", fs["uuid"]]
+        if fs.get("hash_seed"):
+            cmd += ["-E", "hash_seed=" + fs["hash_seed"]]
+        run(cmd + ["-d", tree, image], env=env, check=True)
+        if epoch is not None:
+            pin_ext4_times(image, tree, epoch)
+    elif fs["fs"] == "btrfs":
+        cmd = ["mkfs.btrfs", "-f", "-L", fs["label"], "-U", fs["uuid"]]
+        cmd += ["--rootdir", tree]
+        for subvolume in BTRFS_SUBVOLUMES:
+            cmd += ["--subvol", subvolume]
+        run(cmd + [image], env=env, check=True)
+    elif fs["fs"] == "vfat":
+        cmd = ["mkfs.vfat", "-F", "32", "-n", fs["label"]]
+        if epoch is not None:
+            # Fixed boot sector contents, before -i so the volume id is kept.
+            cmd.append("--invariant")
+        run(cmd + ["-i", fs["uuid"].replace("-", ""), image], env=env, check=True)
+        if epoch is not None:
+            _copy_fat_sorted(tree, image, env)
+            return
+        entries = sorted(os.listdir(tree))
+        if entries:
+            run(
+                ["mcopy", "-s", "-p", "-m", "-i", image]
+                + [os.path.join(tree, entry) for entry in entries]
+                + ["::/"],
+                check=True,
+            )
+    else:
+        raise ValueError("Cannot generate a " + fs["fs"] + " filesystem")
+
+
+def build_all(filesystems: list, tree: str, work_dir: str, splice: bool = True) -> None:
+    """
+    Generate planned filesystems from a tree and write them into their images.
+
+    Filesystems with a source directory are generated from that directory
+    and it is left empty in the others, like a mount point. The filesystems
+    are generated concurrently and the tree is restored before returning.
+
+    Parameters
+    ----------
+        filesystems (list): The planned filesystems, see plan.
+        tree (str): The rootfs tree.
+        work_dir (str): Directory for the filesystem images and staging.
+        splice (bool, optional): Write the filesystems into their image files.
+            If False every filesystem keeps its own image file, its "image",
+            for read_disk or assemble. Defaults to True.
+
+    Returns
+    -------
+    Nothing
+    """
+    staging = os.path.join(work_dir, "fsimage")
+    os.makedirs(staging, exist_ok=True)
+    # Detach the trees of nested filesystems, deepest first.
+    detached = {}
+    moves = []
+    for i, fs in sorted(
+        enumerate(filesystems), key=lambda item: -len(item[1]["source"])
+    ):
+        if fs["source"] and os.path.isdir(os.path.join(tree, fs["source"])):
+            detached[i] = os.path.join(staging, "part" + str(i))
+            moves.append((os.path.join(tree, fs["source"]), detached[i], True))
+    empty = os.path.join(staging, "empty")
+    os.makedirs(empty, exist_ok=True)
+    _pin_times([empty], filesystems)
+
+    def build(i: int, fs: dict) -> None:
+        # Without a source directory, generate it from an empty one.
+        source = detached.get(i, tree if not fs["source"] else empty)
+        image = os.path.join(staging, "part" + str(i) + ".img")
+        if fs["fs"] == "btrfs":
+            _make_btrfs(fs, source, image, staging)
+        else:
+            make_fs(fs, source, image)
+        fs["image"] = image
+        if splice:
+            assemble([fs])
+
+    with _moved(moves):
+        # The trees of the filesystems are disjoint, generate them concurrently.
+        run_graph(
+            {
+                str(i): (functools.partial(build, i, fs), [])
+                for i, fs in enumerate(filesystems)
+            }
+        )
+    if splice:
+        shutil.rmtree(staging)
+    else:
+        os.rmdir(empty)
+
+
+def assemble(filesystems: list) -> None:
+    """
+    Write filesystem images kept by build_all into their image files and remove them.
+
+    Parameters
+    ----------
+        filesystems (list): The planned filesystems, see plan.
+
+    Returns
+    -------
+    Nothing
+    """
+    for fs in filesystems:
+        if "image" in fs:
+            splice_sparse(fs["image"], fs["disk"], fs["offset"])
+            os.remove(fs.pop("image"))
+
+
+def read_disk(disk: str, filesystems: list, stats: dict = None):  # type: ignore
+    """
+    Read an image file as if the filesystem images kept by build_all were in it.
+
+    Parameters
+    ----------
+        disk (str): The image file, holding the partition table.
+        filesystems (list): The planned filesystems of the image, see plan.
+        stats (dict, optional): Updated with the "size" of the image and the
+            number of bytes actually "read", see read_sparse.
+
+    Returns
+    -------
+    Generator of bytes-like objects covering the whole image.
+    """
+    stats = {} if stats is None else stats
+    size = os.path.getsize(disk)
+    offset = 0
+    for fs in sorted(filesystems, key=lambda fs: fs["offset"]):
+        if "image" not in fs:
+            continue
+        yield from read_sparse(disk, stats, offset, fs["offset"])
+        part = {}
+        yield from read_sparse(fs["image"], part, 0, fs["size"])
+        if part["size"] < fs["size"]:
+            raise ValueError(fs["image"] + " is smaller than its partition")
+        stats["read"] += part["read"]
+        offset = fs["offset"] + fs["size"]
+    yield from read_sparse(disk, stats, offset, size)
+    stats["size"] = size
+
+
+def _pin_times(paths: list, filesystems: list) -> None:
+    """Give directories made while staging the epoch of reproducible filesystems as times."""
+    epochs = [fs["epoch"] for fs in filesystems if fs.get("epoch") is not None]
+    for path in paths if epochs else []:
+        os.utime(path, (epochs[0], epochs[0]))
+
+
+def _copy_fat_sorted(tree: str, image: str, env: dict) -> None:
+    """Copy a tree into a FAT image in name order, so its directory entries are too."""
+    for path, dirs, files in os.walk(tree):
+        dirs.sort()
+        rel = os.path.relpath(path, tree)
+        target = "::/" if rel == "." else "::/" + rel + "/"
+        if dirs:
+            run(
+                ["mmd", "-i", image] + [target + name for name in dirs],
+                env=env,
+                check=True,
+            )
+        if files:
+            run(
+                ["mcopy", "-p", "-m", "-i", image]
+                + [os.path.join(path, name) for name in sorted(files)]
+                + [target],
+                env=env,
+                check=True,
+            )
+
+
+def _make_btrfs(fs: dict, tree: str, image: str, staging: str) -> None:
+    """Generate a btrfs root, moving the tree into the layout of its subvolumes."""
+    root = os.path.join(staging, "btrfs")
+    os.mkdir(root)
+    moves = [(tree, os.path.join(root, "@"), False)]
+    empty = []
+    for subvolume, source in BTRFS_SUBVOLUMES.items():
+        if source == "":
+            continue
+        if source is not None and os.path.isdir(os.path.join(tree, source)):
+            moves.append(
+                (os.path.join(root, "@", source), os.path.join(root, subvolume), True)
+            )
+        else:
+            empty.append(os.path.join(root, subvolume))
+            os.mkdir(empty[-1])
+    _pin_times(empty + [root], [fs])
+    with _moved(moves):
+        make_fs(fs, root, image)
+    for path in empty + [root]:
+        os.rmdir(path)
@@ -0,0 +1,87 @@
+"""Cross-process locks shared by concurrent imageforge builds."""
+
+import fcntl
+import itertools
+import os
+from contextlib import contextmanager
+
+# Directory holding the lock files, shared by every build on the host.
+LOCK_DIR = os.environ.get("IMAGEFORGE_LOCK_DIR", "/run/lock/imageforge")
+# Number of io_slot calls made by this process, so its stages rotate slots.
+_io_calls = itertools.count()
+
+
+@contextmanager
+def file_lock(name: str):
+    """
+    Hold an exclusive lock shared with every build on the host.
+
+    Parameters
+    ----------
+        name (str): The name of the lock.
+
+    Returns
+    -------
+    Nothing
+    """
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, name + ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def loop_lock():
+    """Serialise loop device allocation between builds."""
+    return file_lock("loop")
+
+
+@contextmanager
+def io_slot():
+    """
+    Hold one of the IMAGEFORGE_IO_SLOTS slots for an I/O heavy stage.
+
+    Every slot is tried once, starting from one picked round-robin from the
+    pid and the number of stages the process already ran. When all of them
+    are taken, the stage waits for that first one with a blocking lock
+    rather than polling. Without IMAGEFORGE_IO_SLOTS set, stages are not
+    limited.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    Nothing
+    """
+    slots = int(os.environ.get("IMAGEFORGE_IO_SLOTS", "0"))
+    if slots <= 0:
+        yield
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    first = (os.getpid() + next(_io_calls)) % slots
+    locks = [
+        open(os.path.join(LOCK_DIR, "io-" + str((first + i) % slots) + ".lock"), "w")
+        for i in range(slots)
+    ]
+    held = None
+    try:
+        for lock in locks:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                held = lock
+                break
+            except BlockingIOError:
+                pass
+        if held is None:
+            fcntl.flock(locks[0], fcntl.LOCK_EX)
+            held = locks[0]
+        yield
+    finally:
+        if held is not None:
+            fcntl.flock(held, fcntl.LOCK_UN)
+        for lock in locks:
+            lock.close()
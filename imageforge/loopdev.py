@@ -0,0 +1,511 @@
+"""Loop device management for imageforge builds.
+
+Devices are allocated and configured atomically: LOOP_CTL_GET_FREE picks a
+free device and LOOP_CONFIGURE attaches the image with its offset, size
+limit and partition scanning in a single ioctl, retried when another
+process takes the device in between. Kernels without LOOP_CONFIGURE fall
+back to losetup --find --show under the host wide loop lock.
+
+Every attached device is recorded in a registry, in this process and as a
+file under REGISTRY_DIR naming the pid and owner of the build, so devices
+are detached at exit or on SIGTERM/SIGHUP, and devices left behind by
+builds that died anyway are reclaimed by the sweeper:
+
+    python3 -m imageforge.loopdev sweep [--deleted]
+    python3 -m imageforge.loopdev list
+"""
+
+import argparse
+import atexit
+import errno
+import fcntl
+import glob
+import json
+import logging
+import os
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from .locks import LOCK_DIR, loop_lock
+from .profiling import run
+
+# Registry of attached devices, shared by every build on the host.
+REGISTRY_DIR = os.path.join(LOCK_DIR, "loops")
+LOOP_CONTROL = "/dev/loop-control"
+
+LOOP_CTL_ADD = 0x4C80
+LOOP_CTL_GET_FREE = 0x4C82
+LOOP_CLR_FD = 0x4C01
+LOOP_CONFIGURE = 0x4C0A
+LO_FLAGS_PARTSCAN = 8
+LO_NAME_SIZE = 64
+# struct loop_config: fd, block_size, struct loop_info64 and reserved words.
+_LOOP_CONFIG = struct.Struct("=II QQQQQ IIII 64s64s32s QQ 8Q")
+
+# Attempts at configuring a free device taken by someone else meanwhile.
+_RETRIES = 16
+
+_lock = threading.Lock()
+# Devices attached by this process: the owner of every device.
+_attached = {}
+_handlers_installed = False
+
+
+def _ensure_control() -> None:
+    """Load the loop module if the loop control device does not exist yet."""
+    if not os.path.exists(LOOP_CONTROL):
+        run(["modprobe", "loop"])
+
+
+def _control(request: int, arg: int = 0) -> int:
+    fd = os.open(LOOP_CONTROL, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        return fcntl.ioctl(fd, request, arg)
+    finally:
+        os.close(fd)
+
+
+def _open_device(number: int) -> int:
+    """Open a loop device, waiting briefly for a device node just added."""
+    path = "/dev/loop" + str(number)
+    for _ in range(50):
+        try:
+            return os.open(path, os.O_RDWR | os.O_CLOEXEC)
+        except FileNotFoundError:
+            time.sleep(0.01)
+    return os.open(path, os.O_RDWR | os.O_CLOEXEC)
+
+
+def _configure(number: int, image: str, offset: int, sizelimit: int, partscan: bool):
+    """
+    Attach an image to a loop device with LOOP_CONFIGURE.
+
+    Raises
+    ------
+        OSError: EBUSY if the device is taken, ENOTTY or EINVAL without LOOP_CONFIGURE.
+    """
+    backing = os.open(image, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        name = os.fsencode(os.path.abspath(image))[: LO_NAME_SIZE - 1]
+        config = _LOOP_CONFIG.pack(
+            backing,
+            0,
+            # lo_device, lo_inode, lo_rdevice, lo_offset, lo_sizelimit
+            0,
+            0,
+            0,
+            offset,
+            sizelimit,
+            # lo_number, lo_encrypt_type, lo_encrypt_key_size, lo_flags
+            0,
+            0,
+            0,
+            LO_FLAGS_PARTSCAN if partscan else 0,
+            name,
+            b"",
+            b"",
+            # lo_init
+            0,
+            0,
+            *([0] * 8),
+        )
+        fd = _open_device(number)
+        try:
+            fcntl.ioctl(fd, LOOP_CONFIGURE, config)
+        finally:
+            os.close(fd)
+    finally:
+        os.close(backing)
+
+
+def _losetup(image: str, ldev: str, offset: int, sizelimit: int, partscan: bool):
+    """Attach an image with losetup, on kernels without LOOP_CONFIGURE."""
+    args = ["--partscan"] if partscan else []
+    if offset:
+        args += ["--offset", str(offset)]
+    if sizelimit:
+        args += ["--sizelimit", str(sizelimit)]
+    with loop_lock():
+        if ldev is not None:
+            if run(["losetup"] + args + [ldev, image]).returncode == 0:
+                return ldev
+            logging.warning("Loop device " + ldev + " is taken, using another one")
+        return (
+            run(
+                ["losetup", "--find", "--show"] + args + [image],
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            .stdout.decode("utf-8")
+            .strip("\n")
+        )
+
+
+def _number(ldev: str) -> int:
+    return int(os.path.basename(ldev)[len("loop") :])
+
+
+def find_free() -> str:
+    """
+    Returns a free loop device, adding one if all are taken.
+
+    The device is not reserved, attach picks and configures one atomically.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+        str: The free loop device.
+    """
+    _ensure_control()
+    return "/dev/loop" + str(_control(LOOP_CTL_GET_FREE))
+
+
+def attach(
+    image: str,
+    ldev: str = None,  # type: ignore
+    offset: int = 0,
+    sizelimit: int = 0,
+    partscan: bool = True,
+    owner: str = None,  # type: ignore
+) -> str:
+    """
+    Attaches an image file to a loop device and records it in the registry.
+
+    Parameters
+    ----------
+        image (str): The image file to attach.
+        ldev (str, optional): The loop device to use, a free one is picked if it is taken. Defaults to None.
+        offset (int, optional): Offset of the data in the image, in bytes. Defaults to 0.
+        sizelimit (int, optional): Size of the data in bytes, 0 for up to the end of the image. Defaults to 0.
+        partscan (bool, optional): Create devices for the partitions of the image. Defaults to True.
+        owner (str, optional): The build owning the device, for detach_all and the sweeper. Defaults to None.
+
+    Returns
+    -------
+        str: The loop device the image is attached to.
+    """
+    _ensure_control()
+    _install_handlers()
+    attached = None
+    try:
+        for attempt in range(_RETRIES):
+            if ldev is not None and attempt == 0:
+                number = _number(ldev)
+            else:
+                number = _control(LOOP_CTL_GET_FREE)
+            try:
+                _configure(number, image, offset, sizelimit, partscan)
+                attached = "/dev/loop" + str(number)
+                break
+            except OSError as e:
+                if e.errno != errno.EBUSY:
+                    raise
+                if ldev is not None and attempt == 0:
+                    logging.warning(
+                        "Loop device " + ldev + " is taken, using another one"
+                    )
+        else:
+            raise OSError(errno.EBUSY, "No free loop device for " + image)
+    except OSError as e:
+        if e.errno not in (errno.ENOTTY, errno.EINVAL):
+            raise
+        attached = _losetup(image, ldev, offset, sizelimit, partscan)
+    _register(attached, image, owner)
+    return attached
+
+
+def detach(ldev: str, force: bool = False) -> None:
+    """
+    Detaches a loop device and removes it from the registry.
+
+    Failures are logged, not raised, so teardown carries on.
+
+    Parameters
+    ----------
+        ldev (str): The loop device.
+        force (bool, optional): Unmount whatever is still mounted from the device or its partitions first. Defaults to False.
+
+    Returns
+    -------
+    Nothing
+    """
+    if force:
+        for mountpoint in _mounts(ldev):
+            ret = run(["umount", mountpoint])
+            if ret.returncode != 0:
+                run(["umount", "-l", mountpoint])
+    try:
+        fd = os.open(ldev, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            # A device still in use is cleared once its last user closes it.
+            fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        if e.errno != errno.ENXIO:
+            logging.warning("Could not detach loop device " + ldev + ": " + str(e))
+    _unregister(ldev)
+
+
+def detach_all(owner: str = None) -> list:  # type: ignore
+    """
+    Detaches the loop devices attached by this process, unmounting them first.
+
+    Parameters
+    ----------
+        owner (str, optional): Only detach the devices of this build. Defaults to None.
+
+    Returns
+    -------
+    list: The detached loop devices.
+    """
+    with _lock:
+        devices = [
+            ldev
+            for ldev, dev_owner in _attached.items()
+            if owner is None or dev_owner == owner
+        ]
+    for ldev in sorted(devices, reverse=True):
+        logging.warning("Releasing loop device " + ldev)
+        detach(ldev, force=True)
+    return devices
+
+
+@contextmanager
+def loop_device(image: str, **kwargs):
+    """
+    Attach an image for the duration of a with block.
+
+    Parameters
+    ----------
+        image (str): The image file to attach.
+        **kwargs: Passed on to attach, e.g. offset, sizelimit or partscan.
+
+    Returns
+    -------
+    The loop device, detached when the block exits.
+    """
+    ldev = attach(image, **kwargs)
+    try:
+        yield ldev
+    finally:
+        detach(ldev, force=True)
+
+
+def warm(count: int) -> None:
+    """
+    Make sure count loop devices are free, so the next builds skip adding them.
+
+    Parameters
+    ----------
+        count (int): Free loop devices to keep.
+
+    Returns
+    -------
+    Nothing
+    """
+    _ensure_control()
+    free = [ldev for ldev, backing in _devices().items() if backing is None]
+    number = 0
+    while len(free) < count:
+        try:
+            _control(LOOP_CTL_ADD, number)
+            free.append("/dev/loop" + str(number))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                logging.warning("Could not add loop devices: " + str(e))
+                return
+        number += 1
+
+
+def _register(ldev: str, image: str, owner: str) -> None:
+    with _lock:
+        _attached[ldev] = owner
+    entry = {
+        "pid": os.getpid(),
+        "owner": owner,
+        "image": os.path.abspath(image),
+        "time": int(time.time()),
+    }
+    try:
+        os.makedirs(REGISTRY_DIR, exist_ok=True)
+        path = os.path.join(REGISTRY_DIR, os.path.basename(ldev))
+        with open(path + ".part", "w") as f:
+            json.dump(entry, f)
+        os.replace(path + ".part", path)
+    except OSError as e:
+        logging.warning("Could not record loop device " + ldev + ": " + str(e))
+
+
+def _unregister(ldev: str) -> None:
+    with _lock:
+        _attached.pop(ldev, None)
+    try:
+        os.remove(os.path.join(REGISTRY_DIR, os.path.basename(ldev)))
+    except FileNotFoundError:
+        pass
+
+
+def _registry() -> dict:
+    """The registry entry of every recorded loop device."""
+    entries = {}
+    for path in glob.glob(os.path.join(REGISTRY_DIR, "loop*")):
+        if path.endswith(".part"):
+            continue
+        try:
+            with open(path) as f:
+                entries["/dev/" + os.path.basename(path)] = json.load(f)
+        except (OSError, ValueError):
+            entries["/dev/" + os.path.basename(path)] = {}
+    return entries
+
+
+def _devices() -> dict:
+    """The backing file of every loop device, None for the free ones."""
+    devices = {}
+    for path in glob.glob("/sys/block/loop*"):
+        try:
+            with open(os.path.join(path, "loop", "backing_file")) as f:
+                backing = f.read().rstrip("\n")
+        except OSError:
+            backing = None
+        devices["/dev/" + os.path.basename(path)] = backing
+    return devices
+
+
+def _mounts(ldev: str) -> list:
+    """Mountpoints of a loop device and its partitions, deepest first."""
+    mountpoints = []
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            source, mountpoint = line.split()[:2]
+            if source == ldev or source.startswith(ldev + "p"):
+                # Spaces and other characters are octal escaped.
+                mountpoints.append(
+                    mountpoint.encode("latin-1").decode("unicode_escape")
+                )
+    return sorted(mountpoints, key=len, reverse=True)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sweep(deleted: bool = False) -> list:
+    """
+    Reclaim loop devices left behind by builds that are gone.
+
+    A device is stale when the build that recorded it is no longer running,
+    or with deleted, when its backing file was deleted, whoever attached it.
+
+    Parameters
+    ----------
+        deleted (bool, optional): Also reclaim devices whose backing file was deleted. Defaults to False.
+
+    Returns
+    -------
+    list: The reclaimed loop devices.
+    """
+    devices = _devices()
+    stale = []
+    for ldev, entry in _registry().items():
+        if entry.get("pid") is not None and _alive(entry["pid"]):
+            continue
+        if devices.get(ldev) is None:
+            # Already detached, only the record is left.
+            _unregister(ldev)
+            continue
+        stale.append(ldev)
+    if deleted:
+        stale += [
+            ldev
+            for ldev, backing in devices.items()
+            if backing is not None
+            and backing.endswith(" (deleted)")
+            and ldev not in stale
+        ]
+    for ldev in sorted(stale):
+        logging.info("Reclaiming loop device " + ldev)
+        detach(ldev, force=True)
+    return stale
+
+
+def _install_handlers() -> None:
+    """Detach the devices of this process at exit and on SIGTERM or SIGHUP."""
+    global _handlers_installed
+    with _lock:
+        if _handlers_installed:
+            return
+        _handlers_installed = True
+    atexit.register(detach_all)
+    # Signal handlers can only be set from the main thread.
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        previous = signal.getsignal(signum)
+        if previous not in (signal.SIG_DFL, None):
+            continue
+
+        def handler(signum, frame):
+            detach_all()
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+        signal.signal(signum, handler)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Manage imageforge loop devices")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the recorded loop devices")
+    sweeper = commands.add_parser("sweep", help="Reclaim stale loop devices")
+    sweeper.add_argument(
+        "--deleted",
+        help="Also reclaim devices whose backing file was deleted",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S",
+        level=logging.INFO,
+    )
+    if args.command == "list":
+        devices = _devices()
+        for ldev, entry in sorted(_registry().items()):
+            state = "attached" if devices.get(ldev) is not None else "detached"
+            if entry.get("pid") is not None and not _alive(entry["pid"]):
+                state += ", stale"
+            print(
+                ldev
+                + " "
+                + str(entry.get("image"))
+                + " pid "
+                + str(entry.get("pid"))
+                + " owner "
+                + str(entry.get("owner"))
+                + " ("
+                + state
+                + ")"
+            )
+        return
+    stale = sweep(args.deleted)
+    logging.info("Reclaimed " + str(len(stale)) + " loop devices")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
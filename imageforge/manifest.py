@@ -0,0 +1,228 @@
+"""Rootfs manifests for incremental imageforge builds.
+
+A manifest maps every path of a tree to its type, mode, owner, mtime and
+content: a sha256 for files, the target for symlinks and the device number
+for device nodes. Diffing the manifest of the tree in a previous image
+against the one of the new install dir gives the changes to patch into a
+copy of that image.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from .copytree import copy_entries
+
+VERSION = 1
+# Directories whose contents are not part of a rootfs.
+EXCLUDE = ["proc"]
+# Top level entries created by mkfs, never part of the install dir.
+IGNORE = ["lost+found"]
+
+
+def _hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+def scan(
+    root: str, previous: dict = None, jobs: int = 0, rehash: bool = False  # type: ignore
+) -> dict:
+    """
+    Build the manifest of a tree.
+
+    Files whose size and mtime match their entry in previous keep its hash
+    instead of being read again, unless rehash is set.
+
+    Parameters
+    ----------
+        root (str): The tree.
+        previous (dict, optional): An earlier manifest of the same or a copied tree. Defaults to None.
+        jobs (int, optional): Number of hashing threads, 0 for one per core. Defaults to 0.
+        rehash (bool, optional): Hash every file, for trees whose mtimes say
+            nothing about their contents, like the clamped ones of reproducible
+            builds. Defaults to False.
+
+    Returns
+    -------
+    dict: The entry of every path relative to root.
+    """
+    previous = previous or {}
+    entries = {}
+    to_hash = []
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                rel = rel_dir + entry.name
+                if rel in IGNORE:
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                item = {
+                    "mode": st.st_mode,
+                    "uid": st.st_uid,
+                    "gid": st.st_gid,
+                    "mtime": st.st_mtime_ns,
+                }
+                if stat.S_ISREG(st.st_mode):
+                    item["size"] = st.st_size
+                    old = previous.get(rel, {})
+                    if (
+                        not rehash
+                        and old.get("size") == st.st_size
+                        and old["mtime"] == st.st_mtime_ns
+                    ):
+                        item["hash"] = old["hash"]
+                    else:
+                        to_hash.append(rel)
+                elif stat.S_ISLNK(st.st_mode):
+                    item["target"] = os.readlink(entry.path)
+                elif stat.S_ISDIR(st.st_mode):
+                    if rel not in EXCLUDE:
+                        stack.append(rel + "/")
+                else:
+                    item["rdev"] = st.st_rdev
+                entries[rel] = item
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        digests = pool.map(lambda rel: _hash(os.path.join(root, rel)), to_hash)
+        for rel, digest in zip(to_hash, digests):
+            entries[rel]["hash"] = digest
+    return entries
+
+
+def diff(old: dict, new: dict) -> tuple:
+    """
+    Compare two manifests.
+
+    Parameters
+    ----------
+        old (dict): The manifest of the tree to patch.
+        new (dict): The manifest of the wanted tree.
+
+    Returns
+    -------
+    tuple: The paths that are new or changed and the paths that are gone.
+    """
+    changed = [path for path, item in new.items() if old.get(path) != item]
+    removed = [path for path in old if path not in new]
+    return changed, removed
+
+
+def _present(item: dict, st: os.stat_result) -> bool:  # type: ignore
+    """Whether a patched tree still holds an entry, whatever its filesystem keeps of the metadata."""
+    return (
+        st is not None
+        and stat.S_IFMT(st.st_mode) == stat.S_IFMT(item["mode"])
+        and (not stat.S_ISREG(st.st_mode) or st.st_size == item["size"])
+    )
+
+
+def apply(src: str, dst: str, old: dict, new: dict, jobs: int = 0) -> dict:
+    """
+    Patch a tree described by a manifest into the one described by another.
+
+    Entries unchanged between the manifests are only checked to still be
+    present in dst, so a filesystem formatted anew is filled again.
+
+    Parameters
+    ----------
+        src (str): The wanted tree, described by new.
+        dst (str): The tree to patch, described by old.
+        old (dict): The manifest of dst.
+        new (dict): The manifest of src.
+        jobs (int, optional): Number of copy threads, see copy_tree. Defaults to 0.
+
+    Returns
+    -------
+    dict: The number of "changed" and "removed" paths and the statistics of the copy.
+    """
+    changed, removed = diff(old, new)
+    known = set(changed)
+    for path, item in new.items():
+        if path not in known:
+            try:
+                st = os.lstat(os.path.join(dst, path))
+            except FileNotFoundError:
+                st = None
+            if not _present(item, st):
+                changed.append(path)
+    # Children sort after their parents, remove them first.
+    for path in sorted(removed, reverse=True):
+        target = os.path.join(dst, path)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.unlink(target)
+    stats = copy_entries(src, dst, changed, jobs)
+    stats.update({"changed": len(changed), "removed": len(removed)})
+    return stats
+
+
+def layout_key(cfg, img_size: int) -> str:
+    """
+    Hash the settings an image layout depends on.
+
+    Parameters
+    ----------
+        cfg (BuildContext): The build.
+        img_size (int): Size of the image in kilobytes.
+
+    Returns
+    -------
+    str: The key, equal for builds that partition alike.
+    """
+    layout = [
+        cfg["fs"],
+        cfg["part_type"],
+        cfg["has_uefi"],
+        cfg["boot_set_esp"],
+        cfg["partition_table"](img_size, cfg["fs"]),
+    ]
+    return hashlib.sha256(json.dumps(layout, default=str).encode()).hexdigest()
+
+
+def load(path: str):  # type: ignore
+    """
+    Load a saved manifest.
+
+    Parameters
+    ----------
+        path (str): The manifest file.
+
+    Returns
+    -------
+    dict: The "layout" key and "entries", None if missing or of another version.
+    """
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return data if data.get("version") == VERSION else None
+
+
+def save(path: str, entries: dict, layout: str) -> None:
+    """
+    Save a manifest.
+
+    Parameters
+    ----------
+        path (str): The manifest file.
+        entries (dict): The manifest.
+        layout (str): The layout key of the image it describes.
+
+    Returns
+    -------
+    Nothing
+    """
+    with open(path + ".part", "w") as f:
+        json.dump({"version": VERSION, "layout": layout, "entries": entries}, f)
+    os.replace(path + ".part", path)
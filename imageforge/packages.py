@@ -1,83 +1,269 @@
+import os
+import shutil
 import subprocess
-from .config import logging, cfg
+from .chroot import ChrootSession
+from .config import BuildContext, resolve
+from .pkgcache import PackageCache
+from .profiling import run, stage
+from .snapshots import SnapshotCache, backend_key, is_empty
 from os import uname
 
 
-def pacstrap_packages() -> None:
+def _package_cache(ctx: BuildContext = None):  # type: ignore
+    """
+    Open the shared package cache and stage it for this build.
+
+    Parameters
+    ----------
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    The PackageCache and its staging directory, or (None, None) when no pkg_cache_dir is configured.
+    """
+    cfg = resolve(ctx)
+    if cfg["pkg_cache_dir"] is None:
+        return None, None
+    cache = PackageCache(cfg["pkg_cache_dir"], cfg["pkg_cache_size"])
+    staging_dir = os.path.join(cfg["work_dir"], "pkgcache")
+    cache.stage(staging_dir)
+    return cache, staging_dir
+
+
+def _snapshot_cache(ctx: BuildContext = None):  # type: ignore
+    """
+    Open the rootfs snapshot cache of this build's backend config.
+
+    Parameters
+    ----------
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    The SnapshotCache, or None when no snapshot_dir is configured.
+    """
+    cfg = resolve(ctx)
+    if cfg["snapshot_dir"] is None:
+        return None
+    return SnapshotCache(
+        cfg["snapshot_dir"], cfg["snapshot_format"], backend_key(cfg), cfg.log
+    )
+
+
+def _install_delta(
+    added: list, removed: list, staging_dir: str, ctx: BuildContext = None
+) -> None:  # type: ignore
+    """
+    Install and remove packages in a restored rootfs.
+
+    Parameters
+    ----------
+        added (list): Packages to install.
+        removed (list): Packages to remove.
+        staging_dir (str): The package cache staging directory, or None.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
+    if cfg["base"] == "arch":
+        pacman = [
+            "pacman",
+            "--root",
+            cfg["install_dir"],
+            "--config",
+            cfg["pacman_conf"],
+            "--noconfirm",
+        ]
+        if staging_dir is not None:
+            pacman += ["--cachedir", staging_dir]
+        if removed:
+            run(pacman + ["-Rs"] + removed, check=True, log=cfg.log)
+        if added:
+            run(pacman + ["-Sy", "--needed"] + added, check=True, log=cfg.log)
+    else:
+        apt = ["apt-get", "-y"]
+        archives = os.path.join(cfg["install_dir"], "var/cache/apt/archives")
+        # Closed before the rootfs is saved as a snapshot.
+        with ChrootSession(cfg["install_dir"]) as chroot:
+            if removed:
+                chroot.run(apt + ["purge"] + removed, check=True, log=cfg.log)
+            if added:
+                # Like the mmdebstrap hooks, apt downloads through the cache.
+                if staging_dir is not None:
+                    _sync_debs(staging_dir, archives)
+                chroot.run(apt + ["update"], check=True, log=cfg.log)
+                chroot.run(apt + ["install"] + added, check=True, log=cfg.log)
+                if staging_dir is not None:
+                    _sync_debs(archives, staging_dir)
+                chroot.run(apt + ["clean"], check=True)
+
+
+def _sync_debs(src: str, dst: str) -> None:
+    """Hardlink the .deb files of src missing from dst, copying across filesystems."""
+    os.makedirs(dst, exist_ok=True)
+    for name in os.listdir(src):
+        if not name.endswith(".deb") or os.path.exists(os.path.join(dst, name)):
+            continue
+        try:
+            os.link(os.path.join(src, name), os.path.join(dst, name))
+        except OSError:
+            shutil.copy2(os.path.join(src, name), os.path.join(dst, name))
+
+
+def _restore_snapshot(snapshots, staging_dir: str, ctx: BuildContext = None) -> bool:  # type: ignore
+    """
+    Restore the closest rootfs snapshot and bring it to the wanted package set.
+
+    Parameters
+    ----------
+        snapshots (SnapshotCache): The snapshot cache, or None.
+        staging_dir (str): The package cache staging directory, or None.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    bool: Whether install_dir was restored, False if it still needs bootstrapping.
+    """
+    cfg = resolve(ctx)
+    if snapshots is None:
+        return False
+    if not is_empty(cfg["install_dir"]):
+        cfg.log.warning("Install dir is not empty, not restoring a rootfs snapshot")
+        return False
+    found = snapshots.lookup(cfg["packages"], cfg["snapshot_max_delta"])
+    if found is None:
+        cfg.log.info("No close rootfs snapshot found")
+        return False
+    path, added, removed = found
+    snapshots.restore(path, cfg["install_dir"])
+    if not added and not removed:
+        return True
+    cfg.log.info(
+        "Applying package delta: +" + " +".join(added) + " -" + " -".join(removed)
+    )
+    try:
+        _install_delta(added, removed, staging_dir, cfg)
+    except subprocess.CalledProcessError:
+        cfg.log.warning("Package delta failed, bootstrapping from scratch")
+        run(["rm", "-rf", cfg["install_dir"]])
+        os.makedirs(cfg["install_dir"])
+        return False
+    snapshots.save(cfg["packages"], cfg["install_dir"])
+    return True
+
+
+@stage
+def pacstrap_packages(ctx: BuildContext = None) -> None:  # type: ignore
     """
     Install packages using pacstrap.
 
     This function installs packages using the pacstrap command. It takes no arguments and returns nothing.
+    When a package cache is configured it is used as the pacman CacheDir.
+    When a snapshot cache is configured the closest snapshot is restored instead and only the package delta is installed.
 
     Parameters
     ----------
-    None
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
-    logging.info("Install dir is:" + cfg["install_dir"])
+    cfg = resolve(ctx)
+    cfg.log.info("Install dir is:" + cfg["install_dir"])
     if cfg["install_dir"] is None:
-        logging.error("Install directory not set")
+        cfg.log.error("Install directory not set")
         exit(1)
-    subprocess.run(
-        [
-            "pacstrap"
-            + " -c"
-            + " -C "
-            + cfg["pacman_conf"]
-            + " -M"
-            + " -G "
-            + cfg["install_dir"]
-            + " "
-            + " ".join(cfg["packages"]),
-        ],
-        check=True,
-        shell=True,
-    )
-    logging.info("Pacstrap complete")
+    cache, staging_dir = _package_cache(cfg)
+    snapshots = _snapshot_cache(cfg)
+    if _restore_snapshot(snapshots, staging_dir, cfg):
+        if cache is not None:
+            cache.finish(staging_dir, cfg["install_dir"])
+        cfg.log.info("Pacstrap complete (restored from snapshot)")
+        return
+    cmd = [
+        "pacstrap",
+        "-c",
+        "-C",
+        cfg["pacman_conf"],
+        "-M",
+        "-G",
+        cfg["install_dir"],
+    ] + cfg["packages"]
+    if cache is not None:
+        # Arguments after the packages are handed to pacman as is.
+        cmd += ["--cachedir", staging_dir]
+    run(cmd, check=True, log=cfg.log)
+    if cache is not None:
+        cache.finish(staging_dir, cfg["install_dir"])
+    if snapshots is not None:
+        snapshots.save(cfg["packages"], cfg["install_dir"])
+    cfg.log.info("Pacstrap complete")
 
 
-def debstrap_packages() -> None:
+@stage
+def debstrap_packages(ctx: BuildContext = None) -> None:  # type: ignore
     """
     Install packages using mmdebstrap.
 
     This function installs packages using the mmdebstrap command. It takes no arguments and returns nothing.
+    When a package cache is configured it is synced in and out of the apt archives through mmdebstrap hooks.
+    When a snapshot cache is configured the closest snapshot is restored instead and only the package delta is installed.
 
     Parameters
     ----------
-    None
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
+    cfg = resolve(ctx)
 
-    logging.info("Install dir is:" + cfg["install_dir"])
+    cfg.log.info("Install dir is:" + cfg["install_dir"])
     if cfg["install_dir"] is None:
-        logging.error("Install directory not set")
+        cfg.log.error("Install directory not set")
         exit(1)
 
-    subprocess.run(
-        [
-            "mmdebstrap"
-            + " --arch="
-            + cfg["arch"]
-            + " --include="
-            + ",".join(cfg["packages"])
-            + ' --components="'
-            + " ".join(cfg["components"])
-            + '"'
-            + f" --customize-hook='{cfg["config_dir"] + "/customize.sh" + " " + cfg["install_dir"]}'"
-            + " --verbose "
-            + cfg["suite"]
-            + " "
-            + cfg["install_dir"]
-            + " "
-            + cfg["mirror"],
-        ],
-        check=True,
-        shell=True,
-    )
-    logging.info("Debstrap complete")
+    cache, staging_dir = _package_cache(cfg)
+    snapshots = _snapshot_cache(cfg)
+    if _restore_snapshot(snapshots, staging_dir, cfg):
+        if cache is not None:
+            cache.finish(staging_dir, cfg["install_dir"])
+        cfg.log.info("Debstrap complete (restored from snapshot)")
+        return
+    cmd = [
+        "mmdebstrap",
+        "--arch=" + cfg["arch"],
+        "--include=" + ",".join(cfg["packages"]),
+        "--components=" + " ".join(cfg["components"]),
+    ]
+    if cache is not None:
+        cmd += [
+            "--skip=download/empty",
+            "--skip=essential/unlink",
+            '--setup-hook=mkdir -p "$1"/var/cache/apt/archives/',
+            "--setup-hook=sync-in " + staging_dir + " /var/cache/apt/archives/",
+            "--customize-hook=sync-out /var/cache/apt/archives " + staging_dir,
+            '--customize-hook=rm -f "$1"/var/cache/apt/archives/*.deb',
+        ]
+    cmd += [
+        "--customize-hook="
+        + cfg["config_dir"]
+        + "/customize.sh"
+        + " "
+        + cfg["install_dir"],
+        "--verbose",
+        cfg["suite"],
+        cfg["install_dir"],
+        cfg["mirror"],
+    ]
+    run(cmd, check=True, log=cfg.log)
+    if cache is not None:
+        cache.finish(staging_dir, cfg["install_dir"])
+    if snapshots is not None:
+        snapshots.save(cfg["packages"], cfg["install_dir"])
+    cfg.log.info("Debstrap complete")
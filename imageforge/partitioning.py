@@ -1,15 +1,78 @@
 """Partitioning module for imageforge."""
 
+import functools
 import subprocess
 import os
-from .common import run_chroot_cmd
+import re
+import stat
+import time
+from . import manifest, ptable
+from .chroot import close_sessions
+from .common import attach_loop, run_chroot_cmd
 from .config import (
-    cfg,
-    logging,
+    BuildContext,
+    resolve,
 )
+from .export import export_file
+from .fsimage import BTRFS_SUBVOLUMES, new_uuid, plan, read_partitions
+from .profiling import run, stage
+from .reproducible import build_seed, environment
+from .runner import run_graph
 
 
-def get_fsline(partition: str) -> str:  # type: ignore
+def register_fs(
+    partition: str, uuid: str, fstype: str, ctx: BuildContext = None
+) -> None:  # type: ignore
+    """
+    Make get_fsline and get_parttype report a filesystem that is not on disk yet.
+
+    Parameters
+    ----------
+        partition (str): Path of the partition, e.g. the image file followed by p2.
+        uuid (str): UUID of the filesystem.
+        fstype (str): Type of the filesystem as blkid reports it.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    Nothing
+    """
+    resolve(ctx).blkid[partition] = {"UUID": uuid, "TYPE": fstype}
+
+
+def forget_fs(disk: str, ctx: BuildContext = None) -> None:  # type: ignore
+    """
+    Forget the filesystems known on the partitions of a disk, e.g. when repartitioning it.
+
+    Parameters
+    ----------
+        disk (str): The disk, a loop device or an image file.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    Nothing
+    """
+    known = resolve(ctx).blkid
+    for partition in list(known):
+        if partition.startswith(disk + "p") and partition[len(disk) + 1 :].isdigit():
+            del known[partition]
+
+
+def _blkid(partition: str, ctx: BuildContext = None) -> dict:  # type: ignore
+    """Get the blkid tags of a partition, running blkid once per partition and build."""
+    known = resolve(ctx).blkid
+    if partition not in known:
+        out = run(
+            ["blkid", "-o", "export", partition], stdout=subprocess.PIPE, check=True
+        ).stdout.decode("utf-8")
+        known[partition] = dict(
+            line.split("=", 1) for line in out.splitlines() if "=" in line
+        )
+    return known[partition]
+
+
+def get_fsline(partition: str, ctx: BuildContext = None) -> str:  # type: ignore
     """
     Function to get the UUID of a partition.
 
@@ -18,19 +81,19 @@ def get_fsline(partition: str) -> str:  # type: ignore
 
     partition : str
         Path of the partition.
+    ctx : BuildContext, optional
+        The build to work on. Defaults to the current one.
 
     Returns
     -------
     The UUID of the partition.
     """
-    fl = subprocess.check_output(["blkid", partition]).decode("utf-8")
-    spl = fl.split(" ")
-    for i in spl:
-        if i.startswith("UUID="):
-            return str(i.replace('"', ""))
+    tags = _blkid(partition, ctx)
+    if "UUID" in tags:
+        return "UUID=" + tags["UUID"]
 
 
-def get_parttype(partition: str) -> str:  # type: ignore
+def get_parttype(partition: str, ctx: BuildContext = None) -> str:  # type: ignore
     """
     Function to get the filesystem of a partition.
 
@@ -39,167 +102,450 @@ def get_parttype(partition: str) -> str:  # type: ignore
 
     partition : str
         Path of the partition.
+    ctx : BuildContext, optional
+        The build to work on. Defaults to the current one.
 
     Returns
     -------
     The filesystem of the partition.
     """
-    fl = subprocess.check_output(["blkid", partition]).decode("utf-8")
-    spl = fl.split(" ")
-    for i in spl:
-        if i.startswith("TYPE="):
-            return i[6:-1]
+    return _blkid(partition, ctx).get("TYPE")
 
 
-def makeimg(img_size: int, ldev: str) -> None:
+@stage
+def makeimg(img_size: int, ldev: str = None, ctx: BuildContext = None) -> str:  # type: ignore
     """
     Function to create an image file and attach it to a loop device.
 
+    With the mkfs image backend the image file is not attached and its path
+    is returned in place of the loop device, in stream mode it is sparse.
+    With an incremental_dir holding a previous image of the same layout that
+    is big enough, a copy of that image is attached instead of a new one, see
+    _reuse_image.
+
     Parameters
     ----------
 
     img_size : int
         Size of the image file in kilobytes.
-    img_name : str
-        Name of the image file.
-    ldev : str
-        Loop device to attach the image file to.
+    ldev : str, optional
+        Loop device to attach the image file to. A free one is allocated if
+        it is not given or already taken by another build.
+    ctx : BuildContext, optional
+        The build to work on. Defaults to the current one.
 
     Returns
     -------
-    Nothing
+    The loop device the image file is attached to.
     """
-    logging.info("Creating image file " + cfg["img_name"] + ".img")
-    subprocess.run(
-        [
-            "fallocate",
-            "-l",
-            str(img_size) + "K",
-            cfg["work_dir"] + "/" + cfg["img_name"] + ".img",
-        ]
-    )
+    cfg = resolve(ctx)
+    if not _reuse_image(img_size, cfg):
+        cfg.log.info("Creating image file " + cfg["img_name"] + ".img")
+        # Streamed images only ever hold the partition table, keep them sparse.
+        run(
+            [
+                "truncate" if cfg["stream"] else "fallocate",
+                "-s" if cfg["stream"] else "-l",
+                str(img_size) + "K",
+                cfg["work_dir"] + "/" + cfg["img_name"] + ".img",
+            ]
+        )
+    if cfg["img_backend"] == "mkfs":
+        cfg.log.info("Image file created")
+        return cfg["work_dir"] + "/" + cfg["img_name"] + ".img"
 
-    subprocess.run(["modprobe", "loop"])
-    logging.info(
-        "Attaching image file " + cfg["img_name"] + ".img to loop device " + ldev
+    ldev = attach_loop(
+        cfg["work_dir"] + "/" + cfg["img_name"] + ".img", ldev, owner=cfg["work_dir"]
+    )
+    cfg.log.info(
+        "Attached image file " + cfg["img_name"] + ".img to loop device " + ldev
     )
-    subprocess.run(["losetup", ldev, cfg["work_dir"] + "/" + cfg["img_name"] + ".img"])
 
-    logging.info("Image file created")
+    cfg.log.info("Image file created")
+    return ldev
 
 
-def partition(disk: str, img_size: int, split: bool = False) -> None:
+@stage
+def partition(
+    disk: str, img_size: int, split: bool = False, ctx: BuildContext = None
+) -> None:  # type: ignore
     """
     Partition the specified disk.
 
+    With the mkfs image backend the disk is an image file. Only the table is
+    written, the filesystems are planned here with fresh UUIDs and generated
+    from mnt_dir, which becomes the install dir, by unmount.
+    When makeimg reused a previous image its filesystems are mounted as they
+    are, the partition prefix and suffix commands are not run again.
+    Otherwise the root partition, and every other partition of the table
+    with format_partitions, are formatted concurrently and mounted in one
+    pass, the boot partition at /boot or /boot/efi.
+
     Parameters
     ----------
         disk (str): The path of the disk to be partitioned.
         split (bool, optional): Whether to split the partition. Defaults to False.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
     Returns
     -------
+    Nothing
     """
+    cfg = resolve(ctx)
+    if cfg.previous is not None:
+        _mount_previous(
+            disk, "p3" if cfg["has_uefi"] else ("p2" if not split else "p1"), cfg
+        )
+        return
     # Rest of the code...
-    table = [["Partition", "Start", "End", "Size", "Filesystem"]]
-    if cfg["has_uefi"]:
-        prtd_cmd = [
-            "parted",
-            "--script",
-            disk,
-            "--align",
-            "optimal",
-        ]
-    else:
-        prtd_cmd = [
-            "parted",
-            "--script",
-            disk,
-            "--align",
-            "optimal",
-            "mklabel",
-            cfg["part_type"],
-        ]
+    table = [["Partition", "Start", "End", "Sectors", "Filesystem"]]
     ld_partition_table = cfg["partition_table"](img_size, cfg["fs"])
+    forget_fs(disk, cfg)
 
+    if not split:
+        _run_disk_cmds(cfg["partition_prefix"](cfg["config_dir"], disk), disk, cfg)
+
+    # With UEFI the prefix commands create the label, partitions are added to it.
+    pt = ptable.read_table(disk) if cfg["has_uefi"] else None
+    if pt is None:
+        pt = ptable.new_table(cfg["part_type"], ptable.disk_sectors(disk))
+    boot_num = None
+    formats = {}
     for i in ld_partition_table.keys():
-        if ld_partition_table[i][3] == "fat32":
-            if cfg["has_uefi"]:
-                part_num = str(2)
-            else:
-                part_num = str(1)
-            prtd_cmd += [
-                "mkpart",
-                "primary",
-                "fat32",
-                ld_partition_table[i][0],
-                ld_partition_table[i][1],
-                "set",
-                part_num,
-                "boot",
-                "on",
-            ]
-            if cfg["boot_set_esp"]:
-                prtd_cmd += ["set", part_num, "esp", "on"]
-        elif ld_partition_table[i][3] == "NONE":
-            pass
-        else:
-            prtd_cmd += [
-                "mkpart",
-                "primary",
-                ld_partition_table[i][3],
-                ld_partition_table[i][0],
-                ld_partition_table[i][1],
+        fs = ld_partition_table[i][3]
+        if fs == "NONE":
+            continue
+        part = ptable.add_partition(
+            pt,
+            ld_partition_table[i][0],
+            ld_partition_table[i][1],
+            fs,
+            boot=fs == "fat32",
+            esp=fs == "fat32" and cfg["boot_set_esp"],
+        )
+        if fs == "fat32":
+            boot_num = part["number"]
+        formats[part["number"]] = fs
+        table.append(
+            [
+                str(part["number"]),
+                str(part["start"]),
+                str(part["end"]),
+                str(part["end"] - part["start"] + 1),
+                fs,
             ]
+        )
+    for row in table:
+        cfg.log.info("%-10s %-12s %-12s %-12s %s" % tuple(row))
+    if cfg["reproducible"]:
+        ptable.pin_ids(pt, build_seed(cfg))
+    ptable.write_table(disk, pt)
+    if stat.S_ISBLK(os.stat(disk).st_mode):
+        # Let the kernel know about the new partitions, as parted does.
+        run(["partx", "-u", disk])
 
     if not split:
-        for i in cfg["partition_prefix"](cfg["config_dir"], disk):
-            subprocess.run(i)
+        _run_disk_cmds(cfg["partition_suffix"](cfg["config_dir"], disk), disk, cfg)
 
-    logging.info(f"Full command: {prtd_cmd}")
-    subprocess.run(prtd_cmd)
+    idf = "p3" if cfg["has_uefi"] else ("p2" if not split else "p1")
 
-    if not split:
-        for i in cfg["partition_suffix"](cfg["config_dir"], disk):
-            subprocess.run(i)
+    if cfg["img_backend"] == "mkfs":
+        _plan_filesystems(disk, int(idf[1:]), boot_num, cfg)
+        cfg.log.info("Partitioned successfully")
+        return
 
     if not os.path.exists(cfg["mnt_dir"]):
         os.mkdir(cfg["mnt_dir"])
 
-    idf = "p3" if cfg["has_uefi"] else ("p2" if not split else "p1")
+    # The root always, the other partitions of the table if the config asks.
+    labels = {"fat32": "BOOT", "linux-swap": "SWAP"}
+    steps = {
+        idf: (
+            functools.partial(
+                _format,
+                disk + idf,
+                cfg["fs"],
+                "PRIMARY" if cfg["fs"] == "ext4" else "ROOTFS",
+                cfg,
+                int(idf[1:]),
+            ),
+            [],
+        )
+    }
+    if cfg["format_partitions"]:
+        for number, fs in formats.items():
+            if "p" + str(number) != idf:
+                steps["p" + str(number)] = (
+                    functools.partial(
+                        _format,
+                        disk + "p" + str(number),
+                        fs,
+                        labels.get(fs),
+                        cfg,
+                        number,
+                    ),
+                    [],
+                )
+    run_graph(steps)
+    _mount_root(disk + idf, cfg, create=True)
+    boot_dir = cfg["mnt_dir"] + "/boot"
+    os.mkdir(boot_dir)
+    if cfg["has_uefi"] and (cfg["fs"] == "btrfs" or cfg["format_partitions"]):
+        boot_dir += "/efi"
+        os.mkdir(boot_dir)
+    if cfg["format_partitions"] and boot_num is not None:
+        run(["mount", disk + "p" + str(boot_num), boot_dir], check=True)
+
+    cfg.log.info("Partitioned successfully")
+
+
+def _format(
+    partition: str, fs: str, label: str, ctx: BuildContext = None, number: int = None  # type: ignore
+) -> None:
+    """
+    Create a filesystem on a partition with a new UUID, reporting how long it took.
+
+    In reproducible builds the UUID, and the hash seed of ext filesystems, are
+    derived from the build seed and the partition number, and the mkfs tools
+    take their time from the epoch.
+
+    Parameters
+    ----------
+        partition (str): The partition.
+        fs (str): Its filesystem as in the partition table, e.g. "fat32", "ext4" or "linux-swap".
+        label (str): The label of the filesystem, or None.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+        number (int, optional): The partition number. Defaults to None.
 
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
+    fstype = {"fat32": "vfat", "linux-swap": "swap"}.get(fs, fs)
+    seed = None
+    env = None
+    if cfg["reproducible"]:
+        seed = build_seed(cfg) + "/fs" + str(number)
+        env = environment(cfg["source_date_epoch"])
+    uuid = new_uuid(fstype, seed)
+    label_args = ["-L", label] if label else []
+    if fstype == "vfat":
+        argv = ["mkfs.vfat", "-F", "32"]
+        # Fixed boot sector contents, before -i so the volume id is kept.
+        argv += ["--invariant"] if seed is not None else []
+        argv += ["-i", uuid.replace("-", "")]
+        argv += ["-n", label] if label else []
+    elif fstype == "swap":
+        argv = ["mkswap", "-U", uuid] + label_args
+    elif fstype in ["ext2", "ext3", "ext4"]:
+        argv = ["mkfs." + fstype, "-F", "-U", uuid] + label_args
+        if seed is not None:
+            argv += ["-E", "hash_seed=" + new_uuid(fstype, seed + "/hash_seed")]
+    elif fstype == "btrfs":
+        argv = ["mkfs.btrfs", "-f", "-U", uuid] + label_args
+    else:
+        cfg.log.warning("Not formatting " + partition + ", unknown filesystem " + fs)
+        return
+    start = time.monotonic()
+    if cfg.profiler is not None:
+        with cfg.profiler.stage("format " + os.path.basename(partition)):
+            run(argv + [partition], env=env, check=True, log=cfg.log)
+    else:
+        run(argv + [partition], env=env, check=True, log=cfg.log)
+    register_fs(partition, uuid, fstype, cfg)
+    cfg.log.info(
+        "Formatted %s as %s in %.2fs" % (partition, fstype, time.monotonic() - start)
+    )
+
+
+def _mount_root(partition: str, ctx: BuildContext = None, create: bool = False) -> None:  # type: ignore
+    """
+    Mount the root filesystem at mnt_dir, the @ and @home subvolumes for btrfs.
+
+    Parameters
+    ----------
+        partition (str): The root partition.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+        create (bool, optional): Create the btrfs subvolumes first, on a new filesystem. Defaults to False.
+
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
     if cfg["fs"] == "ext4":
-        subprocess.run("mkfs.ext4 -F -L PRIMARY " + disk + idf, shell=True)
-        subprocess.run("mount " + disk + idf + " " + cfg["mnt_dir"], shell=True)
-        os.mkdir(cfg["mnt_dir"] + "/boot")
-    elif cfg["fs"] == "btrfs":
-        p2 = disk + idf + " "
-        subprocess.run("mkfs.btrfs -f -L ROOTFS " + p2, shell=True)
-        subprocess.run(
-            "mount -t btrfs -o compress=zstd " + p2 + cfg["mnt_dir"], shell=True
-        )
-        for i in ["/@", "/@home", "/@log", "/@pkg", "/@.snapshots"]:
-            subprocess.run("btrfs su cr " + cfg["mnt_dir"] + i, shell=True)
-        subprocess.run("umount " + p2, shell=True)
-        subprocess.run(
-            "mount -t btrfs -o compress=zstd,subvol=@ " + p2 + cfg["mnt_dir"],
-            shell=True,
-        )
-        os.mkdir(cfg["mnt_dir"] + "/home")
-        subprocess.run(
-            "mount -t btrfs -o compress=zstd,subvol=@home "
-            + p2
-            + cfg["mnt_dir"]
-            + "/home",
-            shell=True,
+        run(["mount", partition, cfg["mnt_dir"]], check=True)
+        return
+    if create:
+        # All subvolumes in one call, on the top level mounted out of the way.
+        top = cfg["work_dir"] + "/btrfs-top"
+        os.makedirs(top, exist_ok=True)
+        run(["mount", "-t", "btrfs", partition, top], check=True)
+        try:
+            run(
+                ["btrfs", "subvolume", "create"]
+                + [top + "/" + subvol for subvol in BTRFS_SUBVOLUMES],
+                check=True,
+            )
+        finally:
+            run(["umount", top])
+            os.rmdir(top)
+    for subvol, target in [("@", ""), ("@home", "/home")]:
+        os.makedirs(cfg["mnt_dir"] + target, exist_ok=True)
+        run(
+            ["mount", "-t", "btrfs", "-o", "compress=zstd,subvol=" + subvol]
+            + [partition, cfg["mnt_dir"] + target],
+            check=True,
         )
-        os.mkdir(cfg["mnt_dir"] + "/boot")
-        if cfg["has_uefi"]:
-            os.mkdir(cfg["mnt_dir"] + "/boot/efi")
 
-    logging.info("Partitioned successfully")
 
+def _reuse_image(img_size: int, ctx: BuildContext = None) -> bool:  # type: ignore
+    """
+    Copy the previous image of an incremental build into the work dir, if usable.
+
+    It is usable when it was saved with the same partition layout and is at
+    least img_size big. The copy is a reflink where the filesystem allows.
+
+    Parameters
+    ----------
+        img_size (int): Size the image needs in kilobytes.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    bool: Whether the previous image was copied, its manifest is set as ctx.previous.
+    """
+    cfg = resolve(ctx)
+    if cfg["incremental_dir"] is None or cfg["img_backend"] != "loop":
+        return False
+    base = os.path.join(cfg["incremental_dir"], cfg["img_name"])
+    previous = manifest.load(base + ".manifest.json")
+    if previous is None or not os.path.exists(base + ".img"):
+        cfg.log.info("No previous image, building from scratch")
+        return False
+    size = os.path.getsize(base + ".img")
+    if previous["layout"] != manifest.layout_key(cfg, size // 1024):
+        cfg.log.info("Partition layout changed, building from scratch")
+        return False
+    if img_size * 1024 > size:
+        cfg.log.info("Previous image is too small, building from scratch")
+        return False
+    strategy = export_file(
+        base + ".img", cfg["work_dir"] + "/" + cfg["img_name"] + ".img", mode=0o644
+    )
+    cfg.log.info("Patching the previous image, copied using " + strategy)
+    cfg.previous = previous["entries"]
+    return True
+
+
+def _mount_previous(disk: str, idf: str, ctx: BuildContext = None) -> None:  # type: ignore
+    """
+    Mount the root filesystem of a reused image like partition mounts a new one.
+
+    Parameters
+    ----------
+        disk (str): The loop device of the image.
+        idf (str): Suffix of the root partition.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
+    forget_fs(disk, cfg)
+    run(["partx", "-u", disk])
+    _mount_root(disk + idf, cfg)
+    cfg.log.info("Mounted the previous image")
+
+
+def _run_disk_cmds(cmds: list, disk: str, ctx: BuildContext = None) -> None:  # type: ignore
+    """
+    Run the partition prefix or suffix commands of the config on a disk.
+
+    With the mkfs image backend the disk is an image file without partition
+    devices, so commands working on the whole disk, like writing a
+    bootloader with dd conv=notrunc, are run but ones addressing a partition
+    of it, like disk + "p1", fail the build.
+
+    Parameters
+    ----------
+        cmds (list): The commands.
+        disk (str): The disk they work on, a loop device or an image file.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
+    size = os.path.getsize(disk) if cfg["img_backend"] == "mkfs" else None
+    for i in cmds:
+        if size is not None:
+            for arg in i:
+                arg = str(arg)
+                # e.g. disk + "p1" or of=disk + "p1" for dd.
+                if re.search(re.escape(disk) + r"p[0-9]+(?![0-9])", arg):
+                    cfg.log.error(
+                        "Partition command "
+                        + " ".join(str(a) for a in i)
+                        + " addresses a partition of the disk, which needs the"
+                        + " loop image backend"
+                    )
+                    exit(1)
+        run(i)
+        if size is not None and os.path.getsize(disk) < size:
+            # dd without conv=notrunc truncates image files, not devices.
+            cfg.log.warning("Command truncated the image file, use conv=notrunc")
+            os.truncate(disk, size)
+
+
+def _plan_filesystems(
+    disk: str, root_num: int, boot_num: int, ctx: BuildContext = None
+) -> None:  # type: ignore
+    """
+    Plan the filesystems of a partitioned image file for the mkfs image backend.
+
+    Parameters
+    ----------
+        disk (str): The image file.
+        root_num (int): Number of the root partition.
+        boot_num (int): Number of the fat32 boot partition, or None.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
-def create_fstab(ldev, ldev_alt=None, simple_vfat=False) -> None:
+    Returns
+    -------
+    Nothing
+    """
+    cfg = resolve(ctx)
+    partitions = read_partitions(disk)
+    boot_dir = "boot/efi" if cfg["has_uefi"] else "boot"
+    filesystems = []
+    seed = build_seed(cfg) if cfg["reproducible"] else None
+    epoch = cfg["source_date_epoch"] if cfg["reproducible"] else None
+    if boot_num in partitions and boot_num != root_num:
+        filesystems.append(
+            plan(disk, boot_num, "vfat", "BOOT", boot_dir, partitions, seed, epoch)
+        )
+    if root_num in partitions:
+        label = "PRIMARY" if cfg["fs"] == "ext4" else "ROOTFS"
+        filesystems.append(
+            plan(disk, root_num, cfg["fs"], label, "", partitions, seed, epoch)
+        )
+    for fs in filesystems:
+        register_fs(disk + "p" + str(fs["number"]), fs["uuid"], fs["fs"], cfg)
+        cfg.log.info("Planned " + fs["fs"] + " on " + disk + "p" + str(fs["number"]))
+    cfg.filesystems += filesystems
+    # The filesystems are generated from the install dir, no copy needed.
+    cfg["mnt_dir"] = cfg["install_dir"]
+    os.makedirs(os.path.join(cfg["mnt_dir"], boot_dir), exist_ok=True)
+
+
+@stage
+def create_fstab(
+    ldev, ldev_alt=None, simple_vfat=False, ctx: BuildContext = None
+) -> None:  # type: ignore
     """
     Create the /etc/fstab file with the appropriate mount points and options based on the given parameters.
 
@@ -208,16 +554,21 @@ def create_fstab(ldev, ldev_alt=None, simple_vfat=False) -> None:
         ldev (str): The logical device path.
         ldev_alt (str, optional): An alternate logical device path. Defaults to None.
         simple_vfat (bool, optional): Flag indicating whether to use simple VFAT options. Defaults to False.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
     Returns
     -------
     Nothing
     """
+    cfg = resolve(ctx)
     if cfg["has_uefi"]:
-        id1 = get_fsline(ldev + "p2")
-        id2 = get_fsline(ldev + "p3")
+        id1 = get_fsline(ldev + "p2", cfg)
+        id2 = get_fsline(ldev + "p3", cfg)
     else:
-        id1 = get_fsline(ldev + "p1")
-        id2 = get_fsline((ldev_alt + "p1") if ldev_alt is not None else (ldev + "p2"))
+        id1 = get_fsline(ldev + "p1", cfg)
+        id2 = get_fsline(
+            (ldev_alt + "p1") if ldev_alt is not None else (ldev + "p2"), cfg
+        )
 
     if cfg["fs"] == "ext4":
         with open(cfg["mnt_dir"] + "/etc/fstab", "a") as f:
@@ -259,10 +610,10 @@ def create_fstab(ldev, ldev_alt=None, simple_vfat=False) -> None:
             )
     with open(cfg["mnt_dir"] + "/etc/fstab", "a") as f:
         if cfg["has_uefi"]:
-            boot_fs = get_parttype(ldev + "p2")
+            boot_fs = get_parttype(ldev + "p2", cfg)
             mount_point = "/boot/efi"
         else:
-            boot_fs = get_parttype(ldev + "p1")
+            boot_fs = get_parttype(ldev + "p1", cfg)
             mount_point = "/boot"
         if boot_fs == "vfat":
             f.write(
@@ -279,9 +630,9 @@ def create_fstab(ldev, ldev_alt=None, simple_vfat=False) -> None:
         else:
             f.write(
                 (
-                    get_fsline(ldev + "p2")
+                    get_fsline(ldev + "p2", cfg)
                     if not cfg["has_uefi"]
-                    else get_fsline(ldev + "p1")
+                    else get_fsline(ldev + "p1", cfg)
                 )
                 + " "
                 + mount_point
@@ -292,45 +643,51 @@ def create_fstab(ldev, ldev_alt=None, simple_vfat=False) -> None:
             )
 
 
-def create_extlinux_conf(ldev) -> None:
+@stage
+def create_extlinux_conf(ldev, ctx: BuildContext = None) -> None:  # type: ignore
     """
     Creates an extlinux configuration file.
 
     Parameters
     ----------
         ldev: The logical device path.
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
+    cfg = resolve(ctx)
     if not os.path.exists(cfg["mnt_dir"] + "/boot/extlinux"):
         os.mkdir(cfg["mnt_dir"] + "/boot/extlinux")
-        subprocess.run(["touch", cfg["mnt_dir"] + "/boot/extlinux/extlinux.conf"])
+        run(["touch", cfg["mnt_dir"] + "/boot/extlinux/extlinux.conf"])
     with open(cfg["mnt_dir"] + "/boot/extlinux/extlinux.conf", "w") as f:
         f.write(cfg["configtxt"])
         # add append root=UUID=... + cmdline
         if "partition_table_root" in cfg:
-            root_uuid = get_fsline(ldev + "p1")
+            root_uuid = get_fsline(ldev + "p1", cfg)
         else:
-            root_uuid = get_fsline(ldev + "p2")
+            root_uuid = get_fsline(ldev + "p2", cfg)
         f.write("    append root=" + root_uuid + " " + cfg["cmdline"])
         if cfg["configtxt_suffix"] is not None:
             f.write(cfg["configtxt_suffix"])
 
 
-def grub_install(arch: str = "arm64-efi") -> None:
+@stage
+def grub_install(arch: str = "arm64-efi", ctx: BuildContext = None) -> None:  # type: ignore
     """
     Installs GRUB bootloader and generates the GRUB configuration file.
 
     Parameters
     ----------
         arch (str, optional): The architecture for the bootloader. Defaults to "arm64-efi".
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
 
     Returns
     -------
     Nothing
     """
+    cfg = resolve(ctx)
     grubfile = open(cfg["mnt_dir"] + "/etc/default/grub")
     grubconf = grubfile.read()
     grubfile.close()
@@ -366,13 +723,21 @@ def grub_install(arch: str = "arm64-efi") -> None:
     run_chroot_cmd(cfg["mnt_dir"], ["/sbin/grub-mkconfig", "-o", "/boot/grub/grub.cfg"])
 
 
-def cleanup() -> None:
+@stage
+def cleanup(ctx: BuildContext = None) -> None:  # type: ignore
     """
     Cleans up the work directory.
 
+    Parameters
+    ----------
+        ctx (BuildContext, optional): The build to work on. Defaults to the current one.
+
     Returns
     -------
     Nothing
     """
-    logging.info("Cleaning up")
-    subprocess.run(["rm", "-rf", cfg["work_dir"]])
+    cfg = resolve(ctx)
+    cfg.log.info("Cleaning up")
+    # rm -rf would descend into the mounts of a chroot left open.
+    close_sessions(cfg["work_dir"])
+    run(["rm", "-rf", cfg["work_dir"]])
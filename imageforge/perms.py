@@ -0,0 +1,226 @@
+"""In-process ownership and permission fixing for imageforge."""
+
+import errno
+import grp
+import logging
+import os
+import pwd
+import stat
+from .profiling import run
+
+_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+def _read_ids(path: str) -> dict:
+    """Map the names of a passwd or group file to their numeric ids."""
+    ids = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.split(":")
+                if len(parts) > 2 and parts[2].isdigit():
+                    ids.setdefault(parts[0], int(parts[2]))
+    except FileNotFoundError:
+        pass
+    return ids
+
+
+def _resolve_id(name: str, names: dict, lookup) -> int:
+    """Resolve a numeric id, a name of the rootfs or a name of the host."""
+    if name.isdigit():
+        return int(name)
+    if name in names:
+        return names[name]
+    return lookup(name)
+
+
+def _split(key: str) -> tuple:
+    """Split a perms key into its path components, rejecting escapes. The root is ()."""
+    parts = tuple(part for part in key.split("/") if part not in ["", "."])
+    if ".." in parts:
+        raise OSError("Out of bounds permission fix!")
+    return parts
+
+
+def _open_parent(root_fd: int, path: tuple) -> int:
+    """
+    Open the parent directory of a path below root without following symlinks.
+
+    Raises
+    ------
+        OSError: If a component is a symlink, so the path could escape root.
+    """
+    fd = os.dup(root_fd)
+    try:
+        for part in path[:-1]:
+            try:
+                new = os.open(part, _DIR_FLAGS, dir_fd=fd)
+            except OSError as e:
+                if e.errno in (errno.ELOOP, errno.ENOTDIR):
+                    raise OSError("Out of bounds permission fix!") from e
+                raise
+            os.close(fd)
+            fd = new
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _owner(inherited: tuple, entries: list) -> tuple:
+    """Pick the (index, uid, gid) of the latest entry covering a path."""
+    owner = inherited
+    for entry in entries:
+        if entry[0] > owner[0]:
+            owner = entry[:3]
+    return owner
+
+
+def _walk(
+    dir_fd: int, path: tuple, inherited: tuple, entries: dict, stats, dev: int
+) -> None:
+    """Chown everything below an open directory, not following symlinks or mounts."""
+    with os.scandir(dir_fd) as it:
+        children = [
+            (
+                child.name,
+                child.is_dir(follow_symlinks=False),
+                child.stat(follow_symlinks=False).st_dev,
+            )
+            for child in it
+        ]
+    for name, is_dir, child_dev in children:
+        if child_dev != dev:
+            # A mount point, like the proc or dev of a chroot session.
+            continue
+        child = path + (name,)
+        owner = _owner(inherited, entries.get(child, []))
+        os.chown(name, owner[1], owner[2], dir_fd=dir_fd, follow_symlinks=False)
+        stats["entries"] += 1
+        if is_dir:
+            child_fd = os.open(name, _DIR_FLAGS, dir_fd=dir_fd)
+            try:
+                _walk(
+                    child_fd,
+                    child,
+                    _owner(inherited, [e for e in entries.get(child, []) if e[3]]),
+                    entries,
+                    stats,
+                    dev,
+                )
+            finally:
+                os.close(child_fd)
+
+
+def apply_perms(root: str, perms: dict) -> dict:
+    """
+    Apply a perms map to a rootfs in process.
+
+    Keys are paths below root, a trailing slash applies the owner to the
+    whole tree, "/" to the whole root. Values are (user, group, mode) as chown and chmod take them,
+    the mode applies to the path itself only. The result is the same as
+    applying the entries one after the other, but every tree is walked a
+    single time however many entries it contains. Paths are resolved
+    relative to root without following symlinks, so no entry can escape it,
+    and trees are not walked across mounts.
+
+    Parameters
+    ----------
+        root (str): The rootfs.
+        perms (dict): The perms map.
+
+    Raises
+    ------
+        OSError: If an entry is out of bounds.
+
+    Returns
+    -------
+    dict: The number of "entries" chowned and "modes" set.
+    """
+    users = _read_ids(os.path.join(root, "etc/passwd"))
+    groups = _read_ids(os.path.join(root, "etc/group"))
+    # Path components -> [(index, uid, gid, recursive, mode)]
+    entries = {}
+    for index, (key, (user, group, mode)) in enumerate(perms.items()):
+        entries.setdefault(_split(key), []).append(
+            (
+                index,
+                _resolve_id(user, users, lambda n: pwd.getpwnam(n).pw_uid),
+                _resolve_id(group, groups, lambda n: grp.getgrnam(n).gr_gid),
+                key.endswith("/"),
+                mode,
+            )
+        )
+    recursive = {path for path in entries if any(e[3] for e in entries[path])}
+    stats = {"entries": 0, "modes": 0}
+    root_fd = os.open(root, _DIR_FLAGS)
+    try:
+        for path in sorted(entries):
+            st = None
+            parent_fd = None
+            try:
+                if not path:
+                    # The root itself, fixed through its own descriptor.
+                    st = os.fstat(root_fd)
+                else:
+                    parent_fd = _open_parent(root_fd, path)
+                    st = os.stat(path[-1], dir_fd=parent_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                pass
+            try:
+                if st is None:
+                    logging.warning(
+                        "Not fixing permissions of missing /" + "/".join(path)
+                    )
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    raise OSError("Out of bounds permission fix!")
+                if not any(path[:i] in recursive for i in range(len(path))):
+                    # Entries inside a recursive tree are owned while walking it.
+                    owner = _owner((-1, -1, -1), entries[path])
+                    if path:
+                        os.chown(
+                            path[-1],
+                            owner[1],
+                            owner[2],
+                            dir_fd=parent_fd,
+                            follow_symlinks=False,
+                        )
+                    else:
+                        os.chown(root_fd, owner[1], owner[2])
+                    stats["entries"] += 1
+                    if path in recursive:
+                        child_fd = (
+                            os.open(path[-1], _DIR_FLAGS, dir_fd=parent_fd)
+                            if path
+                            else os.dup(root_fd)
+                        )
+                        try:
+                            _walk(
+                                child_fd,
+                                path,
+                                _owner(
+                                    (-1, -1, -1), [e for e in entries[path] if e[3]]
+                                ),
+                                entries,
+                                stats,
+                                st.st_dev,
+                            )
+                        finally:
+                            os.close(child_fd)
+                mode = max(entries[path])[4]
+                try:
+                    if path:
+                        os.chmod(path[-1], int(mode, 8), dir_fd=parent_fd)
+                    else:
+                        os.chmod(root_fd, int(mode, 8))
+                except ValueError:
+                    # Symbolic modes are left to chmod.
+                    run(["chmod", "--", mode, os.path.join(root, *path)], check=True)
+                stats["modes"] += 1
+            finally:
+                if parent_fd is not None:
+                    os.close(parent_fd)
+    finally:
+        os.close(root_fd)
+    return stats
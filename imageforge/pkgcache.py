@@ -0,0 +1,226 @@
+"""Content-addressed package download cache for imageforge."""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+from .export import export_file
+
+
+def _sha256(path: str) -> str:
+    """Return the hex SHA-256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """Hardlink src to dst, copying when they are on different filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        export_file(src, dst, mode=0o644)
+
+
+def _is_archive(name: str) -> bool:
+    """Whether a cache entry is a package archive rather than a signature."""
+    return name.endswith(".deb") or (".pkg.tar" in name and not name.endswith(".sig"))
+
+
+def installed_archives(install_dir: str) -> set:
+    """
+    Get the archive file names of the packages installed in a rootfs.
+
+    Parameters
+    ----------
+        install_dir (str): The rootfs to inspect, pacman or dpkg based.
+
+    Returns
+    -------
+    set: Debian archive names and pacman archive name prefixes.
+    """
+    names = set()
+    local = os.path.join(install_dir, "var/lib/pacman/local")
+    if os.path.isdir(local):
+        # Pacman archives are <name>-<version>-<rel>-<arch>.pkg.tar.<ext>.
+        names.update(
+            entry + "-" for entry in os.listdir(local) if entry != "ALPM_DB_VERSION"
+        )
+    status = os.path.join(install_dir, "var/lib/dpkg/status")
+    if os.path.isfile(status):
+        with open(status, "r") as f:
+            for paragraph in f.read().split("\n\n"):
+                fields = dict(
+                    line.split(": ", 1)
+                    for line in paragraph.splitlines()
+                    if ": " in line and not line.startswith(" ")
+                )
+                if "Package" in fields and "Version" in fields:
+                    names.add(
+                        fields["Package"]
+                        + "_"
+                        + fields["Version"].replace(":", "%3a")
+                        + "_"
+                        + fields.get("Architecture", "all")
+                        + ".deb"
+                    )
+    return names
+
+
+def _was_installed(name: str, installed: set) -> bool:
+    """Whether a package archive belongs to one of the installed packages."""
+    if name in installed:
+        return True
+    for prefix in installed:
+        if prefix.endswith("-") and name.startswith(prefix):
+            if "-" not in name[len(prefix) :]:
+                return True
+    return False
+
+
+class PackageCache:
+    """
+    Package archives shared across builds, stored by their SHA-256 digest.
+
+    Objects live in <cache_dir>/objects/<xx>/<digest> and an index maps the
+    archive file names pacman and apt look for to their digest. Before a
+    build the known archives are hardlinked into a staging directory used as
+    the package manager cache, afterwards new downloads are ingested and the
+    least recently used objects are evicted once the cache exceeds max_size.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        """
+        Parameters
+        ----------
+            cache_dir (str): The directory holding the cache.
+            max_size (int): The maximum size of the cache in kilobytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1024
+        self.objects = os.path.join(cache_dir, "objects")
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.staged = set()
+        os.makedirs(self.objects, exist_ok=True)
+
+    @contextmanager
+    def _lock(self, exclusive: bool = True):
+        """Serialise cache updates between concurrent builds."""
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _object(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def _read_index(self) -> dict:
+        try:
+            with open(self.index_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_index(self, index: dict) -> None:
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+    def stage(self, staging_dir: str) -> None:
+        """
+        Populate a package manager cache directory from the cache.
+
+        Parameters
+        ----------
+            staging_dir (str): The directory handed to pacman or apt.
+
+        Returns
+        -------
+        Nothing
+        """
+        os.makedirs(staging_dir, exist_ok=True)
+        with self._lock(exclusive=False):
+            index = self._read_index()
+            for name, digest in index.items():
+                dst = os.path.join(staging_dir, name)
+                if os.path.exists(self._object(digest)) and not os.path.exists(dst):
+                    _link_or_copy(self._object(digest), dst)
+                    self.staged.add(name)
+        logging.info(
+            "Staged " + str(len(self.staged)) + " cached packages in " + staging_dir
+        )
+
+    def finish(self, staging_dir: str, install_dir: str) -> dict:
+        """
+        Ingest new downloads, refresh used objects and evict old ones.
+
+        Parameters
+        ----------
+            staging_dir (str): The directory used as package manager cache.
+            install_dir (str): The bootstrapped rootfs.
+
+        Returns
+        -------
+        dict: The "hits", "misses" and "downloaded" kilobytes of this build.
+        """
+        installed = installed_archives(install_dir)
+        stats = {"hits": 0, "misses": 0, "downloaded": 0}
+        with self._lock():
+            index = self._read_index()
+            for name in sorted(os.listdir(staging_dir)):
+                path = os.path.join(staging_dir, name)
+                if not os.path.isfile(path):
+                    continue
+                if name in self.staged and name in index:
+                    if _is_archive(name) and _was_installed(name, installed):
+                        stats["hits"] += 1
+                        if os.path.exists(self._object(index[name])):
+                            os.utime(self._object(index[name]))
+                    continue
+                digest = _sha256(path)
+                if not os.path.exists(self._object(digest)):
+                    os.makedirs(os.path.dirname(self._object(digest)), exist_ok=True)
+                    _link_or_copy(path, self._object(digest))
+                os.utime(self._object(digest))
+                index[name] = digest
+                if _is_archive(name):
+                    stats["misses"] += 1
+                    stats["downloaded"] += os.path.getsize(path) // 1024
+            self._evict(index)
+            self._write_index(index)
+        logging.info(
+            "Package cache: "
+            + str(stats["hits"])
+            + " hits, "
+            + str(stats["misses"])
+            + " misses, "
+            + str(stats["downloaded"])
+            + "K downloaded"
+        )
+        return stats
+
+    def _evict(self, index: dict) -> None:
+        """Remove least recently used objects until the cache fits max_size."""
+        objects = []
+        for root, _, files in os.walk(self.objects):
+            for name in files:
+                st = os.stat(os.path.join(root, name))
+                objects.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in objects)
+        evicted = set()
+        for _, size, digest in sorted(objects):
+            if total <= self.max_size:
+                break
+            os.remove(self._object(digest))
+            evicted.add(digest)
+            total -= size
+        for name in [name for name, digest in index.items() if digest in evicted]:
+            del index[name]
+        if evicted:
+            logging.info("Evicted " + str(len(evicted)) + " packages from the cache")
@@ -0,0 +1,385 @@
+"""Package manifests for imageforge.
+
+A manifest is the packages.<arch> file of a config directory, one or more
+package names per line, with # starting a comment anywhere on a line:
+
+    @include packages.common    # another manifest, relative to this one
+    linux-aarch64 firmware-linux
+    -nano                       # drops a package listed before
+
+The packages.<arch>.<edition> manifest, if there is one, is an overlay
+applied after it for the configured edition. Duplicates are dropped,
+the first occurrence deciding the order, so the list is stable.
+
+Names are checked against the repository databases cached on the host or
+in the install dir of a previous build, pacman sync databases or apt
+Packages lists, so typos fail the build before pacstrap or mmdebstrap
+start downloading. Without a cached database the names are not checked.
+The names of every database are indexed once per database version, and the
+resolved list is memoized by the hash of the manifests and databases.
+"""
+
+import difflib
+import glob
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import subprocess
+import tarfile
+
+INCLUDE = "@include"
+# Zstandard frame magic, for sync databases not compressed by tarfile.
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _hash(data) -> str:
+    """Return the hex SHA-256 digest of a JSON serialisable value."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def parse(path: str, sources: list = None, stack: list = None) -> list:  # type: ignore
+    """
+    Read a manifest and the manifests it includes.
+
+    Parameters
+    ----------
+        path (str): The manifest.
+        sources (list, optional): Filled with the (path, contents) of every manifest read. Defaults to None.
+        stack (list, optional): The manifests including this one. Defaults to None.
+
+    Raises
+    ------
+        ValueError: If a manifest includes itself or an include line names no file.
+        OSError: If a manifest cannot be read.
+
+    Returns
+    -------
+    list: (package, remove) in manifest order, remove True for -package lines.
+    """
+    path = os.path.realpath(path)
+    stack = stack or []
+    if path in stack:
+        raise ValueError(
+            "Package manifest "
+            + path
+            + " includes itself through "
+            + " -> ".join(stack)
+        )
+    with open(path, "r") as f:
+        contents = f.read()
+    if sources is not None:
+        sources.append((path, contents))
+    entries = []
+    for number, line in enumerate(contents.splitlines(), 1):
+        words = line.split("#", 1)[0].split()
+        if not words:
+            continue
+        if words[0] == INCLUDE:
+            if len(words) != 2:
+                raise ValueError(
+                    path + ":" + str(number) + ": " + INCLUDE + " takes one file"
+                )
+            included = os.path.join(os.path.dirname(path), words[1])
+            entries += parse(included, sources, stack + [path])
+            continue
+        for word in words:
+            if word.startswith("-"):
+                entries.append((word[1:], True))
+            else:
+                entries.append((word, False))
+    return entries
+
+
+def flatten(entries: list) -> tuple:
+    """
+    Apply removals and drop duplicates, keeping the first occurrence.
+
+    Parameters
+    ----------
+        entries (list): (package, remove) as returned by parse.
+
+    Returns
+    -------
+    tuple: The packages and the duplicates dropped.
+    """
+    packages = {}
+    duplicates = []
+    for package, remove in entries:
+        if remove:
+            packages.pop(package, None)
+        elif package in packages:
+            duplicates.append(package)
+        else:
+            packages[package] = True
+    return list(packages), duplicates
+
+
+def _pacman_databases(pacman_conf: str, install_dir: str) -> list:  # type: ignore
+    """
+    Find the cached sync database of every repository of a pacman config.
+
+    Returns
+    -------
+    list: The database files, None if a repository has none cached.
+    """
+    repos = []
+    db_path = "/var/lib/pacman/"
+    if pacman_conf is None or not os.path.isfile(pacman_conf):
+        return None  # type: ignore
+    section = None
+    with open(pacman_conf, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line.startswith("[") and line.endswith("]"):
+                section = line[1:-1]
+                if section != "options":
+                    repos.append(section)
+            elif section == "options" and line.split("=")[0].strip() == "DBPath":
+                db_path = line.split("=", 1)[1].strip()
+    if not repos:
+        return None  # type: ignore
+    sync_dirs = [
+        os.path.join(install_dir, "var/lib/pacman/sync"),
+        os.path.join(db_path, "sync"),
+    ]
+    databases = []
+    for repo in repos:
+        found = [
+            os.path.join(sync_dir, repo + ".db")
+            for sync_dir in sync_dirs
+            if os.path.isfile(os.path.join(sync_dir, repo + ".db"))
+        ]
+        if not found:
+            return None  # type: ignore
+        databases.append(max(found, key=os.path.getmtime))
+    return databases
+
+
+def _apt_databases(
+    suite: str, components: list, arch: str, install_dir: str
+) -> list:  # type: ignore
+    """
+    Find the cached Packages list of every component of a suite.
+
+    Returns
+    -------
+    list: The Packages files, None if a component has none cached.
+    """
+    if suite is None:
+        return None  # type: ignore
+    list_dirs = [os.path.join(install_dir, "var/lib/apt/lists"), "/var/lib/apt/lists"]
+    databases = []
+    for component in components or ["main"]:
+        pattern = "*_dists_" + suite + "_" + component + "_binary-" + arch + "_Packages"
+        found = []
+        for list_dir in list_dirs:
+            for ext in ["", ".gz", ".xz"]:
+                found += glob.glob(os.path.join(list_dir, pattern + ext))
+        if not found:
+            return None  # type: ignore
+        databases.append(max(found, key=os.path.getmtime))
+    return databases
+
+
+def _pacman_names(database: str) -> set:
+    """Names, provides and groups of the packages of a pacman sync database."""
+    names = set()
+    with open(database, "rb") as f:
+        zstd = f.read(4) == _ZSTD_MAGIC
+    proc = None
+    if zstd:
+        proc = subprocess.Popen(["zstd", "-dcq", database], stdout=subprocess.PIPE)
+        archive = tarfile.open(fileobj=proc.stdout, mode="r|")
+    else:
+        archive = tarfile.open(database, mode="r:*")
+    try:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith("/desc"):
+                continue
+            field = None
+            for line in archive.extractfile(member).read().decode().splitlines():
+                if line.startswith("%") and line.endswith("%"):
+                    field = line
+                elif not line:
+                    field = None
+                elif field in ("%NAME%", "%PROVIDES%", "%GROUPS%"):
+                    names.add(line.split("=")[0].split(">")[0].split("<")[0])
+    finally:
+        archive.close()
+        if proc is not None:
+            proc.stdout.close()
+            proc.wait()
+    return names
+
+
+def _apt_names(database: str) -> set:
+    """Names and provides of the packages of an apt Packages list."""
+    names = set()
+    opener = {".gz": gzip.open, ".xz": lzma.open}.get(
+        os.path.splitext(database)[1], open
+    )
+    with opener(database, "rt") as f:
+        for line in f:
+            if line.startswith("Package:"):
+                names.add(line.split(":", 1)[1].strip())
+            elif line.startswith("Provides:"):
+                for provided in line.split(":", 1)[1].split(","):
+                    names.add(provided.split()[0])
+    return names
+
+
+def _fingerprint(databases: list) -> list:
+    return [
+        [path, os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in databases
+    ]
+
+
+def index(databases: list, base: str, cache_dir: str) -> set:
+    """
+    Get the package names of repository databases, indexed once per version.
+
+    Parameters
+    ----------
+        databases (list): The pacman sync databases or apt Packages lists.
+        base (str): arch or debian.
+        cache_dir (str): Directory keeping the indexes, None to not keep them.
+
+    Returns
+    -------
+    set: The names packages can be installed by.
+    """
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(
+            cache_dir, "index-" + _hash([base, _fingerprint(databases)]) + ".json"
+        )
+    if path is not None and os.path.isfile(path):
+        with open(path, "r") as f:
+            return set(json.load(f))
+    names = set()
+    for database in databases:
+        names |= _pacman_names(database) if base == "arch" else _apt_names(database)
+    if path is None:
+        return names
+    os.makedirs(cache_dir, exist_ok=True)
+    # Builds sharing the cache may write the same index at once.
+    part = path + "." + str(os.getpid()) + ".part"
+    with open(part, "w") as f:
+        json.dump(sorted(names), f)
+    os.replace(part, path)
+    return names
+
+
+def _name(package: str, base: str) -> str:
+    """The package name of a pacstrap or mmdebstrap argument."""
+    if base == "arch":
+        # repo/package
+        return package.split("/")[-1]
+    # package=version, package/suite and package:arch
+    return package.split("=")[0].split("/")[0].split(":")[0]
+
+
+def check(packages: list, names: set, base: str) -> None:
+    """
+    Check that every package is in the repository databases.
+
+    Parameters
+    ----------
+        packages (list): The packages.
+        names (set): The names packages can be installed by, see index.
+        base (str): arch or debian.
+
+    Raises
+    ------
+        ValueError: Listing the unknown packages, with the closest known names.
+
+    Returns
+    -------
+    Nothing
+    """
+    unknown = []
+    for package in packages:
+        # apt patterns select packages by their fields, not by name.
+        if base == "debian" and ("?" in package or "~" in package):
+            continue
+        name = _name(package, base)
+        if name in names:
+            continue
+        close = difflib.get_close_matches(name, names, n=3)
+        unknown.append(
+            package + (" (did you mean " + ", ".join(close) + "?)" if close else "")
+        )
+    if unknown:
+        raise ValueError("Unknown packages: " + "; ".join(unknown))
+
+
+def resolve(
+    packages_file: str,
+    edition: str = None,  # type: ignore
+    base: str = "arch",
+    pacman_conf: str = None,  # type: ignore
+    suite: str = None,  # type: ignore
+    components: list = None,  # type: ignore
+    arch: str = None,  # type: ignore
+    install_dir: str = "/",
+    cache_dir: str = None,  # type: ignore
+    log=None,
+) -> list:
+    """
+    Resolve the package list of a build.
+
+    Parameters
+    ----------
+        packages_file (str): The manifest, packages.<arch> of the config directory.
+        edition (str, optional): Apply the packages_file.<edition> overlay if it exists. Defaults to None.
+        base (str, optional): arch or debian, the kind of repository database. Defaults to "arch".
+        pacman_conf (str, optional): The pacman config naming the repositories. Defaults to None.
+        suite (str, optional): The Debian suite. Defaults to None.
+        components (list, optional): The Debian components. Defaults to None.
+        arch (str, optional): The architecture of the Packages lists. Defaults to None.
+        install_dir (str, optional): Install dir of a previous build to find databases in. Defaults to "/".
+        cache_dir (str, optional): Directory memoizing indexes and resolved lists, None to not memoize. Defaults to None.
+        log (logging.Logger, optional): Where to report dropped duplicates and unchecked lists. Defaults to None.
+
+    Raises
+    ------
+        ValueError: If a manifest is invalid or lists unknown packages.
+        OSError: If a manifest cannot be read.
+
+    Returns
+    -------
+    list: The packages, deduplicated in manifest order.
+    """
+    sources = []
+    entries = parse(packages_file, sources)
+    overlay = packages_file + "." + edition if edition else None
+    if overlay is not None and os.path.isfile(overlay):
+        entries += parse(overlay, sources)
+    if base == "arch":
+        databases = _pacman_databases(pacman_conf, install_dir)
+    else:
+        databases = _apt_databases(suite, components, arch, install_dir)
+    key = _hash(
+        [base, sources, _fingerprint(databases) if databases is not None else None]
+    )
+    memo = os.path.join(cache_dir, key + ".json") if cache_dir is not None else None
+    if memo is not None and os.path.isfile(memo):
+        with open(memo, "r") as f:
+            return json.load(f)["packages"]
+    packages, duplicates = flatten(entries)
+    if duplicates and log is not None:
+        log.info("Dropped duplicate packages: " + " ".join(duplicates))
+    if databases is None:
+        if log is not None:
+            log.info("No cached repository database, package names not checked")
+        return packages
+    check(packages, index(databases, base, cache_dir), base)
+    if memo is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        part = memo + "." + str(os.getpid()) + ".part"
+        with open(part, "w") as f:
+            json.dump({"packages": packages, "sources": [p for p, _ in sources]}, f)
+        os.replace(part, memo)
+    return packages
@@ -0,0 +1,375 @@
+"""Stage and subprocess instrumentation for imageforge."""
+
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import resource
+import signal
+import subprocess
+import threading
+import time
+
+# Profiler of the stage running in the current thread, if any.
+_active = contextvars.ContextVar("imageforge_profiler", default=None)
+# Number of stages the current thread is nested in.
+_depth = contextvars.ContextVar("imageforge_stage_depth", default=0)
+
+
+def _proc_io(pid="self") -> dict:  # type: ignore
+    """Read the I/O counters of a process, empty if they are not available."""
+    try:
+        with open("/proc/" + str(pid) + "/io", "r") as f:
+            return {
+                key: int(value)
+                for key, value in (line.split(": ") for line in f.read().splitlines())
+            }
+    except (OSError, ValueError):
+        return {}
+
+
+def _io_delta(before: dict, after: dict) -> dict:
+    return {
+        "read_bytes": after.get("read_bytes", 0) - before.get("read_bytes", 0),
+        "write_bytes": after.get("write_bytes", 0) - before.get("write_bytes", 0),
+    }
+
+
+class Profiler:
+    """
+    Collects timings and resource usage of the stages and commands of a build.
+
+    Every stage records wall and CPU time, the bytes read from and written to
+    storage by the process and its reaped children and whether it failed.
+    Its max_rss_to_date is the peak RSS of imageforge or of its largest
+    reaped child since the build process started, not of the stage alone:
+    the kernel only keeps a lifetime high-water mark. Every command run
+    through run() records the same for the command and its descendants, with
+    its own peak RSS as max_rss, plus its exit code. After each top level stage a
+    JSON report and a Chrome trace are written to <report_base>.profile.json
+    and <report_base>.trace.json.
+    """
+
+    def __init__(self, report_base: str):
+        """
+        Parameters
+        ----------
+            report_base (str): Path of the reports without their extension.
+        """
+        self.report_base = report_base
+        self.start = time.time()
+        self.stages = []
+        self.commands = []
+        self.lock = threading.Lock()
+
+    def _record(self, kind: list, entry: dict) -> None:
+        with self.lock:
+            kind.append(entry)
+
+    def stage(self, name: str):
+        """
+        Profile a block of code as a stage.
+
+        Parameters
+        ----------
+            name (str): The name of the stage.
+
+        Returns
+        -------
+        A context manager.
+        """
+        return _Stage(self, name)
+
+    def report(self) -> dict:
+        """
+        Summarise the recorded stages and commands.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        dict: The report written to the .profile.json file.
+        """
+        with self.lock:
+            return {
+                "start": self.start,
+                "wall": time.time() - self.start,
+                "stages": list(self.stages),
+                "commands": list(self.commands),
+            }
+
+    def write(self) -> None:
+        """
+        Write the JSON report and the Chrome trace.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        Nothing
+        """
+        report = self.report()
+        events = []
+        for kind, entries in [("stage", report["stages"]), ("cmd", report["commands"])]:
+            for entry in entries:
+                events.append(
+                    {
+                        "name": entry["name"],
+                        "cat": kind,
+                        "ph": "X",
+                        "ts": int((entry["start"] - self.start) * 1e6),
+                        "dur": int(entry["wall"] * 1e6),
+                        "pid": os.getpid(),
+                        "tid": entry["thread"],
+                        "args": {
+                            k: v
+                            for k, v in entry.items()
+                            if k not in ["name", "start", "wall", "thread"]
+                        },
+                    }
+                )
+        for suffix, data in [
+            (".profile.json", report),
+            (".trace.json", {"traceEvents": events, "displayTimeUnit": "ms"}),
+        ]:
+            with open(self.report_base + suffix + ".tmp", "w") as f:
+                json.dump(data, f, indent=1)
+            os.replace(self.report_base + suffix + ".tmp", self.report_base + suffix)
+
+
+class _Stage:
+    def __init__(self, profiler: Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.depth = _depth.get()
+        self.tokens = (_active.set(self.profiler), _depth.set(self.depth + 1))
+        self.io = _proc_io()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start = time.time()
+        self.wall = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.monotonic() - self.wall
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = 0.0
+        for before, after in [
+            (self.self_usage, self_usage),
+            (self.child_usage, child_usage),
+        ]:
+            cpu += after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+        entry = {
+            "name": self.name,
+            "start": self.start,
+            "wall": wall,
+            "cpu": cpu,
+            # Lifetime high-water marks, see the class docstring.
+            "max_rss_to_date": max(self_usage.ru_maxrss, child_usage.ru_maxrss),
+            "depth": self.depth,
+            "thread": threading.get_ident(),
+            "failed": exc_type is not None,
+        }
+        entry.update(_io_delta(self.io, _proc_io()))
+        self.profiler._record(self.profiler.stages, entry)
+        _active.reset(self.tokens[0])
+        _depth.reset(self.tokens[1])
+        logging.debug(
+            "Stage %s took %.2fs wall, %.2fs CPU" % (self.name, wall, cpu),
+        )
+        if self.depth == 0:
+            self.profiler.write()
+        return False
+
+
+def stage(func):
+    """
+    Decorator profiling a pipeline function as a stage of its build.
+
+    The build is the ctx argument of the call, passed by keyword or by
+    position, or the current one. Nothing is recorded when it has profiling
+    disabled.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        from .config import resolve
+
+        try:
+            ctx = signature.bind_partial(*args, **kwargs).arguments.get("ctx")
+        except TypeError:
+            # Let the call itself report the bad arguments.
+            ctx = None
+        try:
+            profiler = resolve(ctx).profiler
+        except RuntimeError:
+            profiler = None
+        if profiler is None:
+            return func(*args, **kwargs)
+        with profiler.stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _drain(pipe, out: list, log: logging.Logger = None, prefix: str = "") -> None:  # type: ignore
+    if log is None:
+        out.append(pipe.read())
+    else:
+        lines = []
+        for line in pipe:
+            lines.append(line)
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", "replace")
+            log.info(prefix + line.rstrip("\n"))
+        out.append(lines[0][:0].join(lines) if lines else pipe.read())
+    pipe.close()
+
+
+def _feed(pipe, data: bytes) -> None:
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def run(
+    cmd,
+    input: bytes = None,
+    check: bool = False,
+    capture_output: bool = False,
+    text: bool = False,
+    timeout: float = None,
+    log: logging.Logger = None,
+    **kwargs,
+) -> subprocess.CompletedProcess:  # type: ignore
+    """
+    Run a command like subprocess.run, profiling it in the running stage.
+
+    Commands are argv lists, no shell is forked in between. The I/O counters
+    of the command are read once it exited but before it is reaped, so they
+    include all of its descendants. With a log, the output of the command
+    is written to it line by line while it runs, so long running tools show
+    their progress in the build log.
+
+    Parameters
+    ----------
+        cmd (list): The argv of the command.
+        input (bytes, optional): Written to the stdin of the command. Defaults to None.
+        check (bool, optional): Raise when the command fails. Defaults to False.
+        capture_output (bool, optional): Capture stdout and stderr. Defaults to False.
+        text (bool, optional): Decode captured output. Defaults to False.
+        timeout (float, optional): Seconds after which the command and the
+            processes it started are killed. Defaults to None.
+        log (logging.Logger, optional): Capture stdout and stderr and log
+            them line by line at info level as they come. Defaults to None.
+        **kwargs: Passed on to subprocess.Popen.
+
+    Raises
+    ------
+        TypeError: If the command is a string or shell=True is passed.
+        subprocess.CalledProcessError: If check is set and the command fails.
+        subprocess.TimeoutExpired: If the command ran longer than timeout.
+
+    Returns
+    -------
+    subprocess.CompletedProcess: The result of the command.
+    """
+    if isinstance(cmd, str) or kwargs.get("shell"):
+        raise TypeError("Commands are run as argv lists, without a shell")
+    profiler = _active.get()
+    name = os.path.basename(str(cmd[0]))
+    if capture_output or log is not None:
+        kwargs.setdefault("stdout", subprocess.PIPE)
+        kwargs.setdefault("stderr", subprocess.PIPE)
+    if timeout is not None:
+        # In a process group of its own, so it is killed with its children.
+        kwargs.setdefault("start_new_session", True)
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    start = time.time()
+    wall = time.monotonic()
+    proc = subprocess.Popen(cmd, text=text, **kwargs)
+    outputs = {}
+    drains = []
+    if input is not None:
+        drains.append(threading.Thread(target=_feed, args=(proc.stdin, input)))
+        drains[-1].start()
+    for stream in ["stdout", "stderr"]:
+        if getattr(proc, stream) is not None:
+            outputs[stream] = []
+            drains.append(
+                threading.Thread(
+                    target=_drain,
+                    args=(getattr(proc, stream), outputs[stream], log, name + ": "),
+                )
+            )
+            drains[-1].start()
+    timer = None
+    expired = threading.Event()
+    if timeout is not None:
+
+        def expire() -> None:
+            expired.set()
+            try:
+                if kwargs["start_new_session"]:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                else:
+                    proc.kill()
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+    # Wait for the exit without reaping, so /proc/<pid>/io is still readable.
+    os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+    io = _proc_io(proc.pid)
+    _, status, usage = os.wait4(proc.pid, 0)
+    # os.waitstatus_to_exitcode needs Python 3.9.
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    if timer is not None:
+        timer.cancel()
+    for drain in drains:
+        drain.join()
+    if profiler is not None:
+        entry = {
+            "name": name,
+            "argv": [str(arg) for arg in cmd],
+            "start": start,
+            "wall": time.monotonic() - wall,
+            "cpu": usage.ru_utime + usage.ru_stime,
+            "max_rss": usage.ru_maxrss,
+            "thread": threading.get_ident(),
+            "returncode": proc.returncode,
+        }
+        entry.update(_io_delta({}, io))
+        profiler._record(profiler.commands, entry)
+    result = subprocess.CompletedProcess(
+        cmd,
+        proc.returncode,
+        outputs["stdout"][0] if "stdout" in outputs else None,
+        outputs["stderr"][0] if "stderr" in outputs else None,
+    )
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, result.stdout, result.stderr)
+    if check:
+        result.check_returncode()
+    return result
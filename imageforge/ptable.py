@@ -0,0 +1,428 @@
+"""In-process GPT and MBR partition tables for imageforge.
+
+Reads and writes partition tables of image files and block devices without
+parted, placing partitions like parted --align optimal does: starts on 1MiB
+boundaries, locations in parted units (s, B, kB, MB, MiB, ..., %, negative
+from the end of the disk, MB when no unit is given).
+"""
+
+import os
+import struct
+import uuid
+import zlib
+from .reproducible import stable_uuid
+
+SECTOR_SIZE = 512
+# Partitions start on multiples of this many sectors, 1MiB.
+ALIGNMENT = 2048
+# Number and size of GPT partition entries, 32 sectors of them.
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_ENTRY_SECTORS = GPT_ENTRIES * GPT_ENTRY_SIZE // SECTOR_SIZE
+
+GPT_TYPES = {
+    "esp": "C12A7328-F81F-11D2-BA4B-00A0C93EC93B",
+    "fat32": "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7",
+    "linux-swap": "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F",
+    "linux": "0FC63DAF-8483-4772-8E79-3D69D8477DE4",
+}
+MBR_TYPES = {
+    "esp": 0xEF,
+    "fat32": 0x0C,
+    "linux-swap": 0x82,
+    "linux": 0x83,
+}
+
+UNITS = {
+    "s": SECTOR_SIZE,
+    "b": 1,
+    "k": 1000,
+    "kb": 1000,
+    "m": 1000**2,
+    "mb": 1000**2,
+    "g": 1000**3,
+    "gb": 1000**3,
+    "t": 1000**4,
+    "tb": 1000**4,
+    "kib": 1024,
+    "mib": 1024**2,
+    "gib": 1024**3,
+    "tib": 1024**4,
+}
+
+_GPT_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+_GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+_MBR_ENTRY = struct.Struct("<B3sB3sII")
+
+
+def parse_location(value, disk_size: int) -> int:
+    """
+    Convert a parted location to a byte offset.
+
+    Parameters
+    ----------
+        value (str or int): The location, e.g. "1MiB", "100%", "-34s" or 256 (MB).
+        disk_size (int): Size of the disk in bytes.
+
+    Raises
+    ------
+        ValueError: If the location cannot be parsed.
+
+    Returns
+    -------
+    int: The byte offset.
+    """
+    text = str(value).strip().lower()
+    if text.endswith("%"):
+        return int(disk_size * float(text[:-1]) / 100)
+    number = text.rstrip("abcdefghijklmnopqrstuvwxyz")
+    unit = text[len(number) :] or "mb"
+    if unit not in UNITS or not number:
+        raise ValueError("Invalid location " + str(value))
+    offset = int(float(number) * UNITS[unit])
+    return disk_size + offset if number.startswith("-") else offset
+
+
+def disk_sectors(path: str) -> int:
+    """
+    Get the size of an image file or block device in sectors.
+
+    Parameters
+    ----------
+        path (str): The image file or block device.
+
+    Returns
+    -------
+    int: The number of sectors.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END) // SECTOR_SIZE
+    finally:
+        os.close(fd)
+
+
+def new_table(label: str, sectors: int) -> dict:
+    """
+    Create an empty partition table.
+
+    Parameters
+    ----------
+        label (str): "gpt" or "msdos".
+        sectors (int): Size of the disk in sectors.
+
+    Returns
+    -------
+    dict: The table, see read_table.
+    """
+    if label not in ["gpt", "msdos"]:
+        raise ValueError("Unsupported partition table " + label)
+    return {
+        "label": label,
+        "sectors": sectors,
+        "disk_id": (
+            str(uuid.uuid4()).upper()
+            if label == "gpt"
+            else "%08x" % struct.unpack("<I", os.urandom(4))[0]
+        ),
+        "partitions": [],
+    }
+
+
+def usable(table: dict) -> tuple:
+    """
+    Get the first and last sector partitions may use.
+
+    Parameters
+    ----------
+        table (dict): The table.
+
+    Returns
+    -------
+    tuple: The first and last usable sector.
+    """
+    if table["label"] == "gpt":
+        return 2 + GPT_ENTRY_SECTORS, table["sectors"] - 2 - GPT_ENTRY_SECTORS
+    return 1, min(table["sectors"], 2**32) - 1
+
+
+def add_partition(
+    table: dict, start, end, fs: str, boot: bool = False, esp: bool = False
+) -> dict:
+    """
+    Add a partition like parted mkpart with optimal alignment does.
+
+    The start is aligned up to 1MiB and moved behind the partitions before
+    it, the end is the sector before the end location, within the disk.
+
+    Parameters
+    ----------
+        table (dict): The table to add to.
+        start (str or int): Start location in parted units.
+        end (str or int): End location in parted units.
+        fs (str): Filesystem type as given to mkpart, e.g. "fat32" or "ext4".
+        boot (bool, optional): Set the boot flag, ESP for fat32 on GPT. Defaults to False.
+        esp (bool, optional): Set the esp flag. Defaults to False.
+
+    Raises
+    ------
+        ValueError: If the partition does not fit.
+
+    Returns
+    -------
+    dict: The added partition.
+    """
+    size = table["sectors"] * SECTOR_SIZE
+    first, last = usable(table)
+    numbers = [part["number"] for part in table["partitions"]]
+    limit = GPT_ENTRIES if table["label"] == "gpt" else 4
+    number = next((n for n in range(1, limit + 1) if n not in numbers), None)
+    if number is None:
+        raise ValueError("Partition table is full")
+    start_sector = -(-parse_location(start, size) // SECTOR_SIZE)
+    for part in sorted(table["partitions"], key=lambda p: p["start"]):
+        if part["start"] <= start_sector <= part["end"]:
+            start_sector = part["end"] + 1
+    start_sector = max(start_sector, first)
+    start_sector = -(-start_sector // ALIGNMENT) * ALIGNMENT
+    end_sector = min(parse_location(end, size) // SECTOR_SIZE - 1, last)
+    for part in table["partitions"]:
+        if start_sector < part["start"] <= end_sector:
+            end_sector = part["start"] - 1
+    if end_sector < start_sector:
+        raise ValueError(
+            "Partition " + str(start) + "-" + str(end) + " does not fit the disk"
+        )
+    if table["label"] == "gpt":
+        kind = "esp" if esp or (boot and fs == "fat32") else fs
+        ptype = GPT_TYPES.get(kind, GPT_TYPES["linux"])
+    else:
+        kind = "esp" if esp else fs
+        ptype = MBR_TYPES.get(kind, MBR_TYPES["linux"])
+    part = {
+        "number": number,
+        "start": start_sector,
+        "end": end_sector,
+        "type": ptype,
+        "uuid": str(uuid.uuid4()).upper(),
+        "name": "primary",
+        "bootable": boot,
+    }
+    table["partitions"].append(part)
+    table["partitions"].sort(key=lambda p: p["number"])
+    return part
+
+
+def pin_ids(table: dict, seed: str) -> None:
+    """
+    Derive the disk identifier and partition UUIDs of a table from a seed.
+
+    Parameters
+    ----------
+        table (dict): The table, see read_table.
+        seed (str): The build seed, see reproducible.build_seed.
+
+    Returns
+    -------
+    Nothing
+    """
+    disk_id = stable_uuid(seed + "/disk")
+    if table["label"] == "gpt":
+        table["disk_id"] = str(disk_id).upper()
+    else:
+        table["disk_id"] = "%08x" % (disk_id.int >> 96)
+    for part in table["partitions"]:
+        part["uuid"] = str(stable_uuid(seed + "/part" + str(part["number"]))).upper()
+
+
+def _gpt_header(table: dict, current: int, backup: int, entries: int, crc: int):
+    first, last = usable(table)
+    fields = [
+        b"EFI PART",
+        0x00010000,
+        _GPT_HEADER.size,
+        0,
+        0,
+        current,
+        backup,
+        first,
+        last,
+        uuid.UUID(table["disk_id"]).bytes_le,
+        entries,
+        GPT_ENTRIES,
+        GPT_ENTRY_SIZE,
+        crc,
+    ]
+    fields[3] = zlib.crc32(_GPT_HEADER.pack(*fields))
+    return _GPT_HEADER.pack(*fields).ljust(SECTOR_SIZE, b"\0")
+
+
+def _mbr_entry(bootable: bool, ptype: int, start: int, sectors: int) -> bytes:
+    # CHS addresses are left at their maximum, everything uses the LBA ones.
+    return _MBR_ENTRY.pack(
+        0x80 if bootable else 0, b"\xfe\xff\xff", ptype, b"\xfe\xff\xff", start, sectors
+    )
+
+
+def write_table(path: str, table: dict) -> None:
+    """
+    Write a partition table to an image file or block device.
+
+    The boot code in the first sector is kept, a table of the other kind is
+    wiped.
+
+    Parameters
+    ----------
+        path (str): The image file or block device.
+        table (dict): The table.
+
+    Returns
+    -------
+    Nothing
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        sectors = table["sectors"]
+        mbr = bytearray(os.pread(fd, SECTOR_SIZE, 0).ljust(SECTOR_SIZE, b"\0"))
+        if table["label"] == "gpt":
+            entries = bytearray(GPT_ENTRIES * GPT_ENTRY_SIZE)
+            for part in table["partitions"]:
+                name = part["name"].encode("utf-16-le")[:72]
+                _GPT_ENTRY.pack_into(
+                    entries,
+                    (part["number"] - 1) * GPT_ENTRY_SIZE,
+                    uuid.UUID(part["type"]).bytes_le,
+                    uuid.UUID(part["uuid"]).bytes_le,
+                    part["start"],
+                    part["end"],
+                    0,
+                    name,
+                )
+            crc = zlib.crc32(entries)
+            backup = sectors - 1
+            backup_entries = sectors - 1 - GPT_ENTRY_SECTORS
+            mbr[446:510] = _mbr_entry(
+                False, 0xEE, 1, min(sectors - 1, 0xFFFFFFFF)
+            ) + bytes(48)
+            mbr[440:444] = bytes(4)
+            os.pwrite(fd, _gpt_header(table, 1, backup, 2, crc), SECTOR_SIZE)
+            os.pwrite(fd, entries, 2 * SECTOR_SIZE)
+            os.pwrite(fd, entries, backup_entries * SECTOR_SIZE)
+            os.pwrite(
+                fd,
+                _gpt_header(table, backup, 1, backup_entries, crc),
+                backup * SECTOR_SIZE,
+            )
+        else:
+            entries = bytearray(64)
+            for part in table["partitions"]:
+                entries[(part["number"] - 1) * 16 : part["number"] * 16] = _mbr_entry(
+                    part["bootable"],
+                    part["type"],
+                    part["start"],
+                    part["end"] - part["start"] + 1,
+                )
+            mbr[440:444] = bytes.fromhex(table["disk_id"])[::-1]
+            mbr[446:510] = entries
+            # Wipe both GPT headers, so the disk is not taken for GPT.
+            for sector in [1, sectors - 1]:
+                if os.pread(fd, 8, sector * SECTOR_SIZE) == b"EFI PART":
+                    os.pwrite(fd, bytes(SECTOR_SIZE), sector * SECTOR_SIZE)
+        mbr[510:512] = b"\x55\xaa"
+        os.pwrite(fd, bytes(mbr), 0)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_table(path: str) -> dict:  # type: ignore
+    """
+    Read the partition table of an image file or block device.
+
+    Parameters
+    ----------
+        path (str): The image file or block device.
+
+    Returns
+    -------
+    dict: The "label" ("gpt" or "msdos"), size in "sectors", "disk_id" and
+    "partitions", each with its "number", "start" and (inclusive) "end"
+    sector, "type" (GUID or MBR type), "uuid", "name" and "bootable" flag.
+    None if the disk has no valid table.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        sectors = os.lseek(fd, 0, os.SEEK_END) // SECTOR_SIZE
+        mbr = os.pread(fd, SECTOR_SIZE, 0)
+        if len(mbr) < SECTOR_SIZE or mbr[510:512] != b"\x55\xaa":
+            return None  # type: ignore
+        if mbr[450] == 0xEE:
+            return _read_gpt(fd, sectors)
+        table = {
+            "label": "msdos",
+            "sectors": sectors,
+            "disk_id": mbr[440:444][::-1].hex(),
+            "partitions": [],
+        }
+        for i in range(4):
+            status, _, ptype, _, start, count = _MBR_ENTRY.unpack_from(
+                mbr, 446 + 16 * i
+            )
+            if ptype == 0 or count == 0:
+                continue
+            table["partitions"].append(
+                {
+                    "number": i + 1,
+                    "start": start,
+                    "end": start + count - 1,
+                    "type": ptype,
+                    "uuid": table["disk_id"] + "-" + "%02x" % (i + 1),
+                    "name": "",
+                    "bootable": status == 0x80,
+                }
+            )
+        return table
+    finally:
+        os.close(fd)
+
+
+def _read_gpt(fd: int, sectors: int) -> dict:  # type: ignore
+    """Read the primary GPT, falling back to the backup one."""
+    for lba in [1, sectors - 1]:
+        header = os.pread(fd, _GPT_HEADER.size, lba * SECTOR_SIZE)
+        if len(header) < _GPT_HEADER.size:
+            continue
+        fields = list(_GPT_HEADER.unpack(header))
+        crc = fields[3]
+        fields[3] = 0
+        if fields[0] != b"EFI PART" or zlib.crc32(_GPT_HEADER.pack(*fields)) != crc:
+            continue
+        count, size = fields[11], fields[12]
+        entries = os.pread(fd, count * size, fields[10] * SECTOR_SIZE)
+        if zlib.crc32(entries) != fields[13]:
+            continue
+        table = {
+            "label": "gpt",
+            "sectors": sectors,
+            "disk_id": str(uuid.UUID(bytes_le=fields[9])).upper(),
+            "partitions": [],
+        }
+        for i in range(count):
+            ptype, puuid, start, end, _, name = _GPT_ENTRY.unpack_from(
+                entries, i * size
+            )
+            if ptype == bytes(16):
+                continue
+            table["partitions"].append(
+                {
+                    "number": i + 1,
+                    "start": start,
+                    "end": end,
+                    "type": str(uuid.UUID(bytes_le=ptype)).upper(),
+                    "uuid": str(uuid.UUID(bytes_le=puuid)).upper(),
+                    "name": name.decode("utf-16-le").rstrip("\0"),
+                    "bootable": False,
+                }
+            )
+        return table
+    return None  # type: ignore
@@ -0,0 +1,196 @@
+"""Reproducible builds for imageforge.
+
+With the reproducible config, everything a build would otherwise pick at
+random or from the clock is derived from the config or pinned to its epoch
+(SOURCE_DATE_EPOCH): the partition table, filesystem UUIDs and ext4 hash
+seeds are name based UUIDs of a seed made of the config, the mkfs tools
+get the epoch as their time, file times are clamped to it and files that
+record the build, like the machine ID or package manager logs, are removed
+or emptied. Two builds of the same config and packages then give the same
+bytes with the mkfs image backend, so their artifacts deduplicate.
+"""
+
+import logging
+import os
+import subprocess
+import uuid
+from .profiling import run
+
+# 1980-01-01, the oldest time FAT can store.
+DEFAULT_EPOCH = 315532800
+# Namespace of the UUIDs derived from build seeds.
+NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://github.com/ameriDroid/imageforge")
+# Config keys a build seed is made of.
+SEED_KEYS = ["img_name", "img_version", "arch", "edition", "fs", "part_type"]
+
+# Files recording the machine or the build, relative to the rootfs.
+REMOVE = [
+    "etc/machine-id",
+    "var/lib/dbus/machine-id",
+    "var/lib/systemd/random-seed",
+    "var/lib/systemd/credential.secret",
+    "var/cache/ldconfig/aux-cache",
+    "etc/.pwd.lock",
+]
+# Logs kept, but emptied, as packages expect them to exist.
+TRUNCATE = [
+    "var/log/pacman.log",
+    "var/log/dpkg.log",
+    "var/log/alternatives.log",
+    "var/log/bootstrap.log",
+    "var/log/apt/history.log",
+    "var/log/apt/term.log",
+    "var/log/apt/eipp.log.xz",
+]
+
+
+def build_seed(cfg) -> str:
+    """
+    Make the seed every identifier of a reproducible build is derived from.
+
+    Parameters
+    ----------
+        cfg (BuildContext): The build.
+
+    Returns
+    -------
+    str: The seed, the same for every build of the same config.
+    """
+    return "\0".join(str(cfg[key]) for key in SEED_KEYS)
+
+
+def stable_uuid(seed: str) -> uuid.UUID:
+    """
+    Derive a UUID from a seed.
+
+    Parameters
+    ----------
+        seed (str): The seed, unique to what the UUID identifies.
+
+    Returns
+    -------
+    uuid.UUID: A name based (version 5) UUID.
+    """
+    return uuid.uuid5(NAMESPACE, seed)
+
+
+def environment(epoch: int) -> dict:
+    """
+    The environment of a tool that should take its times from the epoch.
+
+    Parameters
+    ----------
+        epoch (int): The timestamp.
+
+    Returns
+    -------
+    dict: The environment of imageforge with the epoch set.
+    """
+    return dict(
+        os.environ,
+        SOURCE_DATE_EPOCH=str(epoch),
+        # e2fsprogs takes its time from here, not from SOURCE_DATE_EPOCH.
+        E2FSPROGS_FAKE_TIME=str(epoch),
+    )
+
+
+def normalize(tree: str, epoch: int) -> int:
+    """
+    Clamp the access and modification times of a tree to the epoch.
+
+    Times older than the epoch are kept, so files keep the times their
+    packages gave them, and the access time is set to the modification time.
+
+    Parameters
+    ----------
+        tree (str): The tree.
+        epoch (int): The timestamp.
+
+    Returns
+    -------
+    int: The number of entries whose times were changed.
+    """
+    limit = epoch * 10**9
+    changed = 0
+    # Bottom up, listing a directory after setting its times would change them.
+    for path, dirs, files in os.walk(tree, topdown=False):
+        for name in dirs + files + ([""] if path == tree else []):
+            entry = os.path.join(path, name) if name else path
+            st = os.lstat(entry)
+            mtime = min(st.st_mtime_ns, limit)
+            if st.st_atime_ns != mtime or st.st_mtime_ns != mtime:
+                os.utime(entry, ns=(mtime, mtime), follow_symlinks=False)
+                changed += 1
+    return changed
+
+
+def clean(root: str) -> list:
+    """
+    Remove the files of a rootfs that record the machine or the build.
+
+    Parameters
+    ----------
+        root (str): The rootfs.
+
+    Returns
+    -------
+    list: The files removed or emptied, relative to the rootfs.
+    """
+    cleaned = []
+    for rel in REMOVE:
+        path = os.path.join(root, rel)
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.remove(path)
+            cleaned.append(rel)
+    for rel in TRUNCATE:
+        path = os.path.join(root, rel)
+        if os.path.isfile(path) and not os.path.islink(path):
+            os.truncate(path, 0)
+            cleaned.append(rel)
+    logging.debug("Cleaned " + ", ".join(cleaned))
+    return cleaned
+
+
+def pin_ext4_times(image: str, tree: str, epoch: int) -> None:
+    """
+    Set the change times of an ext4 image generated by mke2fs -d to the epoch.
+
+    mke2fs copies the change times of the tree, which only the kernel sets,
+    so debugfs rewrites them in the image.
+
+    Parameters
+    ----------
+        image (str): The filesystem image.
+        tree (str): The tree it was generated from.
+        epoch (int): The timestamp.
+
+    Returns
+    -------
+    Nothing
+    """
+    commands = []
+    for path, dirs, files in os.walk(tree):
+        dirs.sort()
+        # Directories are visited themselves, except symlinks to them.
+        links = [name for name in dirs if os.path.islink(os.path.join(path, name))]
+        for name in [""] + sorted(files + links):
+            rel = os.path.normpath(
+                "/" + os.path.relpath(os.path.join(path, name), tree)
+            )
+            if '"' in rel or "\n" in rel:
+                logging.warning("Cannot pin the change time of " + rel)
+                continue
+            commands.append('sif "' + rel + '" ctime @' + str(epoch))
+    script = image + ".debugfs"
+    with open(script, "w") as f:
+        f.write("\n".join(commands) + "\n")
+    try:
+        run(
+            ["debugfs", "-w", "-f", script, image],
+            env=environment(epoch),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    finally:
+        os.remove(script)
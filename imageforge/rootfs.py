@@ -0,0 +1,207 @@
+"""Rootfs exports for imageforge.
+
+The install dir is exported as a tree, without building a disk image: a
+tar stream compressed like images are (a .tar.zst with zstd compression),
+a squashfs or an erofs image. Outputs are deterministic: entries are
+ordered by name, the contents of proc are left out like get_size does, and
+with an epoch (SOURCE_DATE_EPOCH) no timestamp is newer than it (tar) or
+every timestamp is it (squashfs and erofs, which can only set them).
+"""
+
+import os
+import subprocess
+from .compression import compress_stream
+from .profiling import run
+from .sparse import CHUNK_SIZE
+
+# Formats and the extension of their outputs, tar gets the compression one too.
+FORMATS = {"tar": ".tar", "squashfs": ".sqfs", "erofs": ".erofs"}
+# Directories whose contents are not exported, relative to the rootfs.
+EXCLUDE = ["proc"]
+
+
+def tar_argv(root: str, epoch: int = None) -> list:  # type: ignore
+    """
+    Build the command line of a deterministic tar of a rootfs, written to stdout.
+
+    Parameters
+    ----------
+        root (str): The rootfs.
+        epoch (int, optional): Clamp the mtimes to this timestamp. Defaults to None.
+
+    Returns
+    -------
+    list: The tar argv.
+    """
+    argv = [
+        "tar",
+        "--create",
+        "--file=-",
+        "--format=posix",
+        # No pids, access or change times in the extended headers.
+        "--pax-option=exthdr.name=%d/PaxHeaders/%f,delete=atime,delete=ctime",
+        "--sort=name",
+        "--numeric-owner",
+        "--xattrs",
+        "--xattrs-include=*",
+        "--acls",
+        "--anchored",
+    ]
+    argv += ["--exclude=./" + directory + "/*" for directory in EXCLUDE]
+    if epoch is not None:
+        argv += ["--mtime=@" + str(epoch), "--clamp-mtime"]
+    return argv + ["-C", root, "."]
+
+
+def squashfs_argv(
+    root: str, dst: str, epoch: int = None, fast: bool = False, threads: int = 0  # type: ignore
+) -> list:
+    """
+    Build the command line of mksquashfs for a rootfs.
+
+    Parameters
+    ----------
+        root (str): The rootfs.
+        dst (str): The squashfs image to write.
+        epoch (int, optional): Set every timestamp to this one. Defaults to None.
+        fast (bool, optional): Use the fast compression level. Defaults to False.
+        threads (int, optional): Compressor threads, 0 for all cores. Defaults to 0.
+
+    Returns
+    -------
+    list: The mksquashfs argv.
+    """
+    argv = [
+        "mksquashfs",
+        root,
+        dst,
+        "-noappend",
+        "-quiet",
+        "-comp",
+        "zstd",
+        "-xattrs",
+        "-processors",
+        str(threads if threads > 0 else os.cpu_count() or 1),
+        "-wildcards",
+    ]
+    for directory in EXCLUDE:
+        argv += ["-e", directory + "/*"]
+    if fast:
+        argv += ["-Xcompression-level", "1"]
+    if epoch is not None:
+        argv += ["-mkfs-time", str(epoch), "-all-time", str(epoch)]
+    return argv
+
+
+def erofs_argv(
+    root: str, dst: str, epoch: int = None, fast: bool = False, threads: int = 0  # type: ignore
+) -> list:
+    """
+    Build the command line of mkfs.erofs for a rootfs.
+
+    Parameters
+    ----------
+        root (str): The rootfs.
+        dst (str): The erofs image to write.
+        epoch (int, optional): Set every timestamp to this one. Defaults to None.
+        fast (bool, optional): Use lz4 instead of lz4hc. Defaults to False.
+        threads (int, optional): Compressor threads, 0 for all cores. Defaults to 0.
+
+    Returns
+    -------
+    list: The mkfs.erofs argv.
+    """
+    argv = ["mkfs.erofs", "-zlz4" if fast else "-zlz4hc", "--quiet"]
+    argv += ["--exclude-regex=^" + directory + "/.+" for directory in EXCLUDE]
+    help_text = run(
+        ["mkfs.erofs", "--help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    ).stdout.decode("utf-8", "replace")
+    # Multithreaded compression came with erofs-utils 1.8.
+    if "--workers" in help_text:
+        argv.append("--workers=" + str(threads if threads > 0 else os.cpu_count() or 1))
+    if epoch is not None:
+        argv.append("-T" + str(epoch))
+    return argv + [dst, root]
+
+
+def write_tar(
+    root: str,
+    outputs: dict,
+    epoch: int = None,  # type: ignore
+    fast: bool = False,
+    seekable: bool = False,
+    digests: dict = None,  # type: ignore
+    tar_digests=None,
+) -> None:
+    """
+    Stream a rootfs as a tar into every compression format at once.
+
+    Parameters
+    ----------
+        root (str): The rootfs.
+        outputs (dict): Mapping of compression format to destination path.
+        epoch (int, optional): Clamp the mtimes to this timestamp. Defaults to None.
+        fast (bool, optional): Use the fast compression level. Defaults to False.
+        seekable (bool, optional): Write seekable outputs, see compress_stream. Defaults to False.
+        digests (dict, optional): Digests of the outputs, see compress_stream. Defaults to None.
+        tar_digests (Digests, optional): Updated with the uncompressed tar. Defaults to None.
+
+    Raises
+    ------
+        subprocess.CalledProcessError: If tar or a compressor fails.
+
+    Returns
+    -------
+    Nothing
+    """
+    proc = subprocess.Popen(tar_argv(root, epoch), stdout=subprocess.PIPE)
+    chunks = iter(lambda: proc.stdout.read(CHUNK_SIZE), b"")
+    if tar_digests is not None:
+        chunks = tar_digests.track(chunks)
+    try:
+        compress_stream(chunks, outputs, fast=fast, seekable=seekable, digests=digests)
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    # 1 means files changed while they were read.
+    if proc.returncode > 1:
+        for dst in outputs.values():
+            os.remove(dst)
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def write_image(
+    fmt: str, root: str, dst: str, epoch: int = None, fast: bool = False  # type: ignore
+) -> None:
+    """
+    Write a rootfs as a squashfs or erofs image.
+
+    Parameters
+    ----------
+        fmt (str): squashfs or erofs.
+        root (str): The rootfs.
+        dst (str): The image to write.
+        epoch (int, optional): Set every timestamp to this one. Defaults to None.
+        fast (bool, optional): Compress faster. Defaults to False.
+
+    Raises
+    ------
+        subprocess.CalledProcessError: If the tool fails.
+
+    Returns
+    -------
+    Nothing
+    """
+    argv_of = {"squashfs": squashfs_argv, "erofs": erofs_argv}[fmt]
+    if os.path.exists(dst + ".part"):
+        os.remove(dst + ".part")
+    try:
+        run(argv_of(root, dst + ".part", epoch, fast), check=True)
+    except BaseException:
+        if os.path.exists(dst + ".part"):
+            os.remove(dst + ".part")
+        raise
+    os.replace(dst + ".part", dst)
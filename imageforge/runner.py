@@ -0,0 +1,109 @@
+"""Concurrent command and step execution for imageforge.
+
+Commands are run by profiling.run, argv only: no shell is forked in
+between, and run_async awaits them from a coroutine. run_graph executes a
+small DAG of steps, each starting as soon as the steps it depends on are
+done, so independent steps of a stage overlap. Commands and steps run in
+threads of an asyncio loop in the context of the caller, so they keep being
+profiled in the stage that runs them.
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .profiling import run
+
+
+async def _in_thread(pool: ThreadPoolExecutor, func, *args, **kwargs):
+    """Run a function in the pool, in the context of the caller."""
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(pool, call)
+
+
+async def run_async(cmd: list, **kwargs):
+    """
+    Run a command without blocking the event loop, see profiling.run.
+
+    Parameters
+    ----------
+        cmd (list): The argv of the command.
+        **kwargs: Passed on to profiling.run, e.g. check, timeout or log.
+
+    Raises
+    ------
+        TypeError: If the command is a string or shell=True is passed.
+
+    Returns
+    -------
+    subprocess.CompletedProcess: The result of the command.
+    """
+    return await _in_thread(None, run, cmd, **kwargs)
+
+
+def run_graph(steps: dict, jobs: int = 0) -> dict:
+    """
+    Run steps concurrently, each once the steps it depends on are done.
+
+    A step is a function without arguments, run in a thread. When a step
+    fails, the steps depending on it are not run, the others finish and the
+    first error is raised.
+
+    Parameters
+    ----------
+        steps (dict): (function, dependencies) of every step name, the
+            dependencies a list of step names.
+        jobs (int, optional): Steps run at once, 0 for cores + 4 up to 32. Defaults to 0.
+
+    Raises
+    ------
+        ValueError: If a dependency is unknown or the steps depend on each other in a cycle.
+
+    Returns
+    -------
+    dict: The return value of every step.
+    """
+    if not steps:
+        return {}
+    for name, (_, deps) in steps.items():
+        for dep in deps:
+            if dep not in steps:
+                raise ValueError("Step " + name + " depends on unknown step " + dep)
+    order = []
+    done = set()
+    while len(order) < len(steps):
+        ready = [
+            name
+            for name, (_, deps) in steps.items()
+            if name not in done and all(dep in done for dep in deps)
+        ]
+        if not ready:
+            raise ValueError("Steps depend on each other in a cycle")
+        order += ready
+        done.update(ready)
+    jobs = jobs if jobs > 0 else min(32, (os.cpu_count() or 1) + 4)
+    return asyncio.run(_run_graph(steps, order, jobs))
+
+
+async def _run_graph(steps: dict, order: list, jobs: int) -> dict:
+    tasks = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+
+        async def step(name: str):
+            func, deps = steps[name]
+            # Raises the error of a failed dependency instead of running.
+            for dep in deps:
+                await tasks[dep]
+            return await _in_thread(pool, func)
+
+        # Dependencies come first in order, so their tasks already exist.
+        for name in order:
+            tasks[name] = asyncio.ensure_future(step(name))
+        await asyncio.wait(tasks.values())
+    errors = [tasks[name].exception() for name in order]
+    for error in errors:
+        if error is not None:
+            raise error
+    return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,322 @@
+"""Rootfs size estimation for imageforge images.
+
+A tree is scanned once and the space its contents take is modelled for
+every filesystem imageforge creates: blocks of file data, directory blocks,
+inode tables, journal and reserved blocks for ext4, duplicated metadata and
+inlined small files for btrfs, cluster rounding and FAT tables for vfat.
+The models are estimates erring on the large side, shrink_image fits an ext4
+image to its contents exactly once populated.
+"""
+
+import os
+import stat
+import struct
+from .loopdev import loop_device
+from .profiling import run
+from .ptable import (
+    ALIGNMENT,
+    GPT_ENTRY_SECTORS,
+    SECTOR_SIZE,
+    add_partition,
+    new_table,
+    read_table,
+    write_table,
+)
+
+# Block size of ext4 and btrfs, and cluster size of vfat boot partitions.
+BLOCK_SIZE = 4096
+# Bytes per inode and inode size mke2fs uses by default.
+EXT4_INODE_RATIO = 16384
+EXT4_INODE_SIZE = 256
+# Files up to this size are stored in the btrfs metadata, the max_inline default.
+BTRFS_MAX_INLINE = 2048
+# Chunks and reserves btrfs allocates whatever the contents.
+BTRFS_BASE = 256 * 1024 * 1024
+# Symlink targets shorter than this are stored in the ext4 inode.
+_EXT4_FAST_SYMLINK = 60
+_MiB = 1024 * 1024
+
+
+def _blocks(size: int) -> int:
+    return -(-size // BLOCK_SIZE)
+
+
+def scan(path: str, exclude: list = None) -> dict:  # type: ignore
+    """
+    Count what a tree holds, walking it once.
+
+    Hardlinked files are counted once. The contents of excluded directories
+    are left out, the directories themselves are counted.
+
+    Parameters
+    ----------
+        path (str): The tree, or a single file.
+        exclude (list, optional): Directories relative to path to leave out. Defaults to None.
+
+    Returns
+    -------
+    dict: The number of "files", "dirs", "symlinks" and "other" entries, the
+    "bytes" of file data and the "allocated" bytes on the current filesystem,
+    the "data_blocks" files take, "inline" files and bytes btrfs would keep
+    in its metadata, "long_symlinks" needing a block on ext4, the "names"
+    bytes, the ext4 "dir_blocks" and the vfat "dir_clusters".
+    """
+    stats = {
+        "files": 0,
+        "dirs": 0,
+        "symlinks": 0,
+        "other": 0,
+        "bytes": 0,
+        "allocated": 0,
+        "data_blocks": 0,
+        "inline_files": 0,
+        "inline_bytes": 0,
+        "long_symlinks": 0,
+        "names": 0,
+        "dir_blocks": 0,
+        "dir_clusters": 0,
+    }
+    excluded = set(rel.strip("/") for rel in exclude or [])
+    seen = set()
+
+    def count(st: os.stat_result) -> None:
+        if stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    return
+                seen.add((st.st_dev, st.st_ino))
+            stats["files"] += 1
+            stats["bytes"] += st.st_size
+            if st.st_size <= BTRFS_MAX_INLINE:
+                stats["inline_files"] += 1
+                stats["inline_bytes"] += st.st_size
+            stats["data_blocks"] += _blocks(st.st_size)
+        elif stat.S_ISDIR(st.st_mode):
+            stats["dirs"] += 1
+        elif stat.S_ISLNK(st.st_mode):
+            stats["symlinks"] += 1
+            if st.st_size >= _EXT4_FAST_SYMLINK:
+                stats["long_symlinks"] += 1
+        else:
+            stats["other"] += 1
+        stats["allocated"] += st.st_blocks * 512
+
+    root = os.lstat(path)
+    count(root)
+    if not stat.S_ISDIR(root.st_mode):
+        return stats
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        # Both directories start with the . and .. entries.
+        ext4_dir = 24
+        vfat_dir = 64
+        with os.scandir(os.path.join(path, rel_dir)) as it:
+            for entry in it:
+                st = entry.stat(follow_symlinks=False)
+                count(st)
+                name = len(entry.name.encode())
+                stats["names"] += name
+                ext4_dir += 8 + -(-name // 4) * 4
+                # A short entry and a long name entry per 13 characters.
+                vfat_dir += (1 + -(-len(entry.name) // 13)) * 32
+                if stat.S_ISDIR(st.st_mode) and rel_dir + entry.name not in excluded:
+                    stack.append(rel_dir + entry.name + "/")
+        stats["dir_blocks"] += _blocks(ext4_dir)
+        stats["dir_clusters"] += _blocks(vfat_dir)
+    return stats
+
+
+def _ext4_journal(size: int) -> int:
+    """Journal size mke2fs picks for a filesystem of the given size."""
+    blocks = size // BLOCK_SIZE
+    for limit, journal in [
+        (32768, 1024),
+        (256 * 1024, 4096),
+        (512 * 1024, 8192),
+        (4096 * 1024, 16384),
+        (8192 * 1024, 32768),
+        (16384 * 1024, 65536),
+        (32768 * 1024, 131072),
+    ]:
+        if blocks < limit:
+            return journal * BLOCK_SIZE
+    return 262144 * BLOCK_SIZE
+
+
+def fs_size(stats: dict, fs: str) -> int:
+    """
+    Estimate the smallest filesystem holding a scanned tree.
+
+    Parameters
+    ----------
+        stats (dict): The scanned tree, see scan.
+        fs (str): The filesystem, "ext4", "btrfs" or "vfat".
+
+    Returns
+    -------
+    int: The size in bytes, a multiple of 1MiB.
+    """
+    if fs == "ext4":
+        data = (
+            stats["data_blocks"] + stats["dir_blocks"] + stats["long_symlinks"]
+        ) * BLOCK_SIZE
+        inodes = stats["files"] + stats["dirs"] + stats["symlinks"] + stats["other"]
+        # 5% reserved blocks, inode tables, bitmaps and group descriptors.
+        usable = 1 - 0.05 - EXT4_INODE_SIZE / EXT4_INODE_RATIO - 1 / 512
+        size = max(data, (inodes + 11) * EXT4_INODE_RATIO)
+        for _ in range(8):
+            size = max(
+                int((data + _ext4_journal(size)) / usable),
+                (inodes + 11) * EXT4_INODE_RATIO,
+            )
+    elif fs == "btrfs":
+        entries = stats["files"] + stats["dirs"] + stats["symlinks"] + stats["other"]
+        # Inode, inode ref, dir item and dir index items with their keys and
+        # names, an extent item per file and the inlined data.
+        metadata = entries * 400 + stats["names"] * 3 + stats["inline_bytes"]
+        metadata += stats["files"] * 80
+        data = (stats["data_blocks"] - stats["inline_files"]) * BLOCK_SIZE
+        # Metadata is duplicated and tree nodes are about 3/4 full.
+        size = BTRFS_BASE + int(data * 1.02) + int(metadata * 2 / 0.75)
+    elif fs == "vfat":
+        clusters = stats["data_blocks"] + stats["dir_clusters"]
+        # Reserved sectors, the two FATs of 4 bytes per cluster.
+        size = int((clusters * BLOCK_SIZE + 32 * SECTOR_SIZE) / (1 - 8 / BLOCK_SIZE))
+    else:
+        raise ValueError("Cannot estimate a " + fs + " filesystem")
+    return -(-size // _MiB) * _MiB
+
+
+def _layout(cfg, img_size: int) -> dict:
+    """Lay out the partition table of the config on a disk of img_size kilobytes."""
+    table = new_table(cfg["part_type"], img_size * 1024 // SECTOR_SIZE)
+    parts = {}
+    entries = cfg["partition_table"](img_size, cfg["fs"])
+    for i in entries.keys():
+        fs = entries[i][3]
+        if fs == "NONE":
+            continue
+        parts[i] = add_partition(table, entries[i][0], entries[i][1], fs)
+        parts[i]["fs"] = fs
+    return parts
+
+
+def image_size(tree: str, cfg, headroom: int = 0) -> int:
+    """
+    Recommend the size of an image holding a rootfs tree.
+
+    The root filesystem is estimated from the tree without its boot
+    partition directory, the image is then grown until the root partition
+    of the partition table holds it.
+
+    Parameters
+    ----------
+        tree (str): The rootfs tree.
+        cfg (BuildContext): The build, for its filesystem and partition table.
+        headroom (int, optional): Free space to leave in the root filesystem, in kilobytes. Defaults to 0.
+
+    Raises
+    ------
+        ValueError: If the boot directory does not fit the boot partition.
+
+    Returns
+    -------
+    int: The image size in kilobytes, a multiple of 1MiB.
+    """
+    boot_dir = "boot/efi" if cfg["has_uefi"] else "boot"
+    root_stats = scan(tree, ["proc", boot_dir])
+    needed = fs_size(root_stats, cfg["fs"]) + headroom * 1024
+    # Room for the table before the first partition and the backup GPT.
+    img_size = (needed + _MiB + _MiB) // 1024
+    for _ in range(64):
+        parts = _layout(cfg, img_size)
+        root = max(
+            (
+                part
+                for part in parts.values()
+                if part["fs"] not in ["fat32", "linux-swap"]
+            ),
+            key=lambda part: part["end"],
+        )
+        size = (root["end"] - root["start"] + 1) * SECTOR_SIZE
+        if size >= needed:
+            break
+        img_size += -(-(needed - size) // _MiB) * 1024
+    boot = [part for part in parts.values() if part["fs"] == "fat32"]
+    if boot and os.path.isdir(os.path.join(tree, boot_dir)):
+        boot_needed = fs_size(scan(os.path.join(tree, boot_dir)), "vfat")
+        boot_size = (boot[0]["end"] - boot[0]["start"] + 1) * SECTOR_SIZE
+        if boot_needed > boot_size:
+            raise ValueError(
+                "/"
+                + boot_dir
+                + " needs "
+                + str(boot_needed // _MiB)
+                + "MiB, the boot partition has "
+                + str(boot_size // _MiB)
+                + "MiB"
+            )
+    return img_size
+
+
+def _ext4_blocks(image: str, offset: int):  # type: ignore
+    """Get the block count and block size of an ext4 filesystem, None if it is none."""
+    with open(image, "rb") as f:
+        f.seek(offset + 1024)
+        sb = f.read(1024)
+    if struct.unpack_from("<H", sb, 0x38)[0] != 0xEF53:
+        return None
+    blocks = struct.unpack_from("<I", sb, 0x04)[0]
+    # The high half of the count is only valid with the 64bit feature.
+    if struct.unpack_from("<I", sb, 0x60)[0] & 0x80:
+        blocks |= struct.unpack_from("<I", sb, 0x150)[0] << 32
+    return blocks, 1024 << struct.unpack_from("<I", sb, 0x18)[0]
+
+
+def shrink_image(image: str, headroom: int = 0) -> int:  # type: ignore
+    """
+    Shrink an image file to fit its contents.
+
+    The last partition is shrunk to its ext4 filesystem made minimal by
+    resize2fs -M, and the image truncated behind it. Images whose last
+    partition holds another filesystem are left as they are.
+
+    Parameters
+    ----------
+        image (str): The image file, not attached to a loop device.
+        headroom (int, optional): Free space to leave in the filesystem, in kilobytes. Defaults to 0.
+
+    Returns
+    -------
+    int: The size of the image in kilobytes.
+    """
+    table = read_table(image)
+    if table is None or not table["partitions"]:
+        return os.path.getsize(image) // 1024
+    last = max(table["partitions"], key=lambda part: part["end"])
+    offset = last["start"] * SECTOR_SIZE
+    if _ext4_blocks(image, offset) is None:
+        return os.path.getsize(image) // 1024
+    size = (last["end"] - last["start"] + 1) * SECTOR_SIZE
+    with loop_device(image, offset=offset, sizelimit=size, partscan=False) as ldev:
+        # 1 means errors were fixed.
+        if run(["e2fsck", "-f", "-y", ldev]).returncode > 1:
+            raise RuntimeError("e2fsck failed on the root filesystem of " + image)
+        run(["resize2fs", "-M", ldev], check=True)
+        if headroom:
+            blocks, block_size = _ext4_blocks(ldev, 0)
+            blocks += -(-headroom * 1024 // block_size)
+            if blocks * block_size < size:
+                run(["resize2fs", ldev, str(blocks)], check=True)
+    blocks, block_size = _ext4_blocks(image, offset)
+    sectors = -(-blocks * block_size // SECTOR_SIZE)
+    last["end"] = last["start"] + sectors - 1
+    end = -(-(last["end"] + 1) // ALIGNMENT) * ALIGNMENT
+    if table["label"] == "gpt":
+        # The backup entries and header.
+        end += GPT_ENTRY_SECTORS + 1
+    table["sectors"] = end
+    os.truncate(image, end * SECTOR_SIZE)
+    write_table(image, table)
+    return os.path.getsize(image) // 1024
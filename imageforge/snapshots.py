@@ -0,0 +1,265 @@
+"""Cached rootfs snapshots for imageforge."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from .chroot import close_sessions
+from .profiling import run
+
+# File extension of the snapshot stored in every supported format.
+FORMATS = {"tar": ".tar.zst", "squashfs": ".sqfs", "btrfs": ""}
+
+
+def _hash(data) -> str:
+    """Return the hex SHA-256 digest of a JSON serialisable value."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _read(path: str):  # type: ignore
+    """Return the contents of a config file, or None if it is missing."""
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return f.read()
+
+
+def backend_key(cfg: dict) -> str:
+    """
+    Hash the parts of the config that shape a bootstrapped rootfs, besides the packages.
+
+    Parameters
+    ----------
+        cfg (dict): The build config.
+
+    Returns
+    -------
+    str: The backend key.
+    """
+    return _hash(
+        {
+            "base": cfg["base"],
+            "arch": cfg["arch"],
+            "pacman_conf": _read(cfg["pacman_conf"]),
+            "suite": cfg["suite"],
+            "mirror": cfg["mirror"],
+            "components": cfg["components"],
+            "customize": (
+                _read(os.path.join(cfg["config_dir"], "customize.sh"))
+                if cfg["base"] == "debian"
+                else None
+            ),
+        }
+    )
+
+
+def _is_subvolume(path: str) -> bool:
+    return (
+        run(
+            ["btrfs", "subvolume", "show", path],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        == 0
+    )
+
+
+class SnapshotCache:
+    """
+    Bootstrapped rootfs trees keyed by backend config and package set.
+
+    Snapshots are stored as <snapshot_dir>/<backend key>/<package hash> in
+    the configured format, next to a JSON file listing their packages so the
+    closest snapshot can be found when the package set changed.
+    """
+
+    def __init__(
+        self, snapshot_dir: str, fmt: str, key: str, log: logging.Logger = None
+    ):  # type: ignore
+        """
+        Parameters
+        ----------
+            snapshot_dir (str): The directory holding the snapshots.
+            fmt (str): The storage format, one of FORMATS.
+            key (str): The backend key of this build, see backend_key.
+            log (logging.Logger, optional): The log of the build. Defaults to the root logger.
+        """
+        self.log = log if log is not None else logging.getLogger()
+        self.fmt = fmt
+        self.dir = os.path.join(snapshot_dir, key)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def _path(self, packages_hash: str) -> str:
+        return os.path.join(self.dir, packages_hash + FORMATS[self.fmt])
+
+    def lookup(self, packages: list, max_delta: float = 1.0):  # type: ignore
+        """
+        Find the snapshot closest to a package set.
+
+        A snapshot further away than max_delta is not used: installing and
+        removing that many packages is slower than bootstrapping from
+        scratch.
+
+        Parameters
+        ----------
+            packages (list): The packages of the build.
+            max_delta (float, optional): Largest number of packages to add
+                and remove, as a share of the packages. Defaults to 1.0.
+
+        Returns
+        -------
+        The snapshot path and the lists of packages to add and remove, or None if there is no snapshot close enough.
+        """
+        wanted = set(packages)
+        best = None
+        for entry in os.listdir(self.dir):
+            if not entry.endswith(".json"):
+                continue
+            with open(os.path.join(self.dir, entry), "r") as f:
+                have = set(json.load(f)["packages"])
+            path = self._path(entry[: -len(".json")])
+            if not os.path.exists(path):
+                continue
+            added = sorted(wanted - have)
+            removed = sorted(have - wanted)
+            if best is None or len(added) + len(removed) < len(best[1]) + len(best[2]):
+                best = (path, added, removed)
+        if best is not None and len(best[1]) + len(best[2]) > max_delta * len(wanted):
+            self.log.info(
+                "Closest rootfs snapshot is "
+                + str(len(best[1]) + len(best[2]))
+                + " packages away, not restoring it"
+            )
+            return None
+        return best
+
+    def restore(self, path: str, install_dir: str) -> None:
+        """
+        Restore a snapshot into an empty install_dir.
+
+        Parameters
+        ----------
+            path (str): The snapshot, as returned by lookup.
+            install_dir (str): The directory to restore into.
+
+        Returns
+        -------
+        Nothing
+        """
+        self.log.info("Restoring rootfs snapshot " + path)
+        if self.fmt == "tar":
+            run(
+                [
+                    "tar",
+                    "--zstd",
+                    "--xattrs",
+                    "--xattrs-include=*",
+                    "--acls",
+                    "--numeric-owner",
+                    "-xpf",
+                    path,
+                    "-C",
+                    install_dir,
+                ],
+                check=True,
+            )
+        elif self.fmt == "squashfs":
+            run(["unsquashfs", "-f", "-q", "-d", install_dir, path], check=True)
+        else:
+            os.rmdir(install_dir)
+            run(["btrfs", "subvolume", "snapshot", path, install_dir], check=True)
+
+    def save(self, packages: list, install_dir: str) -> None:
+        """
+        Store install_dir as the snapshot of a package set.
+
+        Parameters
+        ----------
+            packages (list): The packages installed in install_dir.
+            install_dir (str): The bootstrapped rootfs.
+
+        Returns
+        -------
+        Nothing
+        """
+        # No host mount of a chroot may end up in the snapshot.
+        close_sessions(install_dir)
+        packages_hash = _hash(sorted(set(packages)))
+        path = self._path(packages_hash)
+        # Private to this build, concurrent builds of the same packages each
+        # write their own and the last one to finish replaces the others.
+        tmp_dir = tempfile.mkdtemp(
+            dir=self.dir, prefix=packages_hash + ".", suffix=".tmp"
+        )
+        tmp = os.path.join(tmp_dir, "snapshot" + FORMATS[self.fmt])
+        self.log.info("Saving rootfs snapshot " + path)
+        try:
+            self._write(install_dir, tmp)
+            if os.path.isdir(path):
+                run(["btrfs", "subvolume", "delete", path], check=True)
+            os.replace(tmp, path)
+            with open(os.path.join(tmp_dir, "packages.json"), "w") as f:
+                json.dump({"packages": sorted(set(packages))}, f, indent=1)
+            os.replace(
+                os.path.join(tmp_dir, "packages.json"),
+                os.path.join(self.dir, packages_hash + ".json"),
+            )
+        finally:
+            if os.path.isdir(tmp) and not os.path.islink(tmp):
+                run(["btrfs", "subvolume", "delete", tmp])
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _write(self, install_dir: str, tmp: str) -> None:
+        """Write the snapshot of install_dir to tmp in the cache format."""
+        if self.fmt == "tar":
+            run(
+                [
+                    "tar",
+                    "-I",
+                    "zstd -T0 -3",
+                    "--xattrs",
+                    "--xattrs-include=*",
+                    "--acls",
+                    "--numeric-owner",
+                    "-cpf",
+                    tmp,
+                    "-C",
+                    install_dir,
+                    ".",
+                ],
+                check=True,
+            )
+        elif self.fmt == "squashfs":
+            run(
+                [
+                    "mksquashfs",
+                    install_dir,
+                    tmp,
+                    "-noappend",
+                    "-quiet",
+                    "-comp",
+                    "zstd",
+                    "-xattrs",
+                ],
+                check=True,
+            )
+        else:
+            if _is_subvolume(install_dir):
+                run(
+                    ["btrfs", "subvolume", "snapshot", "-r", install_dir, tmp],
+                    check=True,
+                )
+            else:
+                run(["btrfs", "subvolume", "create", tmp], check=True)
+                run(
+                    ["cp", "-a", "--reflink=auto", install_dir + "/.", tmp],
+                    check=True,
+                )
+
+
+def is_empty(path: str) -> bool:
+    """Whether a directory is missing or has no entries."""
+    return not os.path.isdir(path) or not os.listdir(path)
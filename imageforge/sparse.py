@@ -0,0 +1,214 @@
+"""Sparse file helpers for imageforge."""
+
+import errno
+import os
+
+# Size of the pieces data extents are read and copied in.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+_ZEROS = bytes(CHUNK_SIZE)
+
+
+def is_hole(chunk) -> bool:
+    """
+    Whether a chunk yielded by read_sparse stands for a hole of the file.
+
+    Parameters
+    ----------
+        chunk (bytes-like): The chunk.
+
+    Returns
+    -------
+    bool: True for holes, False for data read from disk, even if all zeros.
+    """
+    return isinstance(chunk, memoryview) and chunk.obj is _ZEROS
+
+
+def data_extents(fd: int, size: int = None) -> list:  # type: ignore
+    """
+    List the allocated extents of an open file.
+
+    Uses SEEK_DATA/SEEK_HOLE, so unallocated ranges and the unwritten extents
+    left behind by fallocate are reported as holes. Filesystems without
+    support fall back to a single extent covering the whole file.
+
+    Parameters
+    ----------
+        fd (int): The open file descriptor.
+        size (int, optional): The size of the file. Defaults to its current size.
+
+    Returns
+    -------
+    list: (start, end) byte offsets of every data extent, in order.
+    """
+    if size is None:
+        size = os.fstat(fd).st_size
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # No data after offset, the rest of the file is a hole.
+                    break
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append((start, end))
+            offset = end
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+        extents = [(0, size)] if size else []
+    os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+
+def read_sparse(path: str, stats: dict = None, start: int = 0, end: int = None):  # type: ignore
+    """
+    Read a file front to back, reading only its data extents from disk.
+
+    Holes are yielded as views of a shared zero buffer, so they cost neither
+    I/O nor allocations.
+
+    Parameters
+    ----------
+        path (str): The file to read.
+        stats (dict, optional): Updated with the "size" of the file and the
+            number of bytes actually "read".
+        start (int, optional): Offset to start reading at. Defaults to 0.
+        end (int, optional): Offset to stop reading at. Defaults to the size of the file.
+
+    Returns
+    -------
+    Generator of bytes-like objects covering the file or the range.
+    """
+    zeros = memoryview(_ZEROS)
+    with open(path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if stats is not None:
+            stats["size"] = size
+            stats.setdefault("read", 0)
+        end = size if end is None else min(end, size)
+        offset = start
+        extents = [
+            (max(data, start), min(stop, end))
+            for data, stop in data_extents(f.fileno(), size)
+            if data < end and stop > start
+        ]
+        for data, stop in extents + [(end, end)]:
+            while offset < data:
+                n = min(CHUNK_SIZE, data - offset)
+                yield zeros[:n]
+                offset += n
+            f.seek(data)
+            while offset < stop:
+                chunk = f.read(min(CHUNK_SIZE, stop - offset))
+                if not chunk:
+                    raise OSError(errno.EIO, "Short read from " + path)
+                if stats is not None:
+                    stats["read"] += len(chunk)
+                yield chunk
+                offset += len(chunk)
+
+
+def _copy_range(
+    src: int, dst: int, start: int, end: int, method: str, shift: int = 0
+) -> None:
+    """Copy [start, end) between two files, to start + shift in dst."""
+    offset = start
+    while offset < end:
+        n = min(CHUNK_SIZE, end - offset)
+        if method == "auto":
+            try:
+                copied = os.copy_file_range(src, dst, n, offset, offset + shift)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                method = "read"
+                continue
+        elif method == "copy_file_range":
+            copied = os.copy_file_range(src, dst, n, offset, offset + shift)
+        elif method == "sendfile":
+            os.lseek(dst, offset + shift, os.SEEK_SET)
+            copied = os.sendfile(dst, src, offset, n)
+        else:
+            copied = os.pwrite(dst, os.pread(src, n, offset), offset + shift)
+        if copied == 0:
+            raise OSError(errno.EIO, "Short copy")
+        offset += copied
+
+
+def copy_sparse_fd(
+    src: int, dst: int, size: int, method: str = "auto", holes: bool = True
+) -> int:
+    """
+    Copy between open files, transferring only the data extents of src.
+
+    Parameters
+    ----------
+        src (int): The open file to copy.
+        dst (int): The open, empty destination file, truncated to size.
+        size (int): The size of src.
+        method (str, optional): The transfer method, see copy_sparse. Defaults to "auto".
+        holes (bool, optional): Look up the holes of src with SEEK_DATA/SEEK_HOLE;
+            without, all of it is copied. Defaults to True.
+
+    Returns
+    -------
+    int: The number of bytes copied.
+    """
+    copied = 0
+    os.ftruncate(dst, size)
+    for start, end in data_extents(src, size) if holes else [(0, size)]:
+        _copy_range(src, dst, start, end, method)
+        copied += end - start
+    return copied
+
+
+def copy_sparse(src: str, dst: str, method: str = "auto") -> int:
+    """
+    Copy a file, transferring only its data extents and keeping holes.
+
+    Parameters
+    ----------
+        src (str): The file to copy.
+        dst (str): The destination file, replaced if it exists.
+        method (str, optional): "copy_file_range", "sendfile" or "read" to
+            force a transfer method, "auto" to use copy_file_range and fall
+            back to reading. Defaults to "auto".
+
+    Returns
+    -------
+    int: The number of bytes copied.
+    """
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        size = os.fstat(s.fileno()).st_size
+        return copy_sparse_fd(s.fileno(), d.fileno(), size, method)
+
+
+def splice_sparse(src: str, dst: str, offset: int, method: str = "auto") -> int:
+    """
+    Write a file into another one at an offset, transferring only its data extents.
+
+    The holes of src are skipped, so the matching range of dst must already
+    read as zeros, as it does in a freshly allocated image.
+
+    Parameters
+    ----------
+        src (str): The file to write, e.g. a filesystem image.
+        dst (str): The file to write into, e.g. a disk image. It is not truncated.
+        offset (int): Byte offset in dst src starts at.
+        method (str, optional): The transfer method, see copy_sparse. Defaults to "auto".
+
+    Returns
+    -------
+    int: The number of bytes copied.
+    """
+    copied = 0
+    with open(src, "rb") as s, open(dst, "r+b") as d:
+        for start, end in data_extents(s.fileno()):
+            _copy_range(s.fileno(), d.fileno(), start, end, method, offset)
+            copied += end - start
+    return copied
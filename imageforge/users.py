@@ -0,0 +1,286 @@
+"""In-process user provisioning for imageforge.
+
+The passwd and group files of a rootfs are parsed once into a UserTable.
+Homes are filled from a single listing of /etc/skel, walked once for all
+users with the contents of its small files kept in memory, and every entry
+is created already owned by its user, so no later chown pass is needed.
+Homes are provisioned concurrently, users with a lot of them are common
+on lab images.
+"""
+
+import errno
+import fcntl
+import functools
+import logging
+import os
+import shutil
+import stat
+from .export import FICLONE, UNSUPPORTED
+from .runner import run_graph
+from .sparse import copy_sparse_fd
+
+# Regular users getting the skeleton have UID_MIN < uid < UID_MAX.
+UID_MIN = 1000
+UID_MAX = 2000
+# Skeleton files up to this size are read once and written from memory.
+INLINE_SIZE = 64 * 1024
+
+
+def _read_db(path: str) -> list:
+    """The fields of every entry of a passwd or group file."""
+    entries = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                fields = line.rstrip("\n").split(":")
+                if len(fields) > 3 and fields[2].isdigit():
+                    entries.append(fields)
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+class UserTable:
+    """
+    The users and groups of a rootfs, indexed by name and by id.
+
+    Users are (name, uid, gid, home, shell) tuples and groups are
+    (name, gid, members) tuples, the first entry of a name or id winning
+    like it does for getpwnam and getpwuid.
+    """
+
+    def __init__(self, root: str):
+        """
+        Parameters
+        ----------
+            root (str): The rootfs, its etc/passwd and etc/group are read.
+        """
+        self.users = {}
+        self.uids = {}
+        self.groups = {}
+        self.gids = {}
+        for name, _, uid, gid, _, home, shell in (
+            (fields + [""] * 7)[:7]
+            for fields in _read_db(os.path.join(root, "etc/passwd"))
+        ):
+            user = (name, int(uid), int(gid) if gid.isdigit() else 0, home, shell)
+            self.users.setdefault(name, user)
+            self.uids.setdefault(user[1], user)
+        for fields in _read_db(os.path.join(root, "etc/group")):
+            group = (
+                fields[0],
+                int(fields[2]),
+                [member for member in fields[3].split(",") if member],
+            )
+            self.groups.setdefault(group[0], group)
+            self.gids.setdefault(group[1], group)
+
+    def regular(self) -> list:
+        """
+        The regular users, those getting a copy of the skeleton.
+
+        Returns
+        -------
+        list: The users with UID_MIN < uid < UID_MAX, in passwd order.
+        """
+        return [user for user in self.users.values() if UID_MIN < user[1] < UID_MAX]
+
+
+def list_skel(skel: str) -> list:
+    """
+    Walk the skeleton directory once for all users.
+
+    Parameters
+    ----------
+        skel (str): The skeleton directory, usually etc/skel of the rootfs.
+
+    Returns
+    -------
+    list: (relative path, stat, contents) of every entry, directories before
+        what they contain. contents is the symlink target, the data of files
+        up to INLINE_SIZE or None for bigger files, read at copy time.
+    """
+    entries = []
+
+    def walk(path: str, rel: str) -> None:
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            st = entry.stat(follow_symlinks=False)
+            name = os.path.join(rel, entry.name)
+            if stat.S_ISDIR(st.st_mode):
+                entries.append((name, st, None))
+                walk(entry.path, name)
+            elif stat.S_ISLNK(st.st_mode):
+                entries.append((name, st, os.readlink(entry.path)))
+            elif stat.S_ISREG(st.st_mode):
+                data = None
+                if st.st_size <= INLINE_SIZE:
+                    with open(entry.path, "rb") as f:
+                        data = f.read()
+                entries.append((name, st, data))
+            else:
+                logging.warning("Not copying special file " + entry.path + " to homes")
+
+    if os.path.isdir(skel):
+        walk(skel, "")
+    return entries
+
+
+def _clear(path: str, st: os.stat_result) -> None:
+    """Remove what is in the way of a skeleton entry."""
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _write_file(src: str, dst: str, st: os.stat_result, data, uid: int, gid: int):
+    fd = os.open(
+        dst,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC,
+        0o600,
+    )
+    try:
+        # Owned before any data or mode, chown would clear setuid bits.
+        os.fchown(fd, uid, gid)
+        if data is not None:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        else:
+            src_fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC)
+            try:
+                try:
+                    fcntl.ioctl(fd, FICLONE, src_fd)
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED:
+                        raise
+                    copy_sparse_fd(src_fd, fd, st.st_size)
+            finally:
+                os.close(src_fd)
+        os.fchmod(fd, stat.S_IMODE(st.st_mode))
+    finally:
+        os.close(fd)
+
+
+def _open_home(root: str, parts: list, uid: int, gid: int) -> int:
+    """
+    Create and open a home below root without following symlinks.
+
+    Raises
+    ------
+        OSError: If a component is a symlink, so the home could escape root.
+    """
+    flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+    fd = os.open(root, flags)
+    try:
+        for i, part in enumerate(parts):
+            try:
+                os.mkdir(part, 0o755, dir_fd=fd)
+            except FileExistsError:
+                pass
+            try:
+                new = os.open(part, flags, dir_fd=fd)
+            except OSError as e:
+                if e.errno in (errno.ELOOP, errno.ENOTDIR):
+                    raise OSError("Home is out of bounds: /" + "/".join(parts)) from e
+                raise
+            if i == len(parts) - 1:
+                os.chown(part, uid, gid, dir_fd=fd, follow_symlinks=False)
+            os.close(fd)
+            fd = new
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def provision_home(root: str, user: tuple, skel: str, entries: list) -> int:
+    """
+    Create the home of a user and copy the skeleton into it, owned by the user.
+
+    Existing files are overwritten like cp -r does, other files of the home
+    are left alone.
+
+    Parameters
+    ----------
+        root (str): The rootfs.
+        user (tuple): The user, as in UserTable.users.
+        skel (str): The skeleton directory the entries were listed from.
+        entries (list): The skeleton, as returned by list_skel.
+
+    Raises
+    ------
+        OSError: If the home of the user is out of the rootfs.
+
+    Returns
+    -------
+    int: The number of entries copied.
+    """
+    name, uid, gid, home, _ = user
+    parts = [part for part in (home or "/home/" + name).split("/") if part]
+    if not parts or ".." in parts:
+        raise OSError("Home of " + name + " is out of bounds: " + home)
+    home_fd = _open_home(root, parts, uid, gid)
+    try:
+        _copy_skel(home_fd, skel, entries, uid, gid)
+    finally:
+        os.close(home_fd)
+    return len(entries)
+
+
+def _copy_skel(home_fd: int, skel: str, entries: list, uid: int, gid: int) -> None:
+    # Paths go through the open home, so nothing above it is resolved again.
+    # Below it parents come first and are made sure to be directories.
+    home = "/proc/self/fd/" + str(home_fd)
+    for rel, st, contents in entries:
+        dst = os.path.join(home, rel)
+        try:
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            dst_st = None
+        if stat.S_ISDIR(st.st_mode):
+            if dst_st is not None and not stat.S_ISDIR(dst_st.st_mode):
+                # Never follow a symlink in place of a directory.
+                os.unlink(dst)
+                dst_st = None
+            if dst_st is None:
+                os.mkdir(dst, 0o700)
+            os.chown(dst, uid, gid)
+            os.chmod(dst, stat.S_IMODE(st.st_mode))
+            continue
+        if stat.S_ISLNK(st.st_mode):
+            if dst_st is not None:
+                _clear(dst, dst_st)
+            os.symlink(contents, dst)
+            os.chown(dst, uid, gid, follow_symlinks=False)
+            continue
+        if dst_st is not None and not stat.S_ISREG(dst_st.st_mode):
+            # A symlink in place of a file is replaced, never written through.
+            _clear(dst, dst_st)
+        _write_file(os.path.join(skel, rel), dst, st, contents, uid, gid)
+
+
+def provision_homes(root: str, users: list, entries: list, jobs: int = 0) -> int:
+    """
+    Provision the homes of several users concurrently.
+
+    Parameters
+    ----------
+        root (str): The rootfs.
+        users (list): The users, as in UserTable.users.
+        entries (list): The skeleton, as returned by list_skel for etc/skel of root.
+        jobs (int, optional): Homes provisioned at once, 0 for the run_graph default. Defaults to 0.
+
+    Returns
+    -------
+    int: The number of entries copied.
+    """
+    skel = os.path.join(root, "etc/skel")
+    results = run_graph(
+        {
+            user[0]: (functools.partial(provision_home, root, user, skel, entries), [])
+            for user in users
+        },
+        jobs,
+    )
+    return sum(results.values())